@@ -0,0 +1,103 @@
+import threading
+from typing import Dict, Any, Optional
+
+# 统计吞吐量时按批次token数分组的组距
+THROUGHPUT_BUCKET_TOKENS = 256
+
+class AdaptiveBatchSizer:
+    """
+    根据每批的延迟、输出截断和解析结果在线调整批次的token预算（加性增、乘性减）
+
+    批次顺利完成时预算增加increase_step；输出被截断（finish_reason为length）、需要调用LLM修正格式、
+    解析失败或延迟超过target_latency时预算乘以decrease_factor；只靠本地修复才解析成功时预算保持不变。
+    预算始终在[min_tokens, max_tokens]之间。同一次运行的所有文件共享一个实例，可以在多个线程间共享。
+    """
+
+    def __init__(self, initial_tokens: int, min_tokens: int, max_tokens: int, increase_step: Optional[int] = None,
+                 decrease_factor: float = 0.7, target_latency: Optional[float] = None):
+        """
+        Args:
+            initial_tokens: 初始预算
+            min_tokens: 预算下限
+            max_tokens: 预算上限
+            increase_step: 每次增加的token数，默认为上下限之差的1/8
+            decrease_factor: 每次减小时乘以的系数
+            target_latency: 单批处理的目标耗时（秒），为None时不按延迟调整
+        """
+        self.min_tokens = max(1, min_tokens)
+        self.max_tokens = max(self.min_tokens, max_tokens)
+        self.increase_step = increase_step or max(1, (self.max_tokens - self.min_tokens) // 8)
+        self.decrease_factor = decrease_factor
+        self.target_latency = target_latency
+        self.initial_tokens = min(max(initial_tokens, self.min_tokens), self.max_tokens)
+        self._budget = self.initial_tokens
+        self.increases = 0
+        self.decreases = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @property
+    def budget(self) -> int:
+        with self._lock:
+            return self._budget
+
+    def observe(self, tokens: int, latency: float, observation: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        登记一个批次的处理结果并调整预算
+
+        Args:
+            tokens: 批次的输入token数
+            latency: 批次的处理耗时（秒）
+            observation: process_batch填写的结果，包括finish_reason和parse（ok/local_repair/llm_repair/failed）
+        Returns:
+            调整结果，包括调整方向、原因和新的预算
+        """
+        parse = observation.get("parse", "failed")
+        if observation.get("finish_reason") == "length":
+            action, reason = "decrease", "输出被截断"
+        elif parse in ("llm_repair", "failed"):
+            action, reason = "decrease", "解析失败" if parse == "failed" else "需要LLM修正格式"
+        elif self.target_latency and latency > self.target_latency:
+            action, reason = "decrease", f"耗时超过{self.target_latency}s"
+        elif parse == "local_repair":
+            action, reason = "hold", "本地修复后解析成功"
+        else:
+            action, reason = "increase", "处理成功"
+
+        with self._lock:
+            if action == "decrease":
+                self._budget = max(self.min_tokens, int(self._budget * self.decrease_factor))
+                self.decreases += 1
+            elif action == "increase" and self._budget < self.max_tokens:
+                self._budget = min(self.max_tokens, self._budget + self.increase_step)
+                self.increases += 1
+            bucket = self._buckets.setdefault(tokens // THROUGHPUT_BUCKET_TOKENS,
+                                              {"batches": 0, "tokens": 0, "seconds": 0.0, "failures": 0})
+            bucket["batches"] += 1
+            bucket["tokens"] += tokens
+            bucket["seconds"] += latency
+            bucket["failures"] += action == "decrease"
+            budget = self._budget
+        return {"action": action, "reason": reason, "budget": budget}
+
+    def stats(self) -> Dict[str, Any]:
+        """返回预算范围、调整次数和按批次大小分组的吞吐量"""
+        with self._lock:
+            by_size = [
+                {
+                    "tokens_range": f"{index * THROUGHPUT_BUCKET_TOKENS}-{(index + 1) * THROUGHPUT_BUCKET_TOKENS - 1}",
+                    "batches": bucket["batches"],
+                    "tokens_per_second": round(bucket["tokens"] / bucket["seconds"], 1) if bucket["seconds"] else None,
+                    "failure_rate": round(bucket["failures"] / bucket["batches"], 4)
+                }
+                for index, bucket in sorted(self._buckets.items())
+            ]
+            return {
+                "min_tokens": self.min_tokens,
+                "max_tokens": self.max_tokens,
+                "initial_tokens": self.initial_tokens,
+                "final_tokens": self._budget,
+                "increases": self.increases,
+                "decreases": self.decreases,
+                "by_size": by_size
+            }
@@ -0,0 +1,82 @@
+import re
+from difflib import SequenceMatcher
+from typing import List, Optional, Tuple
+
+# 统计未覆盖文本时只计算有实际内容的字符，忽略空白和标点
+_WORD_CHAR_PATTERN = re.compile(r'[\u4e00-\u9fffA-Za-z0-9]')
+
+# 在当前位置附近的窗口之外做精确查找时，片段至少要有这么多有效字符，
+# 否则"对。""嗯。"这类短句会匹配到很远处的重复，使之后的片段都无法对齐
+MIN_DISTANT_MATCH_CHARS = 12
+
+def align_segments(source: str, contents: List[str], base_offset: int = 0,
+                   min_similarity: float = 0.6) -> Tuple[List[Optional[Tuple[int, int]]], List[Tuple[int, int]]]:
+    """
+    把各片段的内容按顺序对齐到原文（区间都加上base_offset）
+
+    先在当前位置之后的窗口内做精确查找，窗口外只为足够长的片段（见MIN_DISTANT_MATCH_CHARS）精确查找，
+    以便跳过模型漏掉的大段原文；都找不到时在窗口内做字符级模糊匹配，容忍少量增删改。
+    匹配上的字符少于内容的min_similarity时认为该片段无法对齐。
+
+    Returns:
+        (每个片段在原文中的[start, end)区间，无法对齐时为None；实际匹配上的原文区间列表)
+        片段中间漏掉的原文不在匹配区间内，可以据此找出未覆盖的部分。
+    """
+    spans = []
+    matched = []
+    cursor = 0
+    for content in contents:
+        content = content.strip()
+        if not content:
+            spans.append(None)
+            continue
+        window_end = min(len(source), cursor + int(len(content) * 1.5) + 200)
+        start = source.find(content, cursor, window_end)
+        if start < 0 and count_content_chars(content) >= MIN_DISTANT_MATCH_CHARS:
+            start = source.find(content, cursor)
+        if start >= 0:
+            end = start + len(content)
+            matched.append((base_offset + start, base_offset + end))
+        else:
+            matcher = SequenceMatcher(None, source[cursor:window_end], content, autojunk=False)
+            blocks = [block for block in matcher.get_matching_blocks() if block.size >= 2]
+            if not blocks or sum(block.size for block in blocks) < len(content) * min_similarity:
+                spans.append(None)
+                continue
+            start = cursor + blocks[0].a
+            end = cursor + blocks[-1].a + blocks[-1].size
+            matched.extend((base_offset + cursor + block.a, base_offset + cursor + block.a + block.size) for block in blocks)
+        spans.append((base_offset + start, base_offset + end))
+        cursor = end
+    return spans, matched
+
+def find_gaps(source: str, matched: List[Tuple[int, int]], base_offset: int = 0,
+              min_gap_chars: int = 6) -> List[Tuple[int, int]]:
+    """
+    找出原文中不在任何匹配区间内的部分（加上base_offset）
+
+    只包含空白和标点、或者有效字符少于min_gap_chars的空隙会被忽略。
+    """
+    covered = sorted((start - base_offset, end - base_offset) for start, end in matched)
+    gaps = []
+    cursor = 0
+    for start, end in covered + [(len(source), len(source))]:
+        if start > cursor:
+            gaps.append((cursor, start))
+        cursor = max(cursor, end)
+    return [
+        (base_offset + start, base_offset + end) for start, end in gaps
+        if count_content_chars(source[start:end]) >= min_gap_chars
+    ]
+
+def count_content_chars(text: str) -> int:
+    """统计有效字符（汉字、字母、数字）的数量"""
+    return len(_WORD_CHAR_PATTERN.findall(text))
+
+def coverage_ratio(source: str, gaps: List[Tuple[int, int]], base_offset: int = 0) -> float:
+    """按有效字符计算原文被片段覆盖的比例"""
+    total = count_content_chars(source)
+    if not total:
+        return 1.0
+    missing = sum(count_content_chars(source[start - base_offset:end - base_offset]) for start, end in gaps)
+    return round(1 - missing / total, 4)
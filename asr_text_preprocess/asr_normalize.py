@@ -0,0 +1,113 @@
+import re
+from bisect import bisect_right
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+# ASR输出中的表情标记（如🎼😊😡😮）、杂项符号以及组合表情用的变体选择符和零宽连接符
+_EMOJI_CHARS = r'\U0001F000-\U0001FAFF\u2600-\u27BF\uFE0F\u200D'
+# 会被重复输出的标点，中文句号和英文句点连续3个以上时是省略号，不做处理
+_PUNCTUATION_CHARS = '，、；：,;。！？!?'
+# 各类噪声在统计中的名称
+_NOISE_KINDS = {"emoji": "emoji", "char": "stutter", "pair": "stutter", "word": "stutter", "punct": "punctuation"}
+# 两字词连续出现至少这么多次才折叠，"讨论讨论"、"一点一点"这类叠词出现两次是正常说法
+_MIN_PAIR_REPEATS = 3
+
+class OffsetMap:
+    """
+    清洗后文本到原文的字符偏移映射
+
+    清洗只删除字符，映射由删除点和累计删除数组成：清洗后文本中从anchors[i]开始的位置，
+    在原文中的偏移要加上shifts[i]。可以被pickle，能从预处理子进程返回。
+    """
+
+    def __init__(self, anchors: List[int], shifts: List[int]):
+        self.anchors = anchors
+        self.shifts = shifts
+
+    def to_raw(self, offset: int) -> int:
+        """清洗后文本中的偏移在原文中的位置"""
+        index = bisect_right(self.anchors, offset) - 1
+        return offset + (self.shifts[index] if index >= 0 else 0)
+
+    def span_to_raw(self, start: int, end: int) -> Tuple[int, int]:
+        """
+        把清洗后文本中的[start, end)区间换算为原文区间
+
+        紧跟在区间末尾被删除的字符（如折叠掉的重复字、句末的表情）计入该区间，相邻区间换算后仍然首尾相接。
+        """
+        if end <= start:
+            raw_start = self.to_raw(start)
+            return raw_start, raw_start
+        return self.to_raw(start), self.to_raw(end)
+
+@lru_cache(maxsize=None)
+def _noise_pattern(remove_emoji: bool, min_char_repeats: int, collapse_words: bool, max_word_length: int,
+                   dedupe_punctuation: bool):
+    """按清洗选项组合出一个正则，一次扫描同时识别各类噪声"""
+    parts = []
+    if remove_emoji:
+        parts.append(f'(?P<emoji>[{_EMOJI_CHARS}]+)')
+    if min_char_repeats > 1:
+        # 单字重复，如"我我我"；重复次数少于min_char_repeats的叠字（如"谢谢"）保留
+        parts.append(rf'(?P<char>[\u4e00-\u9fff])(?P=char){{{max(min_char_repeats, 3) - 1},}}')
+    if collapse_words:
+        # 两字词重复，如"然后然后然后"
+        parts.append(rf'(?P<pair>[\u4e00-\u9fff]{{2}})(?P=pair){{{_MIN_PAIR_REPEATS - 1},}}')
+        if max_word_length > 2:
+            # 三字以上的词重复，如"我觉得我觉得"，取最短的重复单位
+            parts.append(rf'(?P<word>[\u4e00-\u9fff]{{3,{max_word_length}}}?)(?P=word)+')
+    if dedupe_punctuation:
+        parts.append(f'(?P<punct>[{_PUNCTUATION_CHARS}])(?P=punct)+')
+    return re.compile("|".join(parts)) if parts else None
+
+def normalize_asr_text(text: str, remove_emoji: bool = True, min_char_repeats: int = 3, collapse_words: bool = True,
+                       max_word_length: int = 4, dedupe_punctuation: bool = True) -> Tuple[str, OffsetMap, Dict[str, int]]:
+    """
+    清洗ASR文本中不影响说话人分割、但会占用输入token的噪声
+
+    删除表情标记，折叠口吃造成的重复字词，把重复的标点合并为一个，只扫描一遍原文。单字和两字词的重复
+    折叠为两次，保留"谢谢"、"讨论讨论"这类叠词；三字以上的词折叠为一次。
+
+    Args:
+        text: ASR原文
+        remove_emoji: 是否删除表情标记
+        min_char_repeats: 单字连续出现至少这么多次（不少于3）时折叠为两次，小于2时不处理单字重复
+        collapse_words: 是否折叠重复的多字词，两字词连续出现至少3次时折叠为两次
+        max_word_length: 多字词的最大长度
+        dedupe_punctuation: 是否合并重复的标点
+    Returns:
+        (清洗后的文本, 到原文的偏移映射, 各类噪声删除的字符数)
+    """
+    removed = Counter({kind: 0 for kind in set(_NOISE_KINDS.values())})
+    pattern = _noise_pattern(remove_emoji, min_char_repeats, collapse_words, max_word_length, dedupe_punctuation)
+    if pattern is None or not text:
+        return text, OffsetMap([], []), dict(removed)
+
+    pieces = []
+    anchors = []
+    shifts = []
+    cursor = 0
+    clean_length = 0
+    deleted = 0
+    for match in pattern.finditer(text):
+        kind = match.lastgroup
+        matched = match.group()
+        if kind == "punct" and len(matched) >= 3 and matched[0] == "。":
+            continue
+        if kind == "emoji":
+            keep = ""
+        elif kind in ("char", "pair"):
+            keep = match.group(kind) * 2
+        else:
+            keep = match.group(kind)
+        pieces.append(text[cursor:match.start()])
+        pieces.append(keep)
+        clean_length += match.start() - cursor + len(keep)
+        deleted += len(matched) - len(keep)
+        anchors.append(clean_length)
+        shifts.append(deleted)
+        removed[_NOISE_KINDS[kind]] += len(matched) - len(keep)
+        cursor = match.end()
+    pieces.append(text[cursor:])
+    return "".join(pieces), OffsetMap(anchors, shifts), dict(removed)
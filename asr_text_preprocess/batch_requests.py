@@ -0,0 +1,361 @@
+"""
+离线批量请求模式
+
+不直接调用LLM，而是把规则提取和说话人分割阶段要发送的所有请求写入一个JSONL请求文件
+（OpenAI Batch API格式，每条请求带有稳定的custom_id），交给批量接口或本地替代服务一次性处理。
+拿到对应的结果JSONL后，再用ingest命令完成解析和结果写入，整个过程不需要任何网络请求。
+
+用法:
+    python batch_requests.py prepare-split --input /path/to/raw_text --output ./split_out --rules final_rules_summary.txt
+    python batch_requests.py prepare-rules --folders dir1 dir2 --output ./rules_out --samples 4
+    python batch_requests.py ingest --manifest ./split_out/batch_manifest.json --results ./results.jsonl
+
+注意: 离线模式下各批次同时提交，无法获得上一批次的摘要，因此除第一批外使用固定的占位历史。
+"""
+import argparse
+import hashlib
+import json
+import random
+from datetime import datetime
+from pathlib import Path
+from typing import List, Dict, Any
+
+from utils import load_config, get_all_txt_files
+from get_speaker_splits import (
+    batch_token_budget, build_speaker_split_messages, load_token_counter, measure_prompt_overhead,
+    prepare_file_batches,
+    parse_segments_with_repair, write_segments_jsonl
+)
+from get_speaker_split_rules import build_rule_extraction_messages, save_rule_result, RULE_SAMPLE_MAX_TOKENS
+from transcript_reader import sample_text_window
+
+FIRST_BATCH_HISTORY = "这是音频文本的开头。"
+OFFLINE_BATCH_HISTORY = "离线批量模式下没有前序批次的摘要，请仅根据本批次文本判断说话人。"
+
+def file_key(path) -> str:
+    """根据文件的绝对路径生成稳定的短标识，用于构造custom_id"""
+    return hashlib.sha1(str(Path(path).resolve()).encode("utf-8")).hexdigest()[:12]
+
+def make_batch_request(custom_id: str, messages: List[Dict[str, str]], config: Dict[str, Any]) -> Dict[str, Any]:
+    """构造一条Batch API格式的请求"""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": config.get("DEFAULT_MODEL", "deepseek-r1"),
+            "messages": messages,
+            "temperature": config.get("TEMPERATURE", 0.0),
+            "max_tokens": config.get("MAX_TOKENS", 8192)
+        }
+    }
+
+def write_requests(requests: List[Dict[str, Any]], entries: List[Dict[str, Any]], request_file: Path,
+                   manifest_path: Path) -> None:
+    """写入请求文件，以及记录custom_id与输入文件对应关系的清单"""
+    with open(request_file, 'w', encoding='utf-8') as f:
+        for request in requests:
+            f.write(json.dumps(request, ensure_ascii=False) + '\n')
+
+    manifest = {
+        "created_at": datetime.now().isoformat(),
+        "request_file": str(request_file),
+        "requests": entries
+    }
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    print(f"共写入 {len(requests)} 条请求到: {request_file}")
+    print(f"请求清单已保存到: {manifest_path}")
+
+def prepare_speaker_split_requests(
+    txt_path_list: List[str],
+    output_dir: str,
+    model_path: str = "/data4/liangyaozhen/model/Qwen2-7B-Instruct",
+    split_rules: str = "根据语气变化、话题转换、代词使用等线索进行说话人分割",
+    max_tokens_per_batch: int = 2148,
+    request_file: str = None,
+    context_length: int = None,
+    output_ratio: float = 1.3,
+    prefix_cache: bool = False,
+) -> Path:
+    """
+    把说话人分割的所有批次请求写入请求文件，分批方式与split_speakers一致
+
+    Args:
+        txt_path_list: ASR文本文件路径列表
+        output_dir: 输出目录，请求文件、清单以及之后的分割结果都保存在这里
+        model_path: 模型路径，用于加载tokenizer
+        split_rules: 说话人分割规则
+        max_tokens_per_batch: 每批最大token数
+        request_file: 请求文件路径，默认为output_dir/requests.jsonl
+        context_length: 模型上下文长度，设置后按实际prompt开销分批，与split_speakers一致
+        output_ratio: 输出与输入token数之比的估计值
+        prefix_cache: 是否使用前缀缓存布局组织分割prompt
+    Returns:
+        清单文件路径
+    """
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+    request_file = Path(request_file) if request_file else output_path / "requests.jsonl"
+
+    config = load_config()
+    token_counter = load_token_counter(model_path)
+    if context_length:
+        # 离线批处理的历史摘要是固定文本，按与split_speakers相同的预算分批，保证批次边界一致
+        prompt_overhead = measure_prompt_overhead(token_counter, split_rules, prefix_cache=prefix_cache)
+        available_tokens = batch_token_budget(context_length, prompt_overhead, output_ratio,
+                                              max_output_tokens=config.get("MAX_TOKENS"))
+    else:
+        available_tokens = max_tokens_per_batch - 100  # 留一些余量，与split_speakers一致
+
+    requests = []
+    entries = []
+    for txt_path in txt_path_list:
+        prepared = prepare_file_batches(txt_path, token_counter, available_tokens, balanced=bool(context_length),
+                                        keep_text=False)
+        if "error" in prepared:
+            print(f"文件 {txt_path} {prepared['error']}，跳过")
+            continue
+
+        sentences = prepared["sentences"]
+        key = file_key(txt_path)
+        for batch_id, (start, end) in enumerate(prepared["batch_plan"], start=1):
+            history = FIRST_BATCH_HISTORY if batch_id == 1 else OFFLINE_BATCH_HISTORY
+            messages = build_speaker_split_messages("".join(sentences[start:end]), split_rules, history,
+                                                    prefix_cache=prefix_cache)
+            custom_id = f"split-{key}-{batch_id:05d}"
+            requests.append(make_batch_request(custom_id, messages, config))
+            entries.append({
+                "custom_id": custom_id,
+                "stage": "split",
+                "file": txt_path,
+                "batch_id": batch_id,
+                "output_dir": str(output_path)
+            })
+    token_counter.close()
+
+    manifest_path = output_path / "batch_manifest.json"
+    write_requests(requests, entries, request_file, manifest_path)
+    return manifest_path
+
+def prepare_rule_extraction_requests(
+    folder_paths: List[str],
+    output_base_path: str,
+    samples_per_folder: int = 5,
+    request_file: str = None,
+    max_sample_tokens: int = RULE_SAMPLE_MAX_TOKENS,
+) -> Path:
+    """
+    为每个文件夹随机抽样文件，把规则提取请求写入请求文件，目录结构与process_multiple_folders一致
+
+    Returns:
+        清单文件路径
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    run_output_path = Path(output_base_path) / f"speaker_split_rules_{timestamp}"
+    run_output_path.mkdir(parents=True, exist_ok=True)
+    request_file = Path(request_file) if request_file else run_output_path / "requests.jsonl"
+
+    config = load_config()
+    requests = []
+    entries = []
+    for folder_path in folder_paths:
+        folder = Path(folder_path)
+        txt_files = list(folder.glob("*.txt"))
+        if not txt_files:
+            print(f"警告: 文件夹 {folder} 中没有找到txt文件")
+            continue
+
+        folder_output_path = run_output_path / folder.name
+        folder_output_path.mkdir(parents=True, exist_ok=True)
+
+        for file_path in random.sample(txt_files, min(samples_per_folder, len(txt_files))):
+            asr_text = sample_text_window(str(file_path), max_sample_tokens)
+            custom_id = f"rules-{file_key(file_path)}"
+            requests.append(make_batch_request(custom_id, build_rule_extraction_messages(asr_text), config))
+            entries.append({
+                "custom_id": custom_id,
+                "stage": "rules",
+                "file": str(file_path),
+                "folder_name": folder.name,
+                "output_dir": str(folder_output_path)
+            })
+
+    manifest_path = run_output_path / "batch_manifest.json"
+    write_requests(requests, entries, request_file, manifest_path)
+    return manifest_path
+
+def load_batch_results(results_path: str) -> Dict[str, str]:
+    """
+    读取结果JSONL，返回custom_id到响应文本的映射
+
+    兼容Batch API的输出格式({"custom_id", "response": {"status_code", "body"}, "error"})，
+    以及直接给出聊天补全结果的格式({"custom_id", "body"}或{"custom_id", "content"})。
+    失败的请求映射为None。
+    """
+    contents = {}
+    with open(results_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            custom_id = item.get("custom_id")
+            if custom_id is None:
+                continue
+            if "content" in item:
+                contents[custom_id] = item["content"]
+                continue
+            response = item.get("response") or {}
+            body = response.get("body") or item.get("body") or {}
+            if item.get("error") or response.get("status_code", 200) != 200 or not body.get("choices"):
+                contents[custom_id] = None
+                continue
+            contents[custom_id] = body["choices"][0]["message"]["content"]
+    return contents
+
+def ingest_batch_results(manifest_path: str, results_path: str) -> Dict[str, Any]:
+    """
+    读取批量结果，完成规则提取和说话人分割的解析以及结果写入，不发起任何网络请求
+
+    Args:
+        manifest_path: prepare阶段生成的清单文件
+        results_path: 与请求文件对应的结果JSONL
+    Returns:
+        处理结果统计
+    """
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    contents = load_batch_results(results_path)
+
+    # 按文件归并分割批次，规则提取请求逐条处理
+    split_files = {}
+    rule_results = {}
+    missing = 0
+    for entry in manifest["requests"]:
+        content = contents.get(entry["custom_id"])
+        if content is None:
+            missing += 1
+        if entry["stage"] == "split":
+            split_files.setdefault(entry["file"], []).append((entry, content))
+        elif entry["stage"] == "rules" and content is not None:
+            result = save_rule_result(entry["file"], entry["folder_name"], content, entry["output_dir"])
+            rule_results.setdefault(entry["folder_name"], []).append(result)
+
+    results = {
+        "total_files": len(split_files),
+        "processed_files": 0,
+        "failed_files": 0,
+        "failed_file_list": [],
+        "processing_details": [],
+        "missing_results": missing
+    }
+
+    for txt_path, batches in split_files.items():
+        batches.sort(key=lambda item: item[0]["batch_id"])
+        output_path = Path(batches[0][0]["output_dir"])
+        file_processing_detail = {
+            "file": txt_path,
+            "segments_count": 0,
+            "batch_count": len(batches),
+            "failed_segments": [],
+            "status": "processing"
+        }
+
+        all_segments = []
+        for entry, content in batches:
+            segments, _ = parse_segments_with_repair(content) if content else ([], [])
+            if not segments:
+                file_processing_detail["failed_segments"].append({
+                    "batch_id": entry["batch_id"],
+                    "error": "缺少批量结果" if content is None else "分割结果解析失败"
+                })
+                continue
+            # 更新ID以保持连续性
+            start_id = len(all_segments) + 1
+            for j, segment in enumerate(segments):
+                segment["id"] = str(start_id + j)
+                segment["batch"] = entry["batch_id"]
+                all_segments.append(segment)
+
+        file_processing_detail["segments_count"] = len(all_segments)
+        if all_segments:
+            jsonl_output_path = output_path / f"{Path(txt_path).stem}_speaker_split.jsonl"
+            write_segments_jsonl(all_segments, jsonl_output_path)
+            file_processing_detail["status"] = "partial_success" if file_processing_detail["failed_segments"] else "success"
+            results["processed_files"] += 1
+        else:
+            file_processing_detail["status"] = "failed"
+            file_processing_detail["error"] = "未获取到有效分割结果"
+            results["failed_files"] += 1
+            results["failed_file_list"].append({"file": txt_path, "error": "未获取到有效分割结果"})
+        results["processing_details"].append(file_processing_detail)
+
+    manifest_dir = Path(manifest_path).parent
+    if split_files:
+        summary_path = manifest_dir / "processing_summary.json"
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"分割结果统计已保存到: {summary_path}")
+    if rule_results:
+        summary_path = manifest_dir / "summary.json"
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump(rule_results, f, ensure_ascii=False, indent=2)
+        print(f"规则提取结果汇总保存在: {summary_path}")
+
+    print(f"共处理 {len(manifest['requests'])} 条请求，缺少或失败的结果: {missing}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="离线批量请求模式")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    split_parser = subparsers.add_parser("prepare-split", help="生成说话人分割的批量请求文件")
+    split_parser.add_argument("--input", required=True, help="ASR文本所在目录")
+    split_parser.add_argument("--output", required=True, help="输出目录")
+    split_parser.add_argument("--rules", help="分割规则文件")
+    split_parser.add_argument("--model-path", default="/data4/liangyaozhen/model/Qwen2-7B-Instruct")
+    split_parser.add_argument("--max-tokens-per-batch", type=int, default=2148)
+    split_parser.add_argument("--request-file", help="请求文件路径，默认为输出目录下的requests.jsonl")
+    split_parser.add_argument("--context-length", type=int, help="模型上下文长度，设置后按实际prompt开销分批")
+    split_parser.add_argument("--output-ratio", type=float, default=1.3, help="输出与输入token数之比的估计值")
+    split_parser.add_argument("--prefix-cache", action="store_true", help="使用前缀缓存布局组织分割prompt")
+
+    rules_parser = subparsers.add_parser("prepare-rules", help="生成规则提取的批量请求文件")
+    rules_parser.add_argument("--folders", nargs="+", required=True, help="ASR文本所在的文件夹")
+    rules_parser.add_argument("--output", required=True, help="输出目录")
+    rules_parser.add_argument("--samples", type=int, default=5, help="每个文件夹抽样的文件数")
+    rules_parser.add_argument("--request-file", help="请求文件路径，默认为本次运行目录下的requests.jsonl")
+    rules_parser.add_argument("--max-sample-tokens", type=int, default=RULE_SAMPLE_MAX_TOKENS,
+                              help="每个文件最多送入的token数，超长文件只取一段连续的完整句子")
+
+    ingest_parser = subparsers.add_parser("ingest", help="读取批量结果并写出最终结果")
+    ingest_parser.add_argument("--manifest", required=True, help="prepare阶段生成的batch_manifest.json")
+    ingest_parser.add_argument("--results", required=True, help="批量结果JSONL")
+
+    args = parser.parse_args()
+    if args.command == "prepare-split":
+        kwargs = {}
+        if args.rules:
+            with open(args.rules, 'r', encoding='utf-8') as f:
+                kwargs["split_rules"] = '\n'.join(f.readlines())
+        prepare_speaker_split_requests(
+            get_all_txt_files(args.input),
+            args.output,
+            model_path=args.model_path,
+            max_tokens_per_batch=args.max_tokens_per_batch,
+            request_file=args.request_file,
+            context_length=args.context_length,
+            output_ratio=args.output_ratio,
+            prefix_cache=args.prefix_cache,
+            **kwargs
+        )
+    elif args.command == "prepare-rules":
+        prepare_rule_extraction_requests(args.folders, args.output, args.samples, args.request_file,
+                                         args.max_sample_tokens)
+    else:
+        ingest_batch_results(args.manifest, args.results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+"""
+ASR文本预处理流程的性能基准
+
+用法:
+    python benchmarks.py inline-summary --input /path/to/raw_text --output ./bench_out --limit 3
+    python benchmarks.py token-count --input /path/to/raw_text --model /path/to/model --limit 20
+    python benchmarks.py segment-parser --samples 300 --cache-dir ./.llm_cache
+    python benchmarks.py export-malformed --cache-dir ./.llm_cache --output ./malformed.jsonl
+    python benchmarks.py sentence-split --input /path/to/raw_text --limit 20
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from utils import get_all_txt_files
+
+def benchmark_inline_summary(txt_path_list, output_dir, **split_kwargs):
+    """
+    对比分割+单独摘要的两次调用流程与合并摘要的单次调用流程
+
+    两种模式都关闭响应缓存并忽略处理清单，保证每个请求都实际发送。输出每个文件平均的调用次数、token用量和LLM耗时。
+    """
+    from get_speaker_splits import split_speakers
+
+    rows = []
+    for inline_summary in (False, True):
+        mode = "合并摘要" if inline_summary else "两次调用"
+        start = time.perf_counter()
+        results = split_speakers(
+            txt_path_list,
+            str(Path(output_dir) / ("inline_summary" if inline_summary else "two_call")),
+            inline_summary=inline_summary,
+            use_cache=False,
+            force=True,
+            **split_kwargs
+        )
+        wall_time = time.perf_counter() - start
+        usage = results["llm_usage"]
+        files = max(results["total_files"], 1)
+        rows.append({
+            "mode": mode,
+            "wall_time": wall_time,
+            "calls_per_file": usage["calls"] / files,
+            "prompt_tokens_per_file": usage["prompt_tokens"] / files,
+            "completion_tokens_per_file": usage["completion_tokens"] / files,
+            "llm_seconds_per_file": usage["latency_total"] / files,
+            "summary_fallbacks": sum(d.get("summary_fallbacks", 0) for d in results["processing_details"])
+        })
+
+    print("\n模式        墙钟(s)   调用/文件   输入token/文件   输出token/文件   LLM耗时/文件(s)   摘要回退")
+    for row in rows:
+        print(f"{row['mode']:<8}  {row['wall_time']:>8.1f}  {row['calls_per_file']:>10.1f}  "
+              f"{row['prompt_tokens_per_file']:>15.0f}  {row['completion_tokens_per_file']:>15.0f}  "
+              f"{row['llm_seconds_per_file']:>16.1f}  {row['summary_fallbacks']:>8}")
+    return rows
+
+def benchmark_token_counting(txt_path_list, model_path):
+    """
+    对比三种句子token计数方式：逐句编码、整文件批量编码、命中计数缓存
+
+    同时对比逐句正则估算与向量化估算。各方式的结果不一致时会给出提示。
+    """
+    from get_speaker_splits import count_tokens, load_tokenizer
+    from text2sentence import split_text_into_sentences
+    from token_counter import TokenCounter, estimate_tokens, estimate_tokens_batch
+
+    files_sentences = []
+    for txt_path in txt_path_list:
+        with open(txt_path, 'r', encoding='utf-8') as f:
+            asr_text = f.read().strip()
+        if asr_text:
+            files_sentences.append(split_text_into_sentences(asr_text)[0])
+    sentence_count = sum(len(sentences) for sentences in files_sentences)
+    print(f"共 {len(files_sentences)} 个文件，{sentence_count} 个句子")
+
+    def timed(fn):
+        start = time.perf_counter()
+        counts = [fn(sentences) for sentences in files_sentences]
+        return time.perf_counter() - start, counts
+
+    tokenizer = load_tokenizer(model_path)
+    rows = []
+    baseline = None
+    with tempfile.TemporaryDirectory() as cache_dir:
+        counter = TokenCounter(tokenizer, model_path, cache_dir=cache_dir)
+        paths = [
+            ("逐句编码", lambda sentences: [count_tokens(sentence, tokenizer) for sentence in sentences]),
+            ("批量编码", counter.count_sentences),
+            ("命中缓存", counter.count_sentences),
+        ]
+        if tokenizer:
+            paths += [
+                ("逐句估算", lambda sentences: [estimate_tokens(sentence) for sentence in sentences]),
+                ("向量化估算", estimate_tokens_batch),
+            ]
+        for name, fn in paths:
+            seconds, counts = timed(fn)
+            if name == "逐句估算":
+                baseline = None
+            if baseline is None:
+                baseline = counts
+            elif counts != baseline:
+                print(f"警告: {name} 的计数结果与基准不一致")
+            rows.append({"path": name, "seconds": seconds,
+                         "sentences_per_second": sentence_count / seconds if seconds else 0.0})
+        counter.close()
+
+    print("\n计数方式      耗时(s)     句子/秒")
+    for row in rows:
+        print(f"{row['path']:<8}  {row['seconds']:>9.3f}  {row['sentences_per_second']:>10.0f}")
+    return rows
+
+# 合成分割结果时使用的文本片段，包含LLM输出中常见的"<"、"&"等会破坏XML解析的字符
+_FUZZ_PHRASES = [
+    "你高三没结束呢", "我跟你讲这个问题很简单", "然后我今天回家了", "对对对", "你说的这个东西",
+    "A<B的时候", "1<2", "<3", "P&G", "AT&T", "&nbsp", "a & b", "x>y", "😂", "🎼", "哈哈哈", "OK", "你懂吧？"
+]
+_FUZZ_SPEAKERS = ["未明子", "连麦用户", "旁白", "背景音频"]
+# 逐条标注了应解析出的片段的格式错误样本，不是由模糊测试的变换生成的
+SEGMENT_FIXTURE_PATH = Path(__file__).resolve().parent / "tests" / "fixtures" / "malformed_split_responses.jsonl"
+
+def _render_segments(segments):
+    return "".join(
+        f"<SEGMENT>\n<ID>{i}</ID>\n<ANALYSIS>{analysis}</ANALYSIS>\n<SPEAKER>{speaker}</SPEAKER>\n"
+        f"<CONTENT>{content}</CONTENT>\n</SEGMENT>\n"
+        for i, (analysis, speaker, content) in enumerate(segments, start=1)
+    )
+
+def _cached_response_contents(cache_dir):
+    """逐条产出LLM响应缓存中第一个候选的文本"""
+    path = os.path.join(cache_dir, "responses.sqlite")
+    if not os.path.exists(path):
+        return
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("SELECT value FROM responses").fetchall()
+    finally:
+        conn.close()
+    for (value,) in rows:
+        choices = json.loads(value).get("choices") or [{}]
+        yield (choices[0].get("message") or {}).get("content") or ""
+
+def load_cached_split_responses(cache_dir, limit=100):
+    """从LLM响应缓存中读取真实的分割结果，作为模糊测试的基础样本"""
+    from segment_parser import parse_segments_xml
+
+    bases = []
+    for content in _cached_response_contents(cache_dir):
+        segments = parse_segments_xml(content) if "<SEGMENT>" in content else []
+        if segments:
+            bases.append([(segment["analysis"], segment["speaker"], segment["content"]) for segment in segments])
+        if len(bases) >= limit:
+            break
+    return bases
+
+def build_segment_fuzz_corpus(samples=300, seed=0, bases=None):
+    """
+    构造分割结果的模糊测试语料
+
+    每个样本由一组片段（真实缓存结果或随机合成）渲染成标准格式后，再施加一种LLM输出中常见的格式错误：
+    内容含"<"或"&"、缺少结束标签、输出被截断、代码块包裹、夹杂说明文字、标签大小写和空格不规范等。
+    每个样本附带应当解析出的(说话人, 内容)列表。
+    """
+    rng = random.Random(seed)
+    bases = bases or []
+
+    def random_segments():
+        return [(
+            rng.choice(["话题转换", "代词变化", "问答交替"]),
+            rng.choice(_FUZZ_SPEAKERS),
+            "，".join(rng.choice(_FUZZ_PHRASES) for _ in range(rng.randint(2, 8)))
+        ) for _ in range(rng.randint(2, 8))]
+
+    def strip_clean(segments):
+        # 去掉内容中的"<"、"&"，作为其他格式错误的基础样本，保证每个样本只有一种错误
+        return [(a, sp, c.replace("<", "").replace("&", "")) for a, sp, c in segments]
+
+    mutations = {
+        "clean": lambda segs: (_render_segments(segs), segs),
+        "stray_chars": lambda segs: (_render_segments(segs), segs),
+        "unclosed_content": lambda segs: (_render_segments(segs).replace("</CONTENT>", "", 1), segs),
+        "missing_segment_close": lambda segs: (_render_segments(segs).replace("</SEGMENT>", "", 1), segs),
+        "truncated": lambda segs: (_render_segments(segs)[:_render_segments(segs).rfind("<CONTENT>") + 12], segs[:-1]),
+        "code_fence": lambda segs: ("```xml\n" + _render_segments(segs) + "```", segs),
+        "chatter": lambda segs: ("好的，以下是分割结果：\n" + _render_segments(segs).replace("</SEGMENT>\n", "</SEGMENT>\n这里是说明。\n")
+                                 + "\n以上。", segs),
+        "tag_style": lambda segs: (_render_segments(segs).replace("<SPEAKER>", "<speaker >").replace("</SPEAKER>", "</ speaker>"), segs),
+        "fullwidth_brackets": lambda segs: (re.sub(r'<(/?[A-Z]+)>', r'＜\1＞', _render_segments(segs)), segs),
+        "markdown_table": lambda segs: ("| 编号 | 说话人 | 内容 |\n|---|---|---|\n"
+                                        + "".join(f"| {i} | {sp} | {c} |\n" for i, (_, sp, c) in enumerate(segs, start=1)), segs),
+    }
+    corpus = []
+    for i in range(samples):
+        name = list(mutations)[i % len(mutations)]
+        segments = rng.choice(bases) if bases and rng.random() < 0.5 else random_segments()
+        if name != "stray_chars":
+            segments = strip_clean(segments)
+        if name == "markdown_table":
+            segments = [(a, sp, c.replace("|", "")) for a, sp, c in segments]
+        text, expected = mutations[name](segments)
+        corpus.append({"mutation": name, "text": text, "expected": [(sp, c.strip()) for _, sp, c in expected]})
+    return corpus
+
+def load_segment_fixture(path=SEGMENT_FIXTURE_PATH):
+    """
+    读取格式错误样本集，返回与build_segment_fuzz_corpus相同结构的语料
+
+    每行一个JSON对象：kind为错误类型，text为模型输出，expected为应解析出的[说话人, 内容]列表。
+    expected为null的样本（如export_malformed_responses导出后尚未标注的）不参与评测。
+    """
+    corpus = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            case = json.loads(line)
+            if case.get("expected") is None:
+                continue
+            corpus.append({"mutation": case["kind"], "text": case["text"],
+                           "expected": [(speaker, content) for speaker, content in case["expected"]]})
+    return corpus
+
+def export_malformed_responses(cache_dir, output_path, limit=50):
+    """
+    从LLM响应缓存中导出严格解析失败的分割结果，追加到样本集文件中供人工标注
+
+    解析不出片段、或有片段缺少说话人或内容的输出视为格式错误；导出的样本expected为null，
+    标注后即可计入load_segment_fixture的评测。
+    """
+    from segment_parser import parse_segments_xml, has_segment_markup
+
+    exported = 0
+    with open(output_path, "a", encoding="utf-8") as f:
+        for content in _cached_response_contents(cache_dir):
+            if exported >= limit:
+                break
+            if not content or not has_segment_markup(content):
+                continue
+            segments = parse_segments_xml(content)
+            if segments and all(segment["speaker"] and segment["content"] for segment in segments):
+                continue
+            f.write(json.dumps({"kind": "cache", "note": "", "text": content, "expected": None}, ensure_ascii=False) + "\n")
+            exported += 1
+    print(f"导出 {exported} 个格式错误的响应到 {output_path}")
+    return exported
+
+def _score_parsers(parsers, corpus, repeat):
+    """在语料上运行各解析器，统计耗时和各类错误的恢复率"""
+    rows = []
+    for name, parser in parsers:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            parsed = [parser(case["text"]) for case in corpus]
+        seconds = (time.perf_counter() - start) / repeat
+
+        recovered = Counter()
+        expected = Counter()
+        for case, segments in zip(corpus, parsed):
+            found = Counter((segment["speaker"], segment["content"]) for segment in segments)
+            wanted = Counter(case["expected"])
+            recovered[case["mutation"]] += sum((found & wanted).values())
+            expected[case["mutation"]] += sum(wanted.values())
+        rows.append({
+            "parser": name,
+            "seconds": seconds,
+            "recovery_rate": sum(recovered.values()) / max(sum(expected.values()), 1),
+            "by_mutation": {mutation: recovered[mutation] / max(expected[mutation], 1) for mutation in expected}
+        })
+
+    print("\n解析器            耗时(ms)   恢复率")
+    for row in rows:
+        print(f"{row['parser']:<14}  {row['seconds'] * 1000:>9.1f}  {row['recovery_rate']:>7.1%}")
+    print("\n各类错误的恢复率:")
+    for mutation in rows[0]["by_mutation"]:
+        print(f"  {mutation:<22}" + "  ".join(f"{row['parser']} {row['by_mutation'][mutation]:.1%}" for row in rows))
+    return rows
+
+def benchmark_segment_parser(samples=300, cache_dir=None, repeat=5, fixture_path=SEGMENT_FIXTURE_PATH):
+    """
+    对比单遍解析器（及本地格式修复）与BeautifulSoup解析器的速度和恢复率
+
+    先在逐条标注的格式错误样本集上评测，再在模糊测试语料上评测。模糊测试语料的变换与本地修复针对的
+    错误类型一一对应，只用来衡量速度和回归，恢复率以样本集上的结果为准。
+    """
+    from segment_parser import parse_segments_xml, parse_segments_with_repair, parse_segments_bs4
+
+    parsers = (
+        ("BeautifulSoup", parse_segments_bs4),
+        ("单遍解析", parse_segments_xml),
+        ("单遍解析+本地修复", lambda text: parse_segments_with_repair(text)[0]),
+    )
+    fixture = load_segment_fixture(fixture_path)
+    print(f"格式错误样本集: {len(fixture)} 个已标注样本（{fixture_path}）")
+    fixture_rows = _score_parsers(parsers, fixture, repeat)
+
+    bases = load_cached_split_responses(cache_dir) if cache_dir else []
+    corpus = build_segment_fuzz_corpus(samples, bases=bases)
+    print(f"\n模糊测试语料: {len(corpus)} 个样本，其中 {len(bases)} 组片段来自响应缓存")
+    return {"fixture": fixture_rows, "fuzz": _score_parsers(parsers, corpus, repeat)}
+
+def benchmark_sentence_split(txt_path_list, repeat=3):
+    """
+    对比原先的分句实现与单遍分句（列表接口和生成器接口）的吞吐量
+
+    同时检查两者得到的句子是否完全一致。
+    """
+    from text2sentence import split_text_into_sentences_legacy, split_text_into_sentences, iter_sentences
+
+    texts = []
+    for txt_path in txt_path_list:
+        with open(txt_path, 'r', encoding='utf-8') as f:
+            asr_text = f.read().strip()
+        if asr_text:
+            texts.append(asr_text)
+    total_chars = sum(len(text) for text in texts)
+    print(f"共 {len(texts)} 个文件，{total_chars} 个字符")
+
+    mismatched = [
+        index for index, text in enumerate(texts)
+        if split_text_into_sentences_legacy(text)[0] != split_text_into_sentences(text)[0]
+    ]
+    if mismatched:
+        print(f"警告: {len(mismatched)} 个文件的分句结果与原先的实现不一致")
+
+    def consume(text):
+        # 只计数不保存句子，模拟流式处理
+        return sum(1 for _ in iter_sentences(text))
+
+    rows = []
+    splitters = (
+        ("原先实现", split_text_into_sentences_legacy),
+        ("单遍分句", split_text_into_sentences),
+        ("生成器", consume),
+    )
+    for name, splitter in splitters:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for text in texts:
+                splitter(text)
+        seconds = (time.perf_counter() - start) / repeat
+        rows.append({"splitter": name, "seconds": seconds,
+                     "chars_per_second": total_chars / seconds if seconds else 0.0})
+
+    print("\n分句方式      耗时(s)     字符/秒")
+    for row in rows:
+        print(f"{row['splitter']:<8}  {row['seconds']:>9.3f}  {row['chars_per_second']:>12.0f}")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ASR文本预处理性能基准")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    inline_parser = subparsers.add_parser("inline-summary", help="对比两次调用与合并摘要的分割流程")
+    inline_parser.add_argument("--input", required=True, help="ASR文本所在目录")
+    inline_parser.add_argument("--output", required=True, help="输出目录")
+    inline_parser.add_argument("--limit", type=int, default=3, help="参与测试的文件数")
+
+    token_parser = subparsers.add_parser("token-count", help="对比逐句、批量和缓存三种token计数方式")
+    token_parser.add_argument("--input", required=True, help="ASR文本所在目录")
+    token_parser.add_argument("--model", default="/data4/liangyaozhen/model/Qwen2-7B-Instruct", help="tokenizer所在的模型路径")
+    token_parser.add_argument("--limit", type=int, default=20, help="参与测试的文件数")
+
+    parser_parser = subparsers.add_parser("segment-parser", help="对比分割结果解析器的速度和容错能力")
+    parser_parser.add_argument("--samples", type=int, default=300, help="模糊测试样本数")
+    parser_parser.add_argument("--cache-dir", help="LLM响应缓存目录，从中读取真实分割结果作为基础样本")
+    parser_parser.add_argument("--fixture", default=str(SEGMENT_FIXTURE_PATH), help="已标注的格式错误样本集")
+
+    export_parser = subparsers.add_parser("export-malformed", help="从响应缓存中导出格式错误的分割结果，供标注后加入样本集")
+    export_parser.add_argument("--cache-dir", required=True, help="LLM响应缓存目录")
+    export_parser.add_argument("--output", default=str(SEGMENT_FIXTURE_PATH), help="追加写入的样本集文件")
+    export_parser.add_argument("--limit", type=int, default=50, help="最多导出的样本数")
+
+    split_parser = subparsers.add_parser("sentence-split", help="对比原先的分句实现与单遍分句的吞吐量")
+    split_parser.add_argument("--input", required=True, help="ASR文本所在目录")
+    split_parser.add_argument("--limit", type=int, default=20, help="参与测试的文件数")
+
+    args = parser.parse_args()
+    if args.command == "inline-summary":
+        benchmark_inline_summary(get_all_txt_files(args.input)[:args.limit], args.output)
+    elif args.command == "token-count":
+        benchmark_token_counting(get_all_txt_files(args.input)[:args.limit], args.model)
+    elif args.command == "segment-parser":
+        benchmark_segment_parser(args.samples, args.cache_dir, fixture_path=args.fixture)
+    elif args.command == "export-malformed":
+        export_malformed_responses(args.cache_dir, args.output, args.limit)
+    elif args.command == "sentence-split":
+        benchmark_sentence_split(get_all_txt_files(args.input)[:args.limit])
@@ -0,0 +1,104 @@
+from collections import Counter
+from typing import List, Dict, Any, Optional, Tuple
+
+from alignment import align_segments
+
+# 置信度低于该值的片段标记为低置信度
+LOW_CONFIDENCE_THRESHOLD = 0.5
+
+def _align_candidate(source: str, segments: List[Dict[str, str]]) -> List[Tuple[int, int, Dict[str, str]]]:
+    """把一个候选的片段对齐到原文，返回[(start, end, 片段)]，丢弃无法对齐的片段"""
+    spans, _ = align_segments(source, [segment["content"] for segment in segments])
+    return [(span[0], span[1], segment) for segment, span in zip(segments, spans) if span]
+
+def vote_boundaries(candidate_boundaries: List[List[int]], tolerance: int = 8) -> List[int]:
+    """
+    对各候选的说话人边界投票
+
+    相距不超过tolerance个字符的边界视为同一个边界，得到过半候选支持的边界被保留，
+    位置取这一组中出现次数最多的偏移（相同时取靠前的）。
+    """
+    points = sorted((offset, index) for index, boundaries in enumerate(candidate_boundaries) for offset in boundaries)
+    majority = len(candidate_boundaries) // 2 + 1
+    accepted = []
+    group = []
+
+    def close_group():
+        if len({index for _, index in group}) >= majority:
+            counts = Counter(offset for offset, _ in group)
+            accepted.append(min(counts, key=lambda offset: (-counts[offset], offset)))
+
+    for offset, index in points:
+        if group and offset - group[0][0] > tolerance:
+            close_group()
+            group = []
+        group.append((offset, index))
+    if group:
+        close_group()
+    return accepted
+
+def _overlapping_segment(items: List[Tuple[int, int, Dict[str, str]]], start: int, end: int) -> Optional[Dict[str, str]]:
+    """返回与[start, end)重叠最多的片段"""
+    best, best_overlap = None, 0
+    for item_start, item_end, segment in items:
+        overlap = min(end, item_end) - max(start, item_start)
+        if overlap > best_overlap:
+            best, best_overlap = segment, overlap
+    return best
+
+def merge_candidate_segments(source: str, candidates: List[List[Dict[str, str]]],
+                             tolerance: int = 8) -> List[Dict[str, Any]]:
+    """
+    把同一批次的多个候选分割结果合并成一个
+
+    各候选的片段先对齐到原文，说话人边界按原文偏移投票，边界之间的文本作为合并后的片段内容；
+    每个片段的说话人取各候选中与其重叠最多的片段的说话人的多数票，票数相同时取靠前的候选的说话人。
+    confidence为边界和说话人都与合并结果一致的候选在可以对齐的候选中所占的比例（无法对齐的候选不参与投票，
+    也不计入分母）；confidence低于LOW_CONFIDENCE_THRESHOLD或说话人票数相同时low_confidence为True。
+
+    Args:
+        source: 批次原文
+        candidates: 各候选解析出的片段列表
+        tolerance: 视为同一边界的最大偏移差（字符数）
+    Returns:
+        合并后的片段，字段与parse_segments_xml一致，另加confidence和low_confidence
+    """
+    aligned = [items for items in (_align_candidate(source, segments) for segments in candidates) if items]
+    if not aligned:
+        return []
+    candidate_boundaries = [[start for start, _, _ in items[1:]] for items in aligned]
+    boundaries = vote_boundaries(candidate_boundaries, tolerance)
+    edges = [0] + boundaries + [len(source)]
+
+    def has_boundary(index, offset):
+        if offset in (0, len(source)):
+            return True
+        return any(abs(boundary - offset) <= tolerance for boundary in candidate_boundaries[index])
+
+    merged = []
+    for start, end in zip(edges, edges[1:]):
+        content = source[start:end].strip()
+        if not content:
+            continue
+        votes = [_overlapping_segment(items, start, end) for items in aligned]
+        speakers = Counter(segment["speaker"] for segment in votes if segment)
+        if not speakers:
+            continue
+        ranked = speakers.most_common(2)
+        speaker = ranked[0][0]
+        tied = len(ranked) > 1 and ranked[0][1] == ranked[1][1]
+        agreeing = [
+            index for index, segment in enumerate(votes)
+            if segment and segment["speaker"] == speaker and has_boundary(index, start) and has_boundary(index, end)
+        ]
+        source_segment = votes[agreeing[0]] if agreeing else next(segment for segment in votes if segment and segment["speaker"] == speaker)
+        confidence = round(len(agreeing) / len(aligned), 3)
+        merged.append({
+            "id": str(len(merged) + 1),
+            "analysis": source_segment.get("analysis", ""),
+            "speaker": speaker,
+            "content": content,
+            "confidence": confidence,
+            "low_confidence": tied or confidence < LOW_CONFIDENCE_THRESHOLD
+        })
+    return merged
@@ -7,7 +7,11 @@ from datetime import datetime
 from openai import OpenAI
 
 from prompts import TEXT2SPEAKER_SPLIT_RULE_SYS,TEXT2SPEAKER_SPLIT_RULE_USER,AGGREGATE_RULES_SYS,AGGREGATE_RULES_USER
-from utils import call_llm
+from utils import call_llm, get_cache_stats, get_telemetry_records, summarize_telemetry, print_telemetry_report, reset_telemetry, close_clients
+from transcript_reader import sample_text_window
+
+# 总结分割规则时每个文件最多送入的token数，超长文件只取其中一段连续的完整句子
+RULE_SAMPLE_MAX_TOKENS = 8000
 
 def extract_rules_from_response(response_text):
     """从LLM响应中提取分割规则"""
@@ -28,8 +32,42 @@ def extract_rules_from_response(response_text):
     # 如果仍然找不到，返回整个响应
     return "未能提取到明确的规则，原始响应：\n" + response_text
 
-def process_folder(folder_path, output_path, samples_per_folder=5):
-    """处理指定文件夹中的txt文件"""
+def build_rule_extraction_messages(asr_text):
+    """构建从ASR文本中总结分割规则的消息"""
+    user_prompt = TEXT2SPEAKER_SPLIT_RULE_USER.replace("{{asr_text}}", asr_text)
+    return [
+        {"role": "system", "content": TEXT2SPEAKER_SPLIT_RULE_SYS},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def save_rule_result(file_path, folder_name, llm_response, output_path):
+    """从LLM响应中提取规则，并保存为rules_{文件夹名}_{文件名}.json"""
+    file_path = Path(file_path)
+    
+    # 提取规则
+    rules = extract_rules_from_response(llm_response)
+    
+    # 保存结果
+    result = {
+        "file_name": file_path.name,
+        "file_path": str(file_path),
+        "timestamp": datetime.now().isoformat(),
+        "rules": rules,
+        "full_response": llm_response
+    }
+    
+    # 生成唯一的输出文件名
+    output_file = Path(output_path) / f"rules_{folder_name}_{file_path.stem}.json"
+    
+    # 保存结果到文件
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    
+    print(f"已保存规则到: {output_file}")
+    return result
+
+def process_folder(folder_path, output_path, samples_per_folder=5, max_sample_tokens=RULE_SAMPLE_MAX_TOKENS):
+    """处理指定文件夹中的txt文件，每个文件最多取max_sample_tokens个token的文本窗口"""
     folder_path = Path(folder_path)
     output_path = Path(output_path)
     
@@ -53,46 +91,22 @@ def process_folder(folder_path, output_path, samples_per_folder=5):
         print(f"处理文件: {file_path}")
         
         try:
-            # 读取文件内容
-            with open(file_path, 'r', encoding='utf-8') as f:
-                asr_text = f.read()
+            # 读取文件内容，超长文件只映射并解码一个窗口
+            asr_text = sample_text_window(str(file_path), max_sample_tokens)
             
             # 构建消息
-            user_prompt = TEXT2SPEAKER_SPLIT_RULE_USER.replace("{{asr_text}}", asr_text)
-            messages = [
-                {"role": "system", "content": TEXT2SPEAKER_SPLIT_RULE_SYS},
-                {"role": "user", "content": user_prompt}
-            ]
+            messages = build_rule_extraction_messages(asr_text)
             
             # 调用LLM
-            response = call_llm(messages)
+            response = call_llm(messages, purpose="rule_extraction")
             
             if response and response.choices:
                 # 提取响应内容
                 llm_response = response.choices[0].message.content
                 
-                # 提取规则
-                rules = extract_rules_from_response(llm_response)
-                
-                # 保存结果
-                result = {
-                    "file_name": file_path.name,
-                    "file_path": str(file_path),
-                    "timestamp": datetime.now().isoformat(),
-                    "rules": rules,
-                    "full_response": llm_response
-                }
-                
+                # 提取并保存规则
+                result = save_rule_result(file_path, folder_path.name, llm_response, output_path)
                 results.append(result)
-                
-                # 生成唯一的输出文件名
-                output_file = output_path / f"rules_{folder_path.name}_{file_path.stem}.json"
-                
-                # 保存结果到文件
-                with open(output_file, 'w', encoding='utf-8') as f:
-                    json.dump(result, f, ensure_ascii=False, indent=2)
-                
-                print(f"已保存规则到: {output_file}")
             
             else:
                 print(f"处理文件失败: {file_path}")
@@ -102,7 +116,7 @@ def process_folder(folder_path, output_path, samples_per_folder=5):
     
     return results
 
-def process_multiple_folders(folder_paths, output_base_path, samples_per_folder=5):
+def process_multiple_folders(folder_paths, output_base_path, samples_per_folder=5, max_sample_tokens=RULE_SAMPLE_MAX_TOKENS):
     """处理多个文件夹"""
     all_results = {}
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -123,7 +137,7 @@ def process_multiple_folders(folder_paths, output_base_path, samples_per_folder=
         folder_output_path.mkdir(parents=True, exist_ok=True)
         
         # 处理文件夹
-        results = process_folder(folder_path, folder_output_path, samples_per_folder)
+        results = process_folder(folder_path, folder_output_path, samples_per_folder, max_sample_tokens)
         
         all_results[folder_name] = results
     
@@ -162,7 +176,7 @@ def aggregate_rules(output_path):
     ]
     
     # 调用LLM
-    response = call_llm(messages)
+    response = call_llm(messages, purpose="aggregation")
     
     if response and response.choices:
         summary = response.choices[0].message.content
@@ -181,6 +195,7 @@ def aggregate_rules(output_path):
 # 主函数
 def main(folder_paths, output_base_path="./speaker_split_results", samples_per_folder=5):
     """主函数"""
+    reset_telemetry()
     # 处理所有文件夹
     # output_path, results = process_multiple_folders(
     #     folder_paths, 
@@ -192,6 +207,10 @@ def main(folder_paths, output_base_path="./speaker_split_results", samples_per_f
     output_path='/data3/liangyaozhen/vvmz/text_v0/speaker_split_rules/speaker_split_rules_20250615_234627'
     final_rules = aggregate_rules(output_path)
     
+    cache_stats = get_cache_stats()
+    print(f"LLM缓存命中: {cache_stats['hits']}，未命中: {cache_stats['misses']}")
+    print_telemetry_report(summarize_telemetry(get_telemetry_records()))
+    close_clients()
     print("\n处理完成!")
     return output_path, final_rules
 
@@ -1,370 +1,1644 @@
 import os
-import json
 import re
-from bs4 import BeautifulSoup
+import json
+import hashlib
 import time
-from prompts import SPEAKER_SPLIT_SYS,SPEAKER_SPLIT_USER,SPEAKER_SPLIT_EXAMPLES,FORMAT_CORRECTION,SPEAKER_SPLIT_FORMAT
-from utils import call_llm, get_all_txt_files
+import threading
+import queue
+import contextvars
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from prompts import SPEAKER_SPLIT_SYS,SPEAKER_SPLIT_USER,SPEAKER_SPLIT_EXAMPLES,FORMAT_CORRECTION,SPEAKER_SPLIT_FORMAT,SPEAKER_SPLIT_FORMAT_REMINDER,SPEAKER_SPLIT_SUMMARY_INSTRUCTION,\
+    SPEAKER_SPLIT_USER_STATIC,SPEAKER_SPLIT_USER_DYNAMIC
+from utils import (
+    call_llm, get_all_txt_files, loadjson, savejson_atomic, content_hash, file_hash, load_config, get_cache_stats, get_endpoint_stats, get_hedge_stats,
+    telemetry_scope, summarize_telemetry, print_telemetry_report, reset_telemetry, close_clients,
+    MESSAGE_OVERHEAD_TOKENS
+)
+from collections import Counter
 from pathlib import Path
 from typing import List, Dict, Any, Tuple
-from transformers import AutoTokenizer
-from text2sentence import split_text_into_sentences
+try:
+    from transformers import AutoTokenizer
+except ImportError:  # transformers不可用时按字符数估算token
+    AutoTokenizer = None
+from text2sentence import split_text_with_spans, iter_sentences_from_chunks
+from transcript_reader import iter_text_chunks
+from asr_normalize import normalize_asr_text
+from token_counter import TokenCounter, estimate_tokens
+from manifest import CorpusManifest
+from segment_parser import parse_segments_xml, parse_segments_with_repair, extract_summary_xml, has_segment_markup
+from alignment import align_segments, find_gaps, count_content_chars, coverage_ratio
+from consensus import merge_candidate_segments
+from adaptive_batching import AdaptiveBatchSizer
+
+# 并发处理多个文件时，用锁保证每行输出完整，并用文件前缀区分输出来源
+_print_lock = threading.Lock()
+_log_context = threading.local()
 
-def parse_segments_xml(text: str) -> List[Dict[str, str]]:
+def set_log_prefix(prefix: str = ""):
+    """设置当前线程的输出前缀"""
+    _log_context.prefix = prefix
+
+def log(message: str):
+    """线程安全的输出，自动加上当前线程的文件前缀"""
+    prefix = getattr(_log_context, "prefix", "")
+    with _print_lock:
+        print(f"{prefix}{message}", flush=True)
+
+class IncrementalSegmentParser:
     """
-    解析XML格式的说话人分割结果
+    流式解析<SEGMENT>片段：每收到一段新输出就解析出新完成的片段并交给on_segment
+    
+    如果输出前probe_chars个字符内既没有解析出片段，也没有出现可以在本地修复的分割标记（小写或全角括号的标签、
+    markdown表格等，见has_segment_markup），判定为格式明显不符，feed返回True以终止输出。
     """
-    try:
-        # 包装所有段落在根元素中
-        wrapped_text = f"<ROOT>{text}</ROOT>"
-        soup = BeautifulSoup(wrapped_text, "xml")
+    
+    def __init__(self, on_segment=None, on_reset=None, probe_chars=600):
+        self.on_segment = on_segment
+        self.on_reset = on_reset
+        self.probe_chars = probe_chars
+        self.text = ""
+        self.pos = 0
+        self.segments = []
+        self.markup_seen = False
+        self.aborted = False
+    
+    def feed(self, delta: str, text: str) -> bool:
+        """传入新文本和目前为止的完整输出，返回True表示应终止输出"""
+        if not text.startswith(self.text):
+            # 调用被重试，输出从头开始，丢弃已解析的片段
+            self.pos = 0
+            self.segments = []
+            self.markup_seen = False
+            if self.on_reset:
+                self.on_reset()
+        self.text = text
         
-        segments = []
-        for segment in soup.find_all("SEGMENT"):
-            try:
-                segment_data = {
-                    "id": segment.find("ID").text.strip() if segment.find("ID") else "",
-                    "analysis": segment.find("ANALYSIS").text.strip() if segment.find("ANALYSIS") else "",
-                    "speaker": segment.find("SPEAKER").text.strip() if segment.find("SPEAKER") else "",
-                    "content": segment.find("CONTENT").text.strip() if segment.find("CONTENT") else ""
-                }
-                segments.append(segment_data)
-            except Exception as e:
-                print(f"解析单个段落时出错: {e}")
-                continue
+        while True:
+            end = text.find("</SEGMENT>", self.pos)
+            if end == -1:
+                break
+            end += len("</SEGMENT>")
+            for segment in parse_segments_xml(text[self.pos:end]):
+                self.segments.append(segment)
+                if self.on_segment:
+                    self.on_segment(segment)
+            self.pos = end
         
-        return segments
-    except Exception as e:
-        print(f"XML解析失败: {e}")
-        return []
+        if not self.segments and not self.markup_seen and len(text) > self.probe_chars:
+            # 只在超过probe_chars时检查一次，出现标记后不再检查
+            self.markup_seen = has_segment_markup(text)
+            self.aborted = not self.markup_seen
+        return self.aborted
+
+class PartialSegmentWriter:
+    """
+    把分割结果逐条追加写入{输出文件名}_speaker_split.jsonl.partial，并在每个批次完成后写入断点
+    
+    每个批次开始时记录文件位置，批次失败或重试时回滚到该位置。批次提交后先fsync结果文件，
+    再原子地写入断点文件(.ckpt)，记录已提交的字节数、下一个片段ID和历史摘要等状态。
+    重新运行时从断点恢复：截断断点之后未提交的内容，从下一个未处理的批次继续。
+    文件全部处理完后重命名为最终结果并删除断点。
+    """
+    
+    def __init__(self, final_path, checkpoint=None):
+        self.final_path = Path(final_path)
+        self.partial_path = self.final_path.with_name(self.final_path.name + ".partial")
+        self.checkpoint_path = self.final_path.with_name(self.final_path.name + ".ckpt")
+        self.batch_id = 0
+        self.next_id = 1
+        if checkpoint is not None:
+            # 从断点恢复，丢弃断点之后写入但未提交的内容
+            self.file = open(self.partial_path, "r+b")
+            self.file.truncate(checkpoint["partial_size"])
+            self.file.seek(checkpoint["partial_size"])
+            self.next_id = checkpoint["next_id"]
+        else:
+            self.file = open(self.partial_path, "wb")
+        self.batch_start = self.file.tell()
+        self.batch_next_id = self.next_id
+    
+    @staticmethod
+    def load_checkpoint(final_path, expected: Dict[str, Any]):
+        """
+        读取断点，只有断点记录的输入和分批参数与expected一致、且结果文件完整时才返回断点
+
+        expected中的source和content_hash为断点所属的输入文件和内容的哈希，缺少这些字段的旧断点不会被使用。
+        """
+        final_path = Path(final_path)
+        checkpoint_path = final_path.with_name(final_path.name + ".ckpt")
+        partial_path = final_path.with_name(final_path.name + ".partial")
+        checkpoint = loadjson(str(checkpoint_path))
+        if not checkpoint or not partial_path.exists():
+            return None
+        if any(checkpoint.get(key) != value for key, value in expected.items()):
+            return None
+        if partial_path.stat().st_size < checkpoint["partial_size"]:
+            return None
+        return checkpoint
+    
+    @property
+    def segments_count(self) -> int:
+        return self.next_id - 1
+    
+    def begin_batch(self, batch_id: int):
+        self.batch_id = batch_id
+        self.batch_start = self.file.tell()
+        self.batch_next_id = self.next_id
     
+    def write(self, segment: Dict[str, Any]):
+        """写入一个片段，按写入顺序分配连续的ID"""
+        segment["id"] = str(self.next_id)
+        segment["batch"] = self.batch_id
+        self.file.write((json.dumps(segment, ensure_ascii=False) + '\n').encode("utf-8"))
+        self.file.flush()
+        self.next_id += 1
+    
+    def reset(self):
+        """丢弃当前批次已写入的片段"""
+        self.file.seek(self.batch_start)
+        self.file.truncate()
+        self.next_id = self.batch_next_id
+    
+    def commit(self, segments: List[Dict[str, Any]]):
+        """用批次的最终结果覆盖流式写入的内容，并持久化到磁盘"""
+        self.reset()
+        for segment in segments:
+            self.write(segment)
+        os.fsync(self.file.fileno())
+    
+    def save_checkpoint(self, state: Dict[str, Any]):
+        """在批次提交后原子地写入断点"""
+        checkpoint = dict(state, partial_size=self.file.tell(), next_id=self.next_id)
+        savejson_atomic(checkpoint, str(self.checkpoint_path))
+    
+    def close(self):
+        """关闭文件，保留.partial文件和断点"""
+        if not self.file.closed:
+            self.file.close()
+    
+    def finalize(self, insertions: List[Tuple[int, List[Dict[str, Any]]]] = None):
+        """
+        关闭文件，有内容时重命名为最终结果文件，否则删除；最后删除断点
+        
+        insertions为[(插入位置, 片段列表)]，插入位置是已提交片段的序号。提供时把这些片段按原来的顺序
+        插入已提交的结果中，重新编号ID后原子地写入最终结果文件。
+        """
+        self.close()
+        if insertions:
+            with open(self.partial_path, 'r', encoding='utf-8') as f:
+                committed = [json.loads(line) for line in f if line.strip()]
+            merged = []
+            position = 0
+            for insert_at, segments in sorted(insertions, key=lambda item: item[0]):
+                merged.extend(committed[position:insert_at])
+                merged.extend(segments)
+                position = max(position, insert_at)
+            merged.extend(committed[position:])
+            for segment_id, segment in enumerate(merged, start=1):
+                segment["id"] = str(segment_id)
+            tmp_path = self.final_path.with_name(self.final_path.name + ".tmp")
+            write_segments_jsonl(merged, tmp_path)
+            os.replace(tmp_path, self.final_path)
+            self.next_id = len(merged) + 1
+            os.remove(self.partial_path)
+        elif self.next_id > 1:
+            os.replace(self.partial_path, self.final_path)
+        else:
+            os.remove(self.partial_path)
+        if self.checkpoint_path.exists():
+            os.remove(self.checkpoint_path)
+
 def count_tokens(text: str, tokenizer) -> int:
     """
     计算文本的token数量
     
     Args:
         text: 要计算的文本
-        tokenizer: 用于分词的tokenizer
+        tokenizer: 用于分词的tokenizer，为None时按字符数估算
         
     Returns:
         token数量
     """
-    tokens = tokenizer.encode(text)
-    return len(tokens)
+    if tokenizer:
+        return len(tokenizer.encode(text))
+    return estimate_tokens(text)
+
+def load_tokenizer(model_path: str):
+    """加载tokenizer，失败时返回None并退回到按字符数估算"""
+    if AutoTokenizer is None:
+        print("未安装transformers，使用默认的token计数方法（按字符数估算）")
+        return None
+    print(f"加载tokenizer: {model_path}")
+    try:
+        return AutoTokenizer.from_pretrained(model_path)
+    except Exception as e:
+        print(f"加载tokenizer失败: {e}")
+        print("使用默认的token计数方法（按字符数估算）")
+        return None
+
+def load_token_counter(model_path: str, use_cache: bool = True) -> TokenCounter:
+    """加载tokenizer并创建句子token计数器，计数结果缓存在LLM响应缓存目录下"""
+    tokenizer = load_tokenizer(model_path)
+    config = load_config()
+    cache_dir = config.get("CACHE_DIR", "./.llm_cache") if use_cache and config.get("CACHE_ENABLED", True) else None
+    return TokenCounter(tokenizer, model_path, cache_dir=cache_dir)
+
+def plan_batches(token_counts: List[int], available_tokens: int) -> List[Tuple[int, int]]:
+    """
+    按token上限把连续的句子打包成批次
+    
+    Args:
+        token_counts: 每个句子的token数
+        available_tokens: 每批可用的token数
+        
+    Returns:
+        批次列表，每个批次为句子下标区间[start, end)
+    """
+    batches = []
+    start = 0
+    current_tokens = 0
+    for i, sentence_tokens in enumerate(token_counts):
+        # 如果加入当前句子会超过限制，先结束当前批次
+        if current_tokens + sentence_tokens > available_tokens and i > start:
+            batches.append((start, i))
+            start = i
+            current_tokens = 0
+        current_tokens += sentence_tokens
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+def next_batch_end(token_counts: List[int], start: int, available_tokens: int) -> int:
+    """从第start个句子开始按token上限打包一个批次，返回批次的结束下标，每批至少包含一个句子"""
+    total = 0
+    for i in range(start, len(token_counts)):
+        if total + token_counts[i] > available_tokens and i > start:
+            return i
+        total += token_counts[i]
+    return len(token_counts)
+
+def plan_balanced_batches(token_counts: List[int], available_tokens: int) -> List[Tuple[int, int]]:
+    """
+    在批次数最少的前提下，让各批次的token数尽量均匀
+
+    先按上限贪心打包得到最少批次数，再二分查找能保持该批次数的最小单批上限，
+    避免最后一批只剩少量句子。
+    """
+    batches = plan_batches(token_counts, available_tokens)
+    if len(batches) <= 1:
+        return batches
+    low = max(max(token_counts), -(-sum(token_counts) // len(batches)))
+    high = available_tokens
+    if low > high:
+        return batches
+    while low < high:
+        middle = (low + high) // 2
+        if len(plan_batches(token_counts, middle)) <= len(batches):
+            high = middle
+        else:
+            low = middle + 1
+    return plan_batches(token_counts, low)
+
+def bisect_batch(token_counts: List[int], start: int, end: int) -> int:
+    """按token数把句子区间[start, end)分成大致相等的两半，返回分割点"""
+    half = sum(token_counts[start:end]) / 2
+    total = 0
+    for i in range(start, end - 1):
+        total += token_counts[i]
+        if total >= half:
+            return i + 1
+    return end - 1
+
+def describe_batch_plan(batch_plan: List[Tuple[int, int]], token_counts: List[int]) -> List[Dict[str, int]]:
+    """把批次规划转换为可保存的数据：每批的句子区间和token数"""
+    return [{"start": start, "end": end, "tokens": sum(token_counts[start:end])} for start, end in batch_plan]
+
+def prepare_file_batches(txt_path: str, token_counter: TokenCounter, available_tokens: int,
+                         balanced: bool = False, normalize_options: Dict[str, Any] = None,
+                         keep_text: bool = True) -> Dict[str, Any]:
+    """
+    读取文件、分割句子、计算token数并规划批次，这一阶段只占用CPU，不调用LLM
+    
+    Args:
+        txt_path: ASR文本文件路径
+        token_counter: 句子token计数器
+        available_tokens: 每批可用的token数
+        balanced: 是否在批次数最少的前提下均匀分批
+        normalize_options: 不为None时先用normalize_asr_text清洗文本（字典为其参数），之后的分句、分批和对齐都基于清洗后的文本
+        keep_text: 是否保留全文，把片段对齐到原文（覆盖检查）时需要。为False且不清洗时按块读取文件、边读边分句，
+            不保存整个文件的文本；清洗或保留全文时整个文件一次读入
+    Returns:
+        包含asr_text、input_hash、sentences、sentence_spans（句子在原文中的区间）、token_counts、batch_plan的字典；
+        按块读取时asr_text为None；清洗时asr_text为清洗后的文本，另外包含raw_text（原文）、offset_map（到原文的偏移映射）
+        和normalization（清洗统计）；文件为空或分割句子失败时只包含error
+    """
+    asr_text = None
+    extra = {}
+    if normalize_options is None and not keep_text:
+        # 句子之外不再保留一份全文；input_hash与一次读入时的content_hash相同
+        digest = hashlib.sha256()
+        
+        def read_chunks():
+            for chunk in iter_text_chunks(txt_path, strip=True):
+                digest.update(chunk.encode("utf-8"))
+                yield chunk
+        
+        sentences = []
+        sentence_spans = []
+        for sentence, start, end in iter_sentences_from_chunks(read_chunks()):
+            sentences.append(sentence)
+            sentence_spans.append((start, end))
+        input_hash = digest.hexdigest()
+        # 非空文本至少分出一个句子
+        if not sentences:
+            return {"error": "文件为空"}
+    else:
+        # 对齐片段、补发未覆盖区间和还原清洗前的原文都要用到全文，整个文件一次读入
+        with open(txt_path, 'r', encoding='utf-8') as f:
+            raw_text = f.read().strip()
+        input_hash = content_hash(raw_text)
+        if normalize_options is None:
+            asr_text = raw_text
+        else:
+            asr_text, offset_map, removed = normalize_asr_text(raw_text, **normalize_options)
+            raw_tokens = token_counter.count(raw_text)
+            clean_tokens = token_counter.count(asr_text)
+            extra = {
+                "raw_text": raw_text,
+                "offset_map": offset_map,
+                "normalization": {
+                    "raw_chars": len(raw_text),
+                    "clean_chars": len(asr_text),
+                    "removed_chars": removed,
+                    "raw_tokens": raw_tokens,
+                    "clean_tokens": clean_tokens,
+                    "tokens_saved": raw_tokens - clean_tokens
+                }
+            }
+        if not asr_text:
+            return {"error": "文件为空"}
+        
+        sentences, sentence_spans = split_text_with_spans(asr_text)
+        if not sentences:
+            return {"error": "分割句子失败"}
+    
+    token_counts = token_counter.count_sentences(sentences)
+    planner = plan_balanced_batches if balanced else plan_batches
+    prepared = {
+        "asr_text": asr_text,
+        "input_hash": input_hash,
+        "sentences": sentences,
+        "sentence_spans": sentence_spans,
+        "token_counts": token_counts,
+        "batch_plan": planner(token_counts, available_tokens)
+    }
+    prepared.update(extra)
+    return prepared
+
+def locate_segments(segments: List[Dict[str, Any]], text: str, span_start: int, span_end: int) -> List[Tuple[int, int]]:
+    """把片段对齐到text[span_start:span_end]，在片段中记录start/end偏移，返回实际匹配上的区间"""
+    spans, matched = align_segments(text[span_start:span_end], [segment["content"] for segment in segments],
+                                    base_offset=span_start)
+    for segment, span in zip(segments, spans):
+        segment["start"], segment["end"] = span if span else (None, None)
+    return matched
+
+def restore_raw_segments(segments: List[Dict[str, Any]], prepared: Dict[str, Any], span_start: int, span_end: int) -> None:
+    """
+    把基于清洗后文本的片段还原到原文：start/end换算为原文偏移，content替换为原文中对应的文本
+
+    没有做覆盖检查的片段先对齐到清洗后的文本；无法对齐的片段保留清洗后的内容。
+    """
+    if any("start" not in segment for segment in segments):
+        locate_segments(segments, prepared["asr_text"], span_start, span_end)
+    offset_map = prepared["offset_map"]
+    raw_text = prepared["raw_text"]
+    for segment in segments:
+        if segment.get("start") is not None:
+            segment["start"], segment["end"] = offset_map.span_to_raw(segment["start"], segment["end"])
+            segment["content"] = raw_text[segment["start"]:segment["end"]].strip()
+
+# 每个批次最多为未覆盖的区间补发的请求数
+MAX_GAP_REQUESTS_PER_BATCH = 3
+
+# 预处理子进程中的token计数器，由进程池的initializer创建
+_worker_token_counter = None
+
+def _init_prepare_worker(model_path: str, use_cache: bool):
+    """预处理子进程的初始化：每个进程加载一次tokenizer"""
+    global _worker_token_counter
+    _worker_token_counter = load_token_counter(model_path, use_cache=use_cache)
+
+def _prepare_in_worker(txt_path: str, available_tokens: int, balanced: bool,
+                       normalize_options: Dict[str, Any] = None, keep_text: bool = True) -> Dict[str, Any]:
+    """在预处理子进程中准备一个文件，并附带本次token计数的统计增量"""
+    before = _worker_token_counter.stats()
+    prepared = prepare_file_batches(txt_path, _worker_token_counter, available_tokens, balanced, normalize_options, keep_text)
+    after = _worker_token_counter.stats()
+    prepared["token_counting"] = {key: after[key] - before[key] for key in ("cache_hits", "cache_misses", "count_seconds")}
+    return prepared
+
+def build_speaker_split_messages(batch_text: str, split_rules: str, history_summary: str,
+                                 inline_summary: bool = False, prefix_cache: bool = False) -> List[Dict[str, str]]:
+    """
+    构建说话人分割请求的消息，inline_summary为True时要求在结果末尾附带<SUMMARY>摘要
+
+    prefix_cache为True时使用前缀缓存布局：同一次运行中不变的部分在前且逐字节相同，
+    历史摘要和ASR文本放在最后，使推理服务可以复用前缀的计算结果。
+    """
+    if prefix_cache:
+        user_prompt = SPEAKER_SPLIT_USER_STATIC.format(
+            split_rules=split_rules,
+            speaker_split_examples=SPEAKER_SPLIT_EXAMPLES
+        )
+        if inline_summary:
+            user_prompt += SPEAKER_SPLIT_SUMMARY_INSTRUCTION
+        user_prompt += SPEAKER_SPLIT_USER_DYNAMIC.format(asr_history=history_summary, asr_raw_text=batch_text)
+        return [
+            {"role": "system", "content": SPEAKER_SPLIT_SYS},
+            {"role": "user", "content": user_prompt}
+        ]
+    user_prompt = SPEAKER_SPLIT_USER.format(
+        split_rules=split_rules,
+        asr_raw_text=batch_text,
+        speaker_split_examples=SPEAKER_SPLIT_EXAMPLES,
+        asr_history=history_summary
+    )
+    if inline_summary:
+        user_prompt += SPEAKER_SPLIT_SUMMARY_INSTRUCTION
+    return [
+        {"role": "system", "content": SPEAKER_SPLIT_SYS},
+        {"role": "user", "content": user_prompt}
+    ]
+
+# 历史摘要要求不超过100字，按200 token预留；合并摘要模式下输出中的<SUMMARY>同样预留
+HISTORY_RESERVE_TOKENS = 200
+SUMMARY_RESERVE_TOKENS = 200
+# 计算上下文占用时额外预留的余量，弥补按字符估算token数的误差
+CONTEXT_SAFETY_MARGIN = 100
+# 没有tokenizer时按字符估算的prompt固定部分再放大的比例
+ESTIMATED_OVERHEAD_MARGIN = 1.25
+
+def measure_prompt_overhead(token_counter: TokenCounter, split_rules: str, inline_summary: bool = False,
+                            prefix_cache: bool = False) -> int:
+    """
+    计算分割请求中除ASR文本和历史摘要以外的固定部分（系统提示、规则、示例等）的token数
+
+    没有tokenizer时字符估算不计模板中大量的XML标签和标点，这些符号按每个1个token补上，
+    总数再乘以ESTIMATED_OVERHEAD_MARGIN，宁可高估也不让批次超出上下文。
+    """
+    messages = build_speaker_split_messages("", split_rules, "", inline_summary, prefix_cache)
+    overhead = sum(token_counter.count(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+    if token_counter.tokenizer is None:
+        symbols = sum(len(re.findall(r'[^\sa-zA-Z\u4e00-\u9fff]', message["content"])) for message in messages)
+        overhead = int((overhead + symbols) * ESTIMATED_OVERHEAD_MARGIN)
+    return overhead
+
+def batch_token_budget(context_length: int, prompt_overhead: int, output_ratio: float,
+                       max_output_tokens: int = None, inline_summary: bool = False,
+                       safety_margin: int = CONTEXT_SAFETY_MARGIN) -> int:
+    """
+    根据模型上下文长度计算每批ASR文本可用的token数
+
+    输入的prompt、历史摘要、批次文本和模型输出共同占用上下文，输出长度按批次文本的output_ratio倍估算。
+
+    Args:
+        context_length: 模型上下文长度
+        prompt_overhead: prompt固定部分的token数，见measure_prompt_overhead
+        output_ratio: 输出token数与批次文本token数之比，分割结果会完整保留原文并加上标签，通常略大于1
+        max_output_tokens: 单次请求允许的最大输出token数，为None时不限制
+        inline_summary: 输出中是否附带<SUMMARY>摘要
+        safety_margin: 额外预留的余量
+    Returns:
+        每批可用的token数
+    """
+    summary_reserve = SUMMARY_RESERVE_TOKENS if inline_summary else 0
+    input_room = context_length - prompt_overhead - HISTORY_RESERVE_TOKENS - summary_reserve - safety_margin
+    budget = int(input_room / (1 + output_ratio))
+    if max_output_tokens:
+        budget = min(budget, int((max_output_tokens - summary_reserve) / output_ratio))
+    if budget <= 0:
+        raise ValueError(f"上下文长度 {context_length} 不足以容纳 {prompt_overhead} tokens 的prompt模板")
+    return budget
+
+def output_token_limit(context_length: int, prompt_tokens: int, max_output_tokens: int = None,
+                       safety_margin: int = CONTEXT_SAFETY_MARGIN) -> int:
+    """
+    计算一次请求的max_tokens，使输入和输出之和不超过模型上下文长度
+
+    max_tokens加上prompt超过上下文长度时，OpenAI兼容的服务（如vLLM）会直接拒绝请求。
+    """
+    room = context_length - prompt_tokens - safety_margin
+    if max_output_tokens:
+        room = min(room, max_output_tokens)
+    return max(room, 1)
+
+def speaker_split_prompt_version(inline_summary: bool = False, prefix_cache: bool = False) -> str:
+    """根据分割所用的prompt模板计算版本号，模板改动后版本号随之变化"""
+    if prefix_cache:
+        templates = [SPEAKER_SPLIT_SYS, SPEAKER_SPLIT_USER_STATIC, SPEAKER_SPLIT_USER_DYNAMIC, SPEAKER_SPLIT_EXAMPLES]
+    else:
+        templates = [SPEAKER_SPLIT_SYS, SPEAKER_SPLIT_USER, SPEAKER_SPLIT_EXAMPLES]
+    if inline_summary:
+        templates.append(SPEAKER_SPLIT_SUMMARY_INSTRUCTION)
+    return content_hash("\n".join(templates))[:12]
+
+def assign_output_stems(txt_path_list: List[str]) -> Dict[str, str]:
+    """
+    为每个输入文件分配输出文件名（不含后缀），返回{输入路径: 文件名}
+
+    get_all_txt_files递归查找文件，不同子目录下可能有同名文件。文件名唯一时沿用文件名；重名的文件改用相对于
+    所有输入的公共目录的路径，各级目录用"__"连接，避免结果、.partial和断点文件互相覆盖。
+    同一文件重复出现或仍无法区分时抛出ValueError。
+    """
+    absolute_paths = [os.path.abspath(txt_path) for txt_path in txt_path_list]
+    repeated = sorted(path for path, count in Counter(absolute_paths).items() if count > 1)
+    if repeated:
+        raise ValueError(f"输入文件重复: {repeated}")
+    stem_counts = Counter(Path(txt_path).stem for txt_path in txt_path_list)
+    root = os.path.commonpath([os.path.dirname(path) for path in absolute_paths]) if absolute_paths else ""
+    stems = {}
+    for txt_path, absolute_path in zip(txt_path_list, absolute_paths):
+        stem = Path(txt_path).stem
+        if stem_counts[stem] > 1:
+            stem = "__".join(Path(os.path.relpath(absolute_path, root)).with_suffix("").parts)
+        stems[txt_path] = stem
+    collisions = sorted(stem for stem, count in Counter(stems.values()).items() if count > 1)
+    if collisions:
+        raise ValueError(f"无法为以下输出文件名区分输入文件: {collisions}")
+    return stems
+
+def write_segments_jsonl(segments: List[Dict[str, Any]], jsonl_output_path) -> None:
+    """把分割结果保存为JSONL格式"""
+    with open(jsonl_output_path, 'w', encoding='utf-8') as f:
+        for segment in segments:
+            f.write(json.dumps(segment, ensure_ascii=False) + '\n')
+
+@dataclass
+class SplitOptions:
+    """说话人分割的设置，各字段的含义见split_speakers的同名参数"""
+    model_path: str = "/data4/liangyaozhen/model/Qwen2-7B-Instruct"
+    split_rules: str = "根据语气变化、话题转换、代词使用等线索进行说话人分割"
+    max_tokens_per_batch: int = 2148
+    max_concurrent_files: int = 1
+    stream: bool = False
+    inline_summary: bool = False
+    use_cache: bool = True
+    context_length: int = None
+    output_ratio: float = 1.3
+    prefix_cache: bool = False
+    pipeline_workers: int = 0
+    pipeline_queue_depth: int = None
+    max_batch_retries: int = 2
+    retry_backoff: float = 2.0
+    check_coverage: bool = False
+    min_gap_chars: int = 20
+    min_gap_ratio: float = 0.05
+    num_candidates: int = 1
+    candidate_mode: str = "parallel"
+    candidate_temperature: float = 0.7
+    boundary_tolerance: int = 8
+    adaptive_batching: bool = False
+    min_batch_tokens: int = None
+    max_batch_tokens: int = None
+    target_batch_latency: float = None
+    normalize_text: bool = False
+    normalize_options: Dict[str, Any] = None
+    manifest_path: str = None
+    force: bool = False
+    only_failed: bool = False
+
+def split_options_hash(run: "SplitRun") -> str:
+    """
+    计算影响分割结果的设置的哈希，计入清单指纹
+
+    包括实际的分批方式（每批token数、计数方式和自适应分批的范围）、覆盖检查、多候选合并和清洗选项；
+    并发数、重试、缓存等只影响速度或可靠性的设置不计入。
+    """
+    options = run.options
+    effective = {
+        "available_tokens": run.available_tokens,
+        "token_counter": run.token_counter.name,
+        "balanced": bool(options.context_length),
+        "check_coverage": options.check_coverage,
+        "normalization": run.normalization_key
+    }
+    if run.batch_sizer is not None:
+        effective["adaptive"] = [run.batch_sizer.min_tokens, run.batch_sizer.max_tokens, options.target_batch_latency]
+    if options.check_coverage:
+        effective["gap"] = [options.min_gap_chars, options.min_gap_ratio]
+    if options.num_candidates > 1:
+        effective["candidates"] = [options.num_candidates, options.candidate_mode, options.candidate_temperature,
+                                   options.boundary_tolerance]
+    return content_hash(json.dumps(effective, sort_keys=True))
+
+class SplitRun:
+    """
+    一次分割运行中各文件共享的状态：token计数器、每批可用的token数、自适应分批、处理清单和候选线程池等
+
+    创建时完成每次运行只需做一次的准备工作，所有文件处理完后调用close释放资源。
+    """
+
+    def __init__(self, options: SplitOptions, txt_path_list: List[str], output_path: Path):
+        self.options = options
+        self.txt_path_list = txt_path_list
+        self.output_path = output_path
+        # 在加载tokenizer和发出请求之前检查输出文件名，重名的输入不会互相覆盖结果
+        self.output_stems = assign_output_stems(txt_path_list)
+
+        # 加载tokenizer，按文件批量计算句子的token数
+        self.token_counter = load_token_counter(options.model_path, use_cache=options.use_cache)
+
+        # 计算每批可用的token数，prompt模板的开销每次运行只计算一次
+        if options.context_length:
+            self.prompt_overhead = measure_prompt_overhead(self.token_counter, options.split_rules, options.inline_summary,
+                                                           options.prefix_cache)
+            self.available_tokens = batch_token_budget(
+                options.context_length, self.prompt_overhead, options.output_ratio,
+                max_output_tokens=load_config().get("MAX_TOKENS"), inline_summary=options.inline_summary
+            )
+            print(f"批次规划: prompt开销 {self.prompt_overhead} tokens，上下文 {options.context_length} tokens，"
+                  f"每批最多 {self.available_tokens} tokens")
+        else:
+            self.prompt_overhead = None
+            self.available_tokens = options.max_tokens_per_batch - 100  # 留一些余量
+
+        # 自适应分批，从按配置算出的每批token数开始，在上下限之间调整
+        self.batch_sizer = None
+        if options.adaptive_batching:
+            upper = options.max_batch_tokens or self.available_tokens
+            if options.context_length:
+                upper = min(upper, self.available_tokens)
+            self.batch_sizer = AdaptiveBatchSizer(self.available_tokens, options.min_batch_tokens or self.available_tokens // 4,
+                                                  upper, target_latency=options.target_batch_latency)
+            print(f"自适应分批: 每批 {self.batch_sizer.min_tokens}-{self.batch_sizer.max_tokens} tokens，"
+                  f"初始 {self.batch_sizer.initial_tokens} tokens")
+
+        # 清洗后送入LLM的文本不同，清洗选项计入指纹和断点
+        if not options.normalize_text:
+            self.normalize_options = None
+        else:
+            self.normalize_options = options.normalize_options if options.normalize_options is not None else {}
+        self.normalization_key = json.dumps(self.normalize_options, sort_keys=True) if self.normalize_options is not None else None
+
+        # 语料处理清单，用于跳过输入没有变化的文件
+        self.manifest = CorpusManifest(options.manifest_path or str(output_path / "corpus_manifest.sqlite"))
+        self.base_fingerprint = {
+            "rules_hash": content_hash(options.split_rules),
+            # 多候选合并的结果与单次分割不同，候选数也计入指纹
+            "prompt_version": speaker_split_prompt_version(options.inline_summary, options.prefix_cache)
+                              + (f"-k{options.num_candidates}" if options.num_candidates > 1 else "")
+                              + (f"-norm{content_hash(self.normalization_key)[:8]}" if self.normalization_key else ""),
+            "model": load_config().get("DEFAULT_MODEL", "deepseek-r1"),
+            "options_hash": split_options_hash(self)
+        }
+        self.file_fingerprints = {}
+
+        # 并发请求候选分割的线程池，每个处理线程的各个候选同时发出
+        self.candidate_executor = None
+        if options.num_candidates > 1:
+            if options.stream:
+                print("多候选模式下不使用流式输出")
+            if options.candidate_mode == "parallel":
+                self.candidate_executor = ThreadPoolExecutor(
+                    max_workers=max(options.max_concurrent_files, 1) * options.num_candidates
+                )
+
+        # 整次运行的LLM调用记录（各文件的记录在文件处理结束后汇入）
+        self.llm_records = []
+
+    def output_file(self, txt_path: str) -> Path:
+        """文件的分割结果路径，.partial和断点文件与其同名"""
+        return self.output_path / f"{self.output_stems[txt_path]}_speaker_split.jsonl"
+
+    def close(self):
+        """关闭处理清单、token计数器和候选线程池"""
+        self.manifest.close()
+        self.token_counter.close()
+        if self.candidate_executor is not None:
+            self.candidate_executor.shutdown()
+
+def format_corrector(response_text: str, format_example: str = SPEAKER_SPLIT_FORMAT, use_cache: bool = True):
+    """尝试修正格式不正确的输出"""
+    try:
+        prompt = FORMAT_CORRECTION.format(format_example, response_text)
+        messages = [
+            {"role":'system','content':'你是有用的助手'},
+            {"role": "user", "content": prompt}
+        ]
+        correction_response = call_llm(messages, use_cache=use_cache, purpose="format_correction")
+        if correction_response:
+            return correction_response.choices[0].message.content
+    except Exception as e:
+        log(f"格式修正失败: {e}")
+    return None
+
+def generate_summary(segments: List[Dict[str, Any]], batch_text: str, use_cache: bool = True) -> str:
+    """生成当前批次的摘要"""
+    try:
+        summary_prompt = f"""
+        请根据以下对话片段，生成一个简短的摘要（不超过100字），概括主要说话人和讨论的话题：
+
+        {batch_text}
+
+        根据分割结果，共有{len(segments)}个说话片段。
+        """
+
+        messages = [
+            {"role": "user", "content": summary_prompt}
+        ]
+
+        summary_response = call_llm(messages, use_cache=use_cache, purpose="summary")
+        if summary_response:
+            return summary_response.choices[0].message.content
+        return "无法生成摘要"
+    except Exception as e:
+        log(f"生成摘要失败: {e}")
+        return "生成摘要过程中发生错误"
+
+def record_format_repair(file_processing_detail: Dict[str, Any], method: str, fixes=()):
+    """记录一次格式修复：method为local（本地修复）或llm（调用LLM修正）"""
+    if file_processing_detail is None:
+        return
+    repairs = file_processing_detail.setdefault("format_repairs", {"local": 0, "llm": 0, "fixes": {}})
+    repairs[method] += 1
+    for fix in fixes:
+        repairs["fixes"][fix] = repairs["fixes"].get(fix, 0) + 1
+
+def request_split(options: SplitOptions, messages, batch_id, writer, max_tokens=None, purpose="split"):
+    """发送分割请求。流式模式下边接收边写入片段，格式明显不符时提前终止并带格式提醒重试一次"""
+    if not options.stream:
+        return call_llm(messages, max_tokens=max_tokens, use_cache=options.use_cache, purpose=purpose)
+
+    for attempt in range(2):
+        # 重试失败批次时没有writer，片段只在请求结束后统一返回
+        parser = IncrementalSegmentParser(on_segment=writer.write if writer else None,
+                                          on_reset=writer.reset if writer else None)
+        response = call_llm(messages, max_tokens=max_tokens, use_cache=options.use_cache, purpose=purpose, stream=True,
+                            on_delta=parser.feed)
+        if response is not None or not parser.aborted:
+            return response
+        if writer:
+            writer.reset()
+        log(f"批次 {batch_id} 输出格式不符，已提前终止")
+        if attempt == 0:
+            messages = messages[:-1] + [dict(messages[-1], content=messages[-1]["content"] + SPEAKER_SPLIT_FORMAT_REMINDER)]
+    return None
+
+def request_candidate(options: SplitOptions, messages, max_tokens, purpose, seed):
+    """请求一个候选分割，不同的seed使各候选的请求和缓存键互不相同"""
+    response = call_llm(messages, temperature=options.candidate_temperature, max_tokens=max_tokens,
+                        use_cache=options.use_cache, purpose=purpose, seed=seed)
+    return response.choices[0].message.content if response and response.choices else None
+
+def request_candidates(run: SplitRun, messages, batch_id, max_tokens=None, purpose="split") -> List[str]:
+    """请求num_candidates个候选分割，返回各候选的输出文本"""
+    options = run.options
+    if options.candidate_mode == "n":
+        response = call_llm(messages, temperature=options.candidate_temperature, max_tokens=max_tokens,
+                            use_cache=options.use_cache, purpose=purpose, n=options.num_candidates)
+        texts = [choice.message.content for choice in response.choices if choice.message.content] if response else []
+        if len(texts) >= options.num_candidates or not response:
+            return texts
+        # 服务不支持n时只返回一个候选，其余的单独请求
+        log(f"批次 {batch_id} 只返回了 {len(texts)} 个候选，补发 {options.num_candidates - len(texts)} 个请求")
+        seeds = range(len(texts), options.num_candidates)
+    else:
+        texts = []
+        seeds = range(options.num_candidates)
+
+    if run.candidate_executor is not None:
+        # 线程池的线程不继承当前上下文，每个候选在当前上下文的副本中请求，调用记录才会计入所在文件的统计
+        futures = [run.candidate_executor.submit(contextvars.copy_context().run, request_candidate,
+                                                 options, messages, max_tokens, purpose, seed) for seed in seeds]
+        results_iter = (future.result() for future in futures)
+    else:
+        results_iter = (request_candidate(options, messages, max_tokens, purpose, seed) for seed in seeds)
+    return texts + [text for text in results_iter if text]
+
+def split_with_candidates(run: SplitRun, messages, batch_text, batch_id, file_processing_detail, max_tokens=None,
+                          purpose="split"):
+    """
+    请求多个候选分割并投票合并
+
+    Returns:
+        (合并后的片段列表，没有可用的候选时为空列表，所有请求都失败时为None; 用于提取摘要和修正格式的输出文本)
+    """
+    texts = request_candidates(run, messages, batch_id, max_tokens, purpose)
+    if not texts:
+        return None, ""
+    candidates = []
+    for text in texts:
+        segments, fixes = parse_segments_with_repair(text)
+        if segments:
+            candidates.append(segments)
+            if fixes:
+                record_format_repair(file_processing_detail, "local", fixes)
+    if not candidates:
+        return [], texts[0]
+    segments = merge_candidate_segments(batch_text, candidates, run.options.boundary_tolerance)
+    # 合并模式下摘要取第一个附带摘要的候选
+    if run.options.inline_summary:
+        response_text = next((text for text in texts if extract_summary_xml(text)), texts[0])
+    else:
+        response_text = texts[0]
+
+    confidences = [segment["confidence"] for segment in segments]
+    log(f"批次 {batch_id} 合并 {len(candidates)}/{len(texts)} 个候选，得到 {len(segments)} 个片段，"
+        f"平均置信度 {sum(confidences) / len(confidences) if confidences else 0:.2f}")
+    if file_processing_detail is not None:
+        consensus = file_processing_detail.setdefault(
+            "consensus", {"batches": 0, "candidates": 0, "segments": 0, "low_confidence_segments": 0, "mean_confidence": 0.0}
+        )
+        total = consensus["mean_confidence"] * consensus["segments"] + sum(confidences)
+        consensus["batches"] += 1
+        consensus["candidates"] += len(candidates)
+        consensus["segments"] += len(segments)
+        consensus["low_confidence_segments"] += sum(1 for segment in segments if segment["low_confidence"])
+        consensus["mean_confidence"] = round(total / consensus["segments"], 4) if consensus["segments"] else 0.0
+    return segments, response_text
+
+def process_batch(run: SplitRun, batch_text, batch_id, history_summary="", writer=None, file_processing_detail=None,
+                  summarize=True, observation=None, purpose="split"):
+    """
+    处理单个批次的文本，summarize为False时不生成新的历史摘要；purpose为分割请求在遥测中的用途，补发未覆盖区间时为gap_split
+
+    提供observation时在其中记录finish_reason和解析结果parse（ok/local_repair/llm_repair/failed），供自适应分批使用。
+
+    Returns:
+        (片段列表，失败时为None, 新的历史摘要)
+    """
+    options = run.options
+    if observation is None:
+        observation = {}
+    observation["parse"] = "failed"
+    batch_tokens = run.token_counter.count(batch_text)
+
+    # 按上下文长度分批时，输出上限取上下文中除去本次prompt后剩余的部分
+    max_tokens = None
+    if options.context_length:
+        prompt_tokens = run.prompt_overhead + batch_tokens + run.token_counter.count(history_summary)
+        max_tokens = output_token_limit(options.context_length, prompt_tokens, load_config().get("MAX_TOKENS"))
+        log(f"处理批次 {batch_id}，约 {batch_tokens} tokens，prompt约 {prompt_tokens} tokens，输出上限 {max_tokens} tokens")
+    else:
+        log(f"处理批次 {batch_id}，约 {batch_tokens} tokens")
+
+    # 构建消息
+    messages = build_speaker_split_messages(batch_text, options.split_rules, history_summary, options.inline_summary,
+                                            options.prefix_cache)
+
+    # 调用LLM
+    try:
+        if options.num_candidates > 1:
+            segments, response_text = split_with_candidates(run, messages, batch_text, batch_id, file_processing_detail,
+                                                            max_tokens, purpose)
+            if segments is None:
+                log(f"批次 {batch_id} LLM调用失败")
+                return None, history_summary
+        else:
+            response = request_split(options, messages, batch_id, writer, max_tokens, purpose)
+
+            if response is None:
+                log(f"批次 {batch_id} LLM调用失败")
+                return None, history_summary
+
+            # 获取响应内容
+            response_text = response.choices[0].message.content
+            observation["finish_reason"] = response.choices[0].finish_reason
+
+            # 解析分割结果，解析不出片段时先在本地修复代码块、全角括号、markdown表格等常见格式问题
+            segments, fixes = parse_segments_with_repair(response_text)
+            if segments and fixes:
+                log(f"批次 {batch_id} 本地修复格式成功（{', '.join(fixes)}），解析出 {len(segments)} 个片段")
+                record_format_repair(file_processing_detail, "local", fixes)
+                observation["parse"] = "local_repair"
+
+        if segments and observation["parse"] == "failed":
+            observation["parse"] = "ok"
+
+        # 本地修复失败时，再调用LLM修正格式
+        if not segments:
+            log(f"批次 {batch_id} 分割结果解析失败，尝试修正格式")
+            record_format_repair(file_processing_detail, "llm")
+            corrected_text = format_corrector(response_text, SPEAKER_SPLIT_EXAMPLES, options.use_cache)
+            if corrected_text:
+                segments = parse_segments_xml(corrected_text)
+                if segments:
+                    observation["parse"] = "llm_repair"
+                    log(f"格式修正成功，成功解析出 {len(segments)} 个片段")
+                else:
+                    log(f"格式修正后仍然解析失败")
+
+        # 生成新的历史摘要，合并模式下优先使用分割结果中附带的摘要
+        new_history_summary = history_summary
+        if segments and summarize:
+            inline_history = extract_summary_xml(response_text) if options.inline_summary else ""
+            if inline_history:
+                new_history_summary = inline_history
+            else:
+                if options.inline_summary:
+                    log(f"批次 {batch_id} 未附带摘要，单独生成摘要")
+                    if file_processing_detail is not None:
+                        file_processing_detail["summary_fallbacks"] = file_processing_detail.get("summary_fallbacks", 0) + 1
+                new_history_summary = generate_summary(segments, batch_text, options.use_cache)
+
+        return segments, new_history_summary
+
+    except Exception as e:
+        log(f"处理批次 {batch_id} 时出错: {e}")
+        return None, history_summary
+
+def verify_coverage(run: SplitRun, segments, span_start, span_end, batch_id, history_summary, asr_text,
+                    file_processing_detail):
+    """
+    把片段对齐到原文，记录每个片段的start/end偏移，并只为未被覆盖的区间补发请求
+
+    补发得到的片段按原文位置插入，返回完整的片段列表。
+    """
+    min_gap_chars = run.options.min_gap_chars
+    source = asr_text[span_start:span_end]
+    matched = locate_segments(segments, asr_text, span_start, span_end)
+    gaps = find_gaps(source, matched, span_start, min_gap_chars)
+    coverage = file_processing_detail.setdefault("coverage", {"chars": 0, "missing_chars": 0, "ratio": 1.0, "gap_requests": 0})
+
+    # 补发的门槛随批次大小增长，漏掉零星几个字时不值得再发一次完整的prompt
+    chars = count_content_chars(source)
+    request_threshold = max(min_gap_chars, int(chars * run.options.min_gap_ratio))
+    requested = [(gap_start, gap_end) for gap_start, gap_end in gaps
+                 if count_content_chars(asr_text[gap_start:gap_end]) >= request_threshold]
+    for gap_start, gap_end in requested[:MAX_GAP_REQUESTS_PER_BATCH]:
+        log(f"批次 {batch_id} 原文 {gap_start}-{gap_end} 未被覆盖，单独请求该区间")
+        coverage["gap_requests"] += 1
+        gap_segments, _ = process_batch(run, asr_text[gap_start:gap_end], batch_id, history_summary, None,
+                                        file_processing_detail, summarize=False, purpose="gap_split")
+        if not gap_segments:
+            continue
+        matched.extend(locate_segments(gap_segments, asr_text, gap_start, gap_end))
+        # 插入到第一个起点不早于该区间的片段前面（空隙可能在某个片段内部）
+        position = next((i for i, segment in enumerate(segments)
+                         if segment["start"] is not None and segment["start"] >= gap_start), len(segments))
+        segments[position:position] = gap_segments
+
+    if requested:
+        gaps = find_gaps(source, matched, span_start, min_gap_chars)
+    # 按有效字符统计覆盖率，忽略空白、标点和过短的空隙
+    missing_chars = sum(count_content_chars(asr_text[gap_start:gap_end]) for gap_start, gap_end in gaps)
+    coverage["chars"] += chars
+    coverage["missing_chars"] += missing_chars
+    coverage["ratio"] = round(1 - coverage["missing_chars"] / coverage["chars"], 4) if coverage["chars"] else 1.0
+    if gaps:
+        log(f"批次 {batch_id} 覆盖率 {coverage_ratio(source, gaps, span_start):.1%}，仍有 {len(gaps)} 个区间未覆盖")
+    return segments
+
+def finish_batch_segments(run: SplitRun, segments, prepared, span_start, span_end, batch_id, history_summary,
+                          file_processing_detail):
+    """对齐并补全批次的片段（启用覆盖检查时），清洗过的片段还原为原文的偏移和内容"""
+    if segments and run.options.check_coverage:
+        segments = verify_coverage(run, segments, span_start, span_end, batch_id, history_summary,
+                                   prepared["asr_text"], file_processing_detail)
+    if segments and "offset_map" in prepared:
+        restore_raw_segments(segments, prepared, span_start, span_end)
+    return segments
+
+def retry_sentence_range(run: SplitRun, failed, prepared, file_processing_detail, start, end, history_summary, depth,
+                         recovered, remaining) -> str:
+    """
+    把句子区间[start, end)二分后分别重试，恢复的片段追加到recovered，最终仍失败的区间追加到remaining
+
+    某一半仍然失败且未超过max_batch_retries轮时继续二分。返回处理后的历史摘要。
+    """
+    options = run.options
+    sentences = prepared["sentences"]
+    sentence_spans = prepared["sentence_spans"]
+    if end - start < 2:
+        pieces = [(start, end)]
+    else:
+        middle = bisect_batch(prepared["token_counts"], start, end)
+        pieces = [(start, middle), (middle, end)]
+    for piece_start, piece_end in pieces:
+        delay = options.retry_backoff * 2 ** (depth - 1)
+        log(f"{delay:.1f} 秒后重试批次 {failed['batch_id']} 的句子 {piece_start}-{piece_end}（第 {depth} 轮）")
+        time.sleep(delay)
+        batch_text = "".join(sentences[piece_start:piece_end])
+        segments, new_history = process_batch(run, batch_text, failed["batch_id"], history_summary, None, file_processing_detail)
+        span_start, span_end = sentence_spans[piece_start][0], sentence_spans[piece_end - 1][1]
+        segments = finish_batch_segments(run, segments, prepared, span_start, span_end, failed["batch_id"], history_summary,
+                                         file_processing_detail)
+        if segments:
+            for segment in segments:
+                segment["batch"] = failed["batch_id"]
+            recovered.extend(segments)
+            history_summary = new_history
+        elif depth < options.max_batch_retries and piece_end - piece_start > 1:
+            history_summary = retry_sentence_range(run, failed, prepared, file_processing_detail, piece_start, piece_end,
+                                                   history_summary, depth + 1, recovered, remaining)
+        else:
+            remaining.append(dict(failed, start=piece_start, end=piece_end))
+    return history_summary
+
+def retry_failed_batch(run: SplitRun, failed, prepared, file_processing_detail):
+    """
+    重试一个失败的批次：每次重试前退避等待，并把批次按token数二分成两半分别处理
+
+    某一半仍然失败时继续二分，最多max_batch_retries轮。后一半使用前一半生成的历史摘要。
+
+    Returns:
+        (恢复的片段列表, 仍然失败的句子区间列表)
+    """
+    recovered = []
+    remaining = []
+    retry_sentence_range(run, failed, prepared, file_processing_detail, failed["start"], failed["end"],
+                         failed["history_summary"], 1, recovered, remaining)
+    return recovered, remaining
+
+def split_checkpoint_key(run: SplitRun, txt_path: str, prepared: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    计算文件的断点键
+
+    断点只在输入、分割规则、prompt和分批方式都不变时有效，保证恢复后的批次边界和各批次的prompt与中断前一致；
+    source和content_hash记录断点所属的输入文件及其内容，其他文件或内容已改变的同一文件不会沿用该断点；
+    prompt_version与清单指纹相同，包含prompt布局、合并摘要、候选数和清洗选项
+    """
+    checkpoint_key = {
+        "source": os.path.abspath(txt_path),
+        "content_hash": prepared["input_hash"],
+        "split_rules_hash": content_hash(run.options.split_rules),
+        "prompt_version": run.base_fingerprint["prompt_version"],
+        "model": run.base_fingerprint["model"],
+        "available_tokens": run.available_tokens,
+        "token_counter": run.token_counter.name
+    }
+    if run.normalization_key:
+        checkpoint_key["normalization"] = run.normalization_key
+    if run.batch_sizer is not None:
+        # 自适应分批的批次边界在处理过程中才确定，可以从任意句子恢复
+        checkpoint_key["planner"] = "adaptive"
+    elif run.options.context_length:
+        checkpoint_key["planner"] = "balanced"
+    return checkpoint_key
+
+def run_file_batch(run: SplitRun, prepared, writer, checkpoint_key, file_processing_detail, start, end, batch_id,
+                   history_summary, observation=None) -> str:
+    """处理文件的一个批次（句子区间[start, end)）、持久化结果并写入断点，返回新的历史摘要"""
+    file_processing_detail["batch_count"] = batch_id
+    sentence_spans = prepared["sentence_spans"]
+
+    # 构建当前批次的文本
+    batch_text = "".join(prepared["sentences"][start:end])
+
+    # 处理当前批次，流式模式下片段在接收过程中就已写入
+    writer.begin_batch(batch_id)
+    previous_history = history_summary
+    segments, history_summary = process_batch(run, batch_text, batch_id, history_summary, writer, file_processing_detail,
+                                              observation=observation)
+
+    # 把片段对齐到原文并补发未覆盖的区间，清洗过的片段还原为原文
+    span_start, span_end = sentence_spans[start][0], sentence_spans[end - 1][1]
+    segments = finish_batch_segments(run, segments, prepared, span_start, span_end, batch_id, previous_history,
+                                     file_processing_detail)
+
+    if segments:
+        # 写入最终结果，writer按顺序分配连续的ID
+        writer.commit(segments)
+        file_processing_detail["segments_count"] = writer.segments_count
+    else:
+        writer.reset()
+        log(f"批次 {batch_id} 处理失败，加入重试队列")
+        # 记录句子区间、使用的历史摘要和在结果中的位置，供文件末尾重试后按原顺序插回
+        file_processing_detail["failed_segments"].append({
+            "batch_id": batch_id,
+            "start": start,
+            "end": end,
+            "insert_at": writer.segments_count,
+            "history_summary": history_summary,
+            "error": "分割结果解析失败"
+        })
+
+    writer.save_checkpoint(dict(
+        checkpoint_key,
+        batch_id=batch_id,
+        next_sentence=end,
+        history_summary=history_summary,
+        failed_segments=file_processing_detail["failed_segments"]
+    ))
+    return history_summary
+
+def run_file_batches(run: SplitRun, prepared, writer, checkpoint_key, file_processing_detail, batch_id, history_summary,
+                     next_sentence) -> int:
+    """从第next_sentence个句子开始逐批处理文件，返回最后一个批次的编号"""
+    batch_sizer = run.batch_sizer
+    token_counts = prepared["token_counts"]
+    if batch_sizer is None:
+        for start, end in prepared["batch_plan"]:
+            if start < next_sentence:
+                continue
+            batch_id += 1
+            history_summary = run_file_batch(run, prepared, writer, checkpoint_key, file_processing_detail, start, end,
+                                             batch_id, history_summary)
+        return batch_id
+
+    # 每批按当前预算打包，处理完成后根据结果调整下一批的预算
+    executed = []
+    start = next_sentence
+    while start < len(token_counts):
+        budget = batch_sizer.budget
+        end = next_batch_end(token_counts, start, budget)
+        batch_id += 1
+        observation = {}
+        batch_start_time = time.perf_counter()
+        history_summary = run_file_batch(run, prepared, writer, checkpoint_key, file_processing_detail, start, end,
+                                         batch_id, history_summary, observation)
+        latency = time.perf_counter() - batch_start_time
+        batch_tokens = sum(token_counts[start:end])
+        adjustment = batch_sizer.observe(batch_tokens, latency, observation)
+        log(f"批次 {batch_id} 预算 {budget} tokens，实际 {batch_tokens} tokens，耗时 {latency:.1f}s，"
+            f"吞吐 {batch_tokens / latency if latency else 0:.0f} tokens/s；{adjustment['reason']}，"
+            f"下一批预算 {adjustment['budget']} tokens")
+        executed.append((start, end))
+        start = end
+    file_processing_detail["batch_plan"] = describe_batch_plan(executed, token_counts)
+    return batch_id
+
+def retry_failed_batches(run: SplitRun, prepared, file_processing_detail) -> List[Tuple[int, List[Dict[str, Any]]]]:
+    """在文件末尾处理重试队列，返回恢复的片段及其在结果中的插入位置"""
+    insertions = []
+    retry_queue = [failed for failed in file_processing_detail["failed_segments"] if "start" in failed]
+    if not retry_queue or run.options.max_batch_retries <= 0:
+        return insertions
+    log(f"重试 {len(retry_queue)} 个失败的批次")
+    remaining = [failed for failed in file_processing_detail["failed_segments"] if "start" not in failed]
+    for failed in retry_queue:
+        recovered, still_failed = retry_failed_batch(run, failed, prepared, file_processing_detail)
+        if recovered:
+            insertions.append((failed["insert_at"], recovered))
+        remaining.extend(still_failed)
+    file_processing_detail["retried_batches"] = len(retry_queue)
+    file_processing_detail["recovered_batches"] = len(retry_queue) - len({failed["batch_id"] for failed in remaining if "start" in failed})
+    file_processing_detail["failed_segments"] = remaining
+    log(f"重试完成: 恢复 {sum(len(segments) for _, segments in insertions)} 个段落，仍有 {len(remaining)} 个区间失败")
+    return insertions
+
+def process_file_content(run: SplitRun, txt_path, file_processing_detail, prepared_future=None):
+    """读取、分批并分割单个文件，处理结果写入file_processing_detail"""
+    try:
+        # 读取文件、分割句子并按token数分批，流水线模式下由预处理进程提前完成
+        if prepared_future is None:
+            prepared = prepare_file_batches(txt_path, run.token_counter, run.available_tokens,
+                                            balanced=bool(run.options.context_length),
+                                            normalize_options=run.normalize_options,
+                                            keep_text=run.options.check_coverage)
+        else:
+            prepared = prepared_future.result()
+            if "token_counting" in prepared:
+                run.token_counter.merge_stats(prepared["token_counting"])
+
+        if "error" in prepared:
+            log(f"文件 {txt_path} {prepared['error']}，跳过处理")
+            file_processing_detail["status"] = "failed"
+            file_processing_detail["error"] = prepared["error"]
+            return
+        sentences = prepared["sentences"]
+        token_counts = prepared["token_counts"]
+        batch_plan = prepared["batch_plan"]
+
+        # 生成输出文件名
+        jsonl_output_path = run.output_file(txt_path)
+
+        file_processing_detail["batch_plan"] = describe_batch_plan(batch_plan, token_counts)
+        if "normalization" in prepared:
+            normalization = prepared["normalization"]
+            file_processing_detail["normalization"] = normalization
+            log(f"文本清洗: 删除 {normalization['raw_chars'] - normalization['clean_chars']} 个字符 {normalization['removed_chars']}，"
+                f"{normalization['raw_tokens']} -> {normalization['clean_tokens']} tokens")
+        log(f"共 {len(sentences)} 个句子，{sum(token_counts)} tokens，计划 {len(batch_plan)} 个批次")
+
+        checkpoint_key = split_checkpoint_key(run, txt_path, prepared)
+        checkpoint = PartialSegmentWriter.load_checkpoint(jsonl_output_path, checkpoint_key)
+        if (checkpoint is not None and run.batch_sizer is None
+                and checkpoint["next_sentence"] not in {start for start, _ in batch_plan} | {len(sentences)}):
+            checkpoint = None
+
+        if checkpoint is not None:
+            batch_id = checkpoint["batch_id"]
+            history_summary = checkpoint["history_summary"]
+            next_sentence = checkpoint["next_sentence"]
+            file_processing_detail["failed_segments"] = checkpoint["failed_segments"]
+            file_processing_detail["resumed_from_batch"] = batch_id
+            log(f"从断点恢复: 已完成 {batch_id} 个批次，{checkpoint['next_id'] - 1} 个段落")
+        else:
+            batch_id = 0
+            # 初始化历史摘要
+            history_summary = "这是音频文本的开头。"
+            next_sentence = 0
+
+        # 逐批处理，结果边处理边写入.partial文件
+        writer = PartialSegmentWriter(jsonl_output_path, checkpoint)
+        file_processing_detail["segments_count"] = writer.segments_count
+        try:
+            batch_id = run_file_batches(run, prepared, writer, checkpoint_key, file_processing_detail, batch_id,
+                                        history_summary, next_sentence)
+        except BaseException:
+            writer.close()
+            raise
+        file_processing_detail["batch_count"] = batch_id
+
+        # 文件末尾处理重试队列，恢复的片段在写入最终结果时按原来的顺序插回并重新编号
+        insertions = retry_failed_batches(run, prepared, file_processing_detail)
+        writer.finalize(insertions)
+        segments_count = writer.segments_count
+        file_processing_detail["segments_count"] = segments_count
+
+        # 保存所有结果
+        if segments_count:
+            # 已按JSONL格式写入
+            log(f"JSONL结果已保存到: {jsonl_output_path}")
+
+            file_processing_detail["status"] = "success"
+
+            log(f"成功处理 {txt_path}，分割出 {segments_count} 个段落，共 {batch_id} 个批次")
+
+            # 检查是否有失败的段落
+            if file_processing_detail["failed_segments"]:
+                file_processing_detail["status"] = "partial_success"
+                log(f"部分批次处理失败: {len(file_processing_detail['failed_segments'])} 个批次")
+        else:
+            log(f"文件 {txt_path} 处理失败，未获取到有效分割结果")
+            file_processing_detail["status"] = "failed"
+            file_processing_detail["error"] = "未获取到有效分割结果"
+
+    except Exception as e:
+        log(f"处理文件 {txt_path} 时出错: {e}")
+        file_processing_detail["status"] = "failed"
+        file_processing_detail["error"] = str(e)
+
+def process_file(run: SplitRun, file_index, txt_path, prepared_future=None) -> Dict[str, Any]:
+    """处理单个文件，返回该文件的处理详情。文件内的批次按顺序串行处理；prepared_future为预处理进程的结果"""
+    file_count = len(run.txt_path_list)
+    set_log_prefix(f"[{file_index+1}/{file_count} {run.output_stems[txt_path]}] " if run.options.max_concurrent_files > 1 else "")
+    log(f"处理第 {file_index+1}/{file_count} 个文件: {txt_path}")
+
+    file_processing_detail = {
+        "file": txt_path,
+        "segments_count": 0,
+        "batch_count": 0,
+        "failed_segments": [],
+        "status": "processing"
+    }
+
+    with telemetry_scope() as llm_records:
+        process_file_content(run, txt_path, file_processing_detail, prepared_future)
+
+    # 更新语料处理清单
+    run.manifest.update(
+        txt_path,
+        run.file_fingerprints[txt_path],
+        file_processing_detail["status"],
+        output_path=str(run.output_file(txt_path)),
+        segments_count=file_processing_detail["segments_count"],
+        error=file_processing_detail.get("error", "")
+    )
+
+    # 记录该文件的LLM调用统计，并汇入整次运行的记录
+    file_processing_detail["llm_usage"] = summarize_telemetry(llm_records)
+    run.llm_records.extend(llm_records)
+    set_log_prefix("")
+    return file_processing_detail
+
+def select_pending_files(run: SplitRun) -> Tuple[List[int], List[Dict[str, Any]]]:
+    """
+    根据清单筛选需要处理的文件
+
+    Returns:
+        (需要处理的文件下标列表, 各文件的处理详情列表，跳过的文件已填入，其余为None)
+    """
+    options = run.options
+    pending_indices = []
+    file_details = [None] * len(run.txt_path_list)
+    for i, txt_path in enumerate(run.txt_path_list):
+        try:
+            fingerprint = dict(run.base_fingerprint, content_hash=file_hash(txt_path))
+        except OSError as e:
+            fingerprint = dict(run.base_fingerprint, content_hash="")
+            log(f"读取文件 {txt_path} 失败: {e}")
+        run.file_fingerprints[txt_path] = fingerprint
+        process, reason = run.manifest.should_process(txt_path, fingerprint, options.force, options.only_failed)
+        if process:
+            pending_indices.append(i)
+        else:
+            file_details[i] = {"file": txt_path, "status": "skipped", "reason": reason}
+    print(f"需要处理 {len(pending_indices)} 个文件，跳过 {len(run.txt_path_list) - len(pending_indices)} 个文件")
+    return pending_indices, file_details
+
+def _produce_prepared(run: SplitRun, prepare_pool, pending_indices, slots, ready, consumers):
+    """按顺序把待处理文件提交给预处理进程池，队列满时等待，最后为每个处理线程放入结束标记"""
+    for i in pending_indices:
+        slots.acquire()
+        future = prepare_pool.submit(_prepare_in_worker, run.txt_path_list[i], run.available_tokens,
+                                     bool(run.options.context_length), run.normalize_options, run.options.check_coverage)
+        ready.put((i, future))
+    for _ in range(consumers):
+        ready.put(None)
+
+def _consume_prepared(run: SplitRun, ready, slots, file_details):
+    """处理线程：取出预处理好的文件并调用LLM，直到遇到结束标记"""
+    while True:
+        item = ready.get()
+        if item is None:
+            return
+        i, future = item
+        try:
+            file_details[i] = process_file(run, i, run.txt_path_list[i], future)
+        finally:
+            slots.release()
+
+def run_pipeline(run: SplitRun, pending_indices, file_details):
+    """
+    预处理进程池提前准备文件，处理线程按顺序取用并调用LLM
+
+    信号量限制已提交但尚未处理完成的文件数，内存占用取决于队列深度而不是语料规模。
+    """
+    options = run.options
+    consumers = max(options.max_concurrent_files, 1)
+    queue_depth = max(options.pipeline_queue_depth or 2 * consumers, consumers)
+    slots = threading.Semaphore(queue_depth)
+    ready = queue.Queue()
+    print(f"预处理流水线: {options.pipeline_workers} 个预处理进程，{consumers} 个处理线程，队列深度 {queue_depth}")
+
+    with ProcessPoolExecutor(max_workers=options.pipeline_workers, initializer=_init_prepare_worker,
+                             initargs=(options.model_path, options.use_cache)) as prepare_pool:
+        producer = threading.Thread(target=_produce_prepared,
+                                    args=(run, prepare_pool, pending_indices, slots, ready, consumers), daemon=True)
+        producer.start()
+        with ThreadPoolExecutor(max_workers=consumers) as executor:
+            workers = [executor.submit(_consume_prepared, run, ready, slots, file_details) for _ in range(consumers)]
+            for worker in workers:
+                worker.result()
+        producer.join()
+
+def summarize_split_results(run: SplitRun, file_details: List[Dict[str, Any]], wall_time: float) -> Dict[str, Any]:
+    """汇总各文件的处理详情，得到整次运行的处理结果统计"""
+    options = run.options
+    results = {
+        "total_files": len(run.txt_path_list),
+        "processed_files": 0,
+        "failed_files": 0,
+        "skipped_files": 0,
+        "failed_file_list": [],
+        "prompt_layout": "prefix_cache" if options.prefix_cache else "interleaved",
+        "batch_planning": {
+            "mode": "context" if options.context_length else "fixed",
+            "prompt_overhead": run.prompt_overhead,
+            "context_length": options.context_length,
+            "output_ratio": options.output_ratio if options.context_length else None,
+            "available_tokens": run.available_tokens,
+            "adaptive": options.adaptive_batching
+        },
+        "processing_details": []
+    }
+    for file_processing_detail in file_details:
+        if file_processing_detail["status"] == "skipped":
+            results["skipped_files"] += 1
+        elif file_processing_detail["status"] in ("success", "partial_success"):
+            results["processed_files"] += 1
+        else:
+            results["failed_files"] += 1
+            results["failed_file_list"].append({
+                "file": file_processing_detail["file"],
+                "error": file_processing_detail.get("error", "")
+            })
+        results["processing_details"].append(file_processing_detail)
+    results["format_repairs"] = {"local_repairs": 0, "llm_corrections": 0, "fixes": {}}
+    for detail in results["processing_details"]:
+        repairs = detail.get("format_repairs")
+        if repairs:
+            results["format_repairs"]["local_repairs"] += repairs["local"]
+            results["format_repairs"]["llm_corrections"] += repairs["llm"]
+            for fix, count in repairs["fixes"].items():
+                results["format_repairs"]["fixes"][fix] = results["format_repairs"]["fixes"].get(fix, 0) + count
+    results["batch_retries"] = {
+        "retried_batches": sum(detail.get("retried_batches", 0) for detail in results["processing_details"]),
+        "recovered_batches": sum(detail.get("recovered_batches", 0) for detail in results["processing_details"])
+    }
+    coverage_chars = sum(detail.get("coverage", {}).get("chars", 0) for detail in results["processing_details"])
+    missing_chars = sum(detail.get("coverage", {}).get("missing_chars", 0) for detail in results["processing_details"])
+    results["coverage"] = {
+        "ratio": round(1 - missing_chars / coverage_chars, 4) if coverage_chars else None,
+        "gap_requests": sum(detail.get("coverage", {}).get("gap_requests", 0) for detail in results["processing_details"])
+    }
+    normalization_details = [detail["normalization"] for detail in results["processing_details"] if detail.get("normalization")]
+    if normalization_details:
+        removed_chars = {}
+        for normalization in normalization_details:
+            for kind, count in normalization["removed_chars"].items():
+                removed_chars[kind] = removed_chars.get(kind, 0) + count
+        results["normalization"] = {
+            "files": len(normalization_details),
+            "removed_chars": removed_chars,
+            "raw_tokens": sum(normalization["raw_tokens"] for normalization in normalization_details),
+            "clean_tokens": sum(normalization["clean_tokens"] for normalization in normalization_details),
+            "tokens_saved": sum(normalization["tokens_saved"] for normalization in normalization_details)
+        }
+    if options.num_candidates > 1:
+        consensus_details = [detail["consensus"] for detail in results["processing_details"] if detail.get("consensus")]
+        segments_total = sum(consensus["segments"] for consensus in consensus_details)
+        results["self_consistency"] = {
+            "candidates": options.num_candidates,
+            "mode": options.candidate_mode,
+            "merged_batches": sum(consensus["batches"] for consensus in consensus_details),
+            "mean_confidence": round(sum(consensus["mean_confidence"] * consensus["segments"] for consensus in consensus_details)
+                                     / segments_total, 4) if segments_total else None,
+            "low_confidence_segments": sum(consensus["low_confidence_segments"] for consensus in consensus_details)
+        }
+    results["batch_planning"]["planned_batches"] = sum(
+        len(detail.get("batch_plan", [])) for detail in results["processing_details"]
+    )
+    if run.batch_sizer is not None:
+        results["batch_planning"]["adaptive_stats"] = run.batch_sizer.stats()
+
+    # 记录整次运行的LLM调用统计和响应缓存的命中情况
+    results["llm_usage"] = summarize_telemetry(run.llm_records, wall_time=wall_time)
+    results["llm_cache"] = get_cache_stats()
+    results["llm_endpoints"] = get_endpoint_stats()
+    results["llm_hedging"] = get_hedge_stats()
+    results["token_counting"] = run.token_counter.stats()
+    return results
+
+def print_split_report(results: Dict[str, Any]):
+    """打印整次运行的处理结果统计"""
+    print(f"\n批量处理完成!")
+    print(f"总文件数: {results['total_files']}")
+    print(f"成功处理: {results['processed_files']}")
+    print(f"处理失败: {results['failed_files']}")
+    print(f"跳过（输入未变化）: {results['skipped_files']}")
+    print(f"LLM缓存命中: {results['llm_cache']['hits']}，未命中: {results['llm_cache']['misses']}")
+    print(f"计划批次数: {results['batch_planning']['planned_batches']}，每批最多 {results['batch_planning']['available_tokens']} tokens")
+    if "adaptive_stats" in results["batch_planning"]:
+        adaptive_stats = results["batch_planning"]["adaptive_stats"]
+        print(f"自适应分批: 预算 {adaptive_stats['initial_tokens']} -> {adaptive_stats['final_tokens']} tokens，"
+              f"增大 {adaptive_stats['increases']} 次，减小 {adaptive_stats['decreases']} 次")
+        for bucket in adaptive_stats["by_size"]:
+            print(f"  {bucket['tokens_range']} tokens: {bucket['batches']} 批，吞吐 {bucket['tokens_per_second']} tokens/s，"
+                  f"失败率 {bucket['failure_rate']:.1%}")
+    if results["coverage"]["ratio"] is not None:
+        gap_usage = results["llm_usage"]["by_purpose"].get("gap_split", {})
+        print(f"原文覆盖率: {results['coverage']['ratio']:.1%}，补发未覆盖区间 {results['coverage']['gap_requests']} 次"
+              f"（{gap_usage.get('calls', 0)} 次LLM调用，{gap_usage.get('total_tokens', 0)} tokens）")
+    if "normalization" in results:
+        normalization = results["normalization"]
+        saved_ratio = normalization["tokens_saved"] / normalization["raw_tokens"] if normalization["raw_tokens"] else 0.0
+        print(f"文本清洗: 送入LLM的文本少 {normalization['tokens_saved']} tokens（{saved_ratio:.1%}），删除字符 {normalization['removed_chars']}")
+    if results.get("self_consistency", {}).get("mean_confidence") is not None:
+        consistency = results["self_consistency"]
+        print(f"多候选合并: 每批 {consistency['candidates']} 个候选，合并 {consistency['merged_batches']} 个批次，"
+              f"平均置信度 {consistency['mean_confidence']:.2f}，低置信度片段 {consistency['low_confidence_segments']} 个")
+    if results["batch_retries"]["retried_batches"]:
+        print(f"失败批次重试: {results['batch_retries']['retried_batches']} 个，"
+              f"完全恢复 {results['batch_retries']['recovered_batches']} 个")
+    if results["format_repairs"]["local_repairs"] or results["format_repairs"]["llm_corrections"]:
+        print(f"格式修复: 本地修复 {results['format_repairs']['local_repairs']} 次（省去同样次数的LLM修正调用），"
+              f"LLM修正 {results['format_repairs']['llm_corrections']} 次")
+    token_counting = results["token_counting"]
+    print(f"token计数: {token_counting['counter']}，耗时 {token_counting['count_seconds']}s，"
+          f"缓存命中 {token_counting['cache_hits']}，未命中 {token_counting['cache_misses']}")
+    print_telemetry_report(results["llm_usage"])
+    if results["llm_hedging"]["fired"]:
+        hedging = results["llm_hedging"]
+        print(f"对冲请求: 触发 {hedging['fired']} 次，对冲获胜 {hedging['hedge_wins']} 次，"
+              f"p99 {hedging['p99_without_hedging']}s -> {hedging['p99_with_hedging']}s")
+    if len(results["llm_endpoints"]) > 1:
+        for endpoint_stats in results["llm_endpoints"]:
+            print(f"  服务 {endpoint_stats['base_url']}: {endpoint_stats['requests']} 次请求，失败 {endpoint_stats['failures']}，"
+                  f"{endpoint_stats['tokens_per_second']} tokens/s")
 
 def split_speakers(
-    txt_path_list: List[str], 
+    txt_path_list: List[str],
     output_dir: str,
     model_path: str = "/data4/liangyaozhen/model/Qwen2-7B-Instruct",
     split_rules: str = "根据语气变化、话题转换、代词使用等线索进行说话人分割",
     max_tokens_per_batch: int = 2148,
+    max_concurrent_files: int = 1,
+    stream: bool = False,
+    inline_summary: bool = False,
+    use_cache: bool = True,
+    context_length: int = None,
+    output_ratio: float = 1.3,
+    prefix_cache: bool = False,
+    pipeline_workers: int = 0,
+    pipeline_queue_depth: int = None,
+    max_batch_retries: int = 2,
+    retry_backoff: float = 2.0,
+    check_coverage: bool = False,
+    min_gap_chars: int = 20,
+    min_gap_ratio: float = 0.05,
+    num_candidates: int = 1,
+    candidate_mode: str = "parallel",
+    candidate_temperature: float = 0.7,
+    boundary_tolerance: int = 8,
+    adaptive_batching: bool = False,
+    min_batch_tokens: int = None,
+    max_batch_tokens: int = None,
+    target_batch_latency: float = None,
+    normalize_text: bool = False,
+    normalize_options: Dict[str, Any] = None,
+    manifest_path: str = None,
+    force: bool = False,
+    only_failed: bool = False,
 ) -> Dict[str, Any]:
     """
     批量处理ASR文本的说话人分割，基于token数量限制分批处理
     
     Args:
         txt_path_list: ASR文本文件路径列表
-        output_dir: 输出目录
+        output_dir: 输出目录，每个文件的结果保存为{输出文件名}_speaker_split.jsonl，输出文件名见assign_output_stems
         model_path: 模型路径，用于加载tokenizer
         split_rules: 说话人分割规则
-        max_tokens_per_batch: 每批最大token数    
+        max_tokens_per_batch: 每批最大token数
+        max_concurrent_files: 同时处理的文件数，大于1时使用线程池并发处理多个文件
+        stream: 是否以流式接收分割结果，边接收边解析和写入，输出格式明显不符时提前终止并重试
+        inline_summary: 是否让分割请求同时输出<SUMMARY>摘要，省去单独的摘要调用；摘要缺失时再单独生成
+        use_cache: 是否使用LLM响应缓存，关闭后所有请求都会实际发送
+        context_length: 模型上下文长度。设置后根据实际的prompt开销、上下文长度和输出比例计算每批的token数，
+            并在批次数最少的前提下均匀分批，此时忽略max_tokens_per_batch；为None时沿用max_tokens_per_batch
+        output_ratio: 输出token数与批次文本token数之比的估计值，仅在设置context_length时使用
+        prefix_cache: 是否使用前缀缓存布局，把整次运行不变的prompt部分放在最前面，每批变化的内容放在最后
+        pipeline_workers: 预处理进程数。大于0时由进程池提前读取、分句、计算token数并规划批次，
+            处理LLM调用的线程直接取用准备好的文件；为0时在处理线程中顺序完成预处理
+        pipeline_queue_depth: 已提交预处理但尚未处理完成的文件数上限，限制内存占用，默认为并发文件数的2倍
+        max_batch_retries: 失败批次的最大重试轮数。失败的批次在文件末尾重试，每轮把批次二分后分别处理，为0时不重试
+        retry_backoff: 重试前的等待秒数，每轮翻倍
+        check_coverage: 是否把分割结果对齐到原文，在输出中记录每个片段的start/end字符偏移，并为未覆盖的区间补发请求。
+            默认关闭，开启后补发的请求会增加LLM调用
+        min_gap_chars: 未覆盖区间的有效字符数达到该值时才计入未覆盖并考虑补发请求
+        min_gap_ratio: 未覆盖区间的有效字符数还要达到批次有效字符数的这一比例才补发请求，每次补发都要重新发送完整的prompt
+        num_candidates: 每个批次请求的候选分割数，大于1时按原文偏移对说话人边界投票合并，并为每个片段给出confidence
+        candidate_mode: 候选的请求方式，parallel为并发发出多个请求，n为在一次请求中设置n（需要服务支持）
+        candidate_temperature: 请求候选时使用的温度，为0时各候选通常完全相同
+        boundary_tolerance: 投票时视为同一说话人边界的最大偏移差（字符数）
+        adaptive_batching: 是否根据每批的延迟、输出截断和解析结果在线调整批次的token预算，启用后不再预先规划批次
+        min_batch_tokens: 自适应分批的预算下限，默认为每批可用token数的1/4
+        max_batch_tokens: 自适应分批的预算上限，默认为每批可用token数；设置了context_length时不会超过按上下文算出的上限
+        target_batch_latency: 自适应分批的单批目标耗时（秒），超过时减小预算，默认不按延迟调整
+        normalize_text: 是否在送入LLM前清洗表情标记、口吃重复和重复标点，输出中的content和start/end仍然对应原文
+        normalize_options: 传给normalize_asr_text的清洗选项，默认全部启用
+        manifest_path: 语料处理清单路径，默认为output_dir/corpus_manifest.sqlite。
+            输入内容、分割规则、prompt模板和模型都没有变化且已处理完成的文件会被跳过
+        force: 忽略清单，重新处理所有文件
+        only_failed: 只重新处理清单中记录为失败或部分成功的文件
     Returns:
         处理结果统计
     """
+    options = SplitOptions(
+        model_path=model_path, split_rules=split_rules, max_tokens_per_batch=max_tokens_per_batch,
+        max_concurrent_files=max_concurrent_files, stream=stream, inline_summary=inline_summary, use_cache=use_cache,
+        context_length=context_length, output_ratio=output_ratio, prefix_cache=prefix_cache,
+        pipeline_workers=pipeline_workers, pipeline_queue_depth=pipeline_queue_depth,
+        max_batch_retries=max_batch_retries, retry_backoff=retry_backoff, check_coverage=check_coverage,
+        min_gap_chars=min_gap_chars, min_gap_ratio=min_gap_ratio, num_candidates=num_candidates,
+        candidate_mode=candidate_mode, candidate_temperature=candidate_temperature, boundary_tolerance=boundary_tolerance,
+        adaptive_batching=adaptive_batching, min_batch_tokens=min_batch_tokens, max_batch_tokens=max_batch_tokens,
+        target_batch_latency=target_batch_latency, normalize_text=normalize_text, normalize_options=normalize_options,
+        manifest_path=manifest_path, force=force, only_failed=only_failed
+    )
     
     # 创建输出目录
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
     
-    # 加载tokenizer
-    print(f"加载tokenizer: {model_path}")
-    try:
-        tokenizer = AutoTokenizer.from_pretrained(model_path)
-    except Exception as e:
-        print(f"加载tokenizer失败: {e}")
-        print("使用默认的token计数方法（按字符数估算）")
-        tokenizer = None
-    
-    # 处理结果统计
-    results = {
-        "total_files": len(txt_path_list),
-        "processed_files": 0,
-        "failed_files": 0,
-        "failed_file_list": [],
-        "processing_details": []
-    }
-    
-    def estimate_tokens(text):
-        """估算token数量，当tokenizer不可用时使用"""
-        # 中文字符大约是1个token，英文单词大约是1.3个token
-        chinese_chars = len(re.findall(r'[\u4e00-\u9fff]', text))
-        english_words = len(re.findall(r'[a-zA-Z]+', text))
-        return chinese_chars + int(english_words * 1.3)
-    
-    def count_tokens(text, tokenizer):
-        """计算文本的token数量"""
-        if tokenizer:
-            return len(tokenizer.encode(text))
-        else:
-            return estimate_tokens(text)
+    # 每次运行的调用统计单独汇总，清空进程级记录，避免长时间运行的进程中记录不断累积
+    reset_telemetry()
     
-    def format_corrector(response_text, format_example=SPEAKER_SPLIT_FORMAT):
-        """尝试修正格式不正确的输出"""
-        try:
-            prompt = FORMAT_CORRECTION.format(format_example, response_text)
-            messages = [
-                {"role":'system','content':'你是有用的助手'},
-                {"role": "user", "content": prompt}
-            ]
-            correction_response = call_llm(messages)
-            if correction_response:
-                return correction_response.choices[0].message.content
-        except Exception as e:
-            print(f"格式修正失败: {e}")
-        return None
+    run = SplitRun(options, txt_path_list, output_path)
+    run_start_time = time.perf_counter()
+    pending_indices, file_details = select_pending_files(run)
     
-    def generate_summary(segments, batch_text):
-        """生成当前批次的摘要"""
-        try:
-            summary_prompt = f"""
-            请根据以下对话片段，生成一个简短的摘要（不超过100字），概括主要说话人和讨论的话题：
-            
-            {batch_text}
-            
-            根据分割结果，共有{len(segments)}个说话片段。
-            """
-            
-            messages = [
-                {"role": "user", "content": summary_prompt}
-            ]
-            
-            summary_response = call_llm(messages)
-            if summary_response:
-                return summary_response.choices[0].message.content
-            return "无法生成摘要"
-        except Exception as e:
-            print(f"生成摘要失败: {e}")
-            return "生成摘要过程中发生错误"
+    # 文件之间相互独立，可以并发处理；同一文件内的批次依赖上一批次的摘要，必须串行
+    if pipeline_workers > 0 and pending_indices:
+        run_pipeline(run, pending_indices, file_details)
+    elif max_concurrent_files > 1 and len(pending_indices) > 1:
+        print(f"并发处理文件，最大并发数: {max_concurrent_files}")
+        with ThreadPoolExecutor(max_workers=max_concurrent_files) as executor:
+            # executor.map按输入顺序返回结果，保证processing_details与txt_path_list顺序一致
+            processed = executor.map(process_file, [run] * len(pending_indices), pending_indices,
+                                     [txt_path_list[i] for i in pending_indices])
+            for i, file_processing_detail in zip(pending_indices, processed):
+                file_details[i] = file_processing_detail
+    else:
+        for i in pending_indices:
+            file_details[i] = process_file(run, i, txt_path_list[i])
+    run.close()
+    # 所有请求都已完成，释放连接池
+    close_clients()
     
-    def process_batch(batch_text, batch_id, history_summary=""):
-        """处理单个批次的文本"""
-        print(f"处理批次 {batch_id}，约 {count_tokens(batch_text, tokenizer)} tokens")
-        
-        # 构建消息
-        user_prompt = SPEAKER_SPLIT_USER.format(
-            split_rules=split_rules,
-            asr_raw_text=batch_text,
-            speaker_split_examples=SPEAKER_SPLIT_EXAMPLES,
-            asr_history=history_summary
-        )
-        
-        messages = [
-            {"role": "system", "content": SPEAKER_SPLIT_SYS},
-            {"role": "user", "content": user_prompt}
-        ]
-        
-        # 调用LLM
-        try:
-            response = call_llm(messages)
-            
-            if response is None:
-                print(f"批次 {batch_id} LLM调用失败")
-                return None, history_summary
-            
-            # 获取响应内容
-            response_text = response.choices[0].message.content
-            
-            # 解析分割结果
-            segments = parse_segments_xml(response_text)
-            
-            # 如果解析失败，尝试修正格式
-            if not segments:
-                print(f"批次 {batch_id} 分割结果解析失败，尝试修正格式")
-                corrected_text = format_corrector(response_text, SPEAKER_SPLIT_EXAMPLES)
-                if corrected_text:
-                    segments = parse_segments_xml(corrected_text)
-                    if segments:
-                        print(f"格式修正成功，成功解析出 {len(segments)} 个片段")
-                    else:
-                        print(f"格式修正后仍然解析失败")
-            
-            # 生成新的历史摘要
-            new_history_summary = history_summary
-            if segments:
-                new_history_summary = generate_summary(segments, batch_text)
-            
-            return segments, new_history_summary
-        
-        except Exception as e:
-            print(f"处理批次 {batch_id} 时出错: {e}")
-            return None, history_summary
-    
-    for i, txt_path in enumerate(txt_path_list):
-        print(f"处理第 {i+1}/{len(txt_path_list)} 个文件: {txt_path}")
-        
-        file_processing_detail = {
-            "file": txt_path,
-            "segments_count": 0,
-            "batch_count": 0,
-            "failed_segments": [],
-            "status": "processing"
-        }
-        
-        try:
-            # 读取ASR文本
-            with open(txt_path, 'r', encoding='utf-8') as f:
-                asr_text = f.read().strip()
-            
-            if not asr_text:
-                print(f"文件 {txt_path} 为空，跳过处理")
-                results["failed_files"] += 1
-                results["failed_file_list"].append({"file": txt_path, "error": "文件为空"})
-                file_processing_detail["status"] = "failed"
-                file_processing_detail["error"] = "文件为空"
-                results["processing_details"].append(file_processing_detail)
-                continue
-            
-            # 分割为句子
-            sentences, _ = split_text_into_sentences(asr_text)
-            
-            if not sentences:
-                print(f"文件 {txt_path} 分割句子失败，跳过处理")
-                results["failed_files"] += 1
-                results["failed_file_list"].append({"file": txt_path, "error": "分割句子失败"})
-                file_processing_detail["status"] = "failed"
-                file_processing_detail["error"] = "分割句子失败"
-                results["processing_details"].append(file_processing_detail)
-                continue
-            
-            # 生成输出文件名
-            file_stem = Path(txt_path).stem
-            
-            # 准备保存结果
-            all_segments = []
-            batch_id = 0
-            
-            # 初始化历史摘要
-            history_summary = "这是音频文本的开头。"
-            
-            empty_prompt_tokens = 0  # 这里可以计算prompt模板的token数
-            
-            # 设置实际可用的token数量
-            available_tokens = max_tokens_per_batch - empty_prompt_tokens - 100  # 留一些余量
-            
-            # 分批处理
-            current_batch = []
-            current_tokens = 0
-            
-            for sentence in sentences:
-                # 计算当前句子的token数
-                sentence_tokens = count_tokens(sentence, tokenizer)
-                
-                # 如果加入当前句子会超过限制，先处理当前批次
-                if current_tokens + sentence_tokens > available_tokens and current_batch:
-                    batch_id += 1
-                    file_processing_detail["batch_count"] = batch_id
-                    
-                    # 构建当前批次的文本
-                    batch_text = "".join(current_batch)
-                    
-                    # 处理当前批次
-                    segments, history_summary = process_batch(batch_text, batch_id, history_summary)
-                    
-                    if segments:
-                        # 更新ID以保持连续性
-                        start_id = len(all_segments) + 1
-                        for j, segment in enumerate(segments):
-                            segment["id"] = str(start_id + j)
-                            segment["batch"] = batch_id
-                            all_segments.append(segment)
-                        
-                        file_processing_detail["segments_count"] = len(all_segments)
-                    else:
-                        print(f"批次 {batch_id} 处理失败")
-                        file_processing_detail["failed_segments"].append({
-                            "batch_id": batch_id,
-                            "error": "分割结果解析失败"
-                        })
-                    
-                    # 重置当前批次
-                    current_batch = []
-                    current_tokens = 0
-                
-                # 添加当前句子到批次
-                current_batch.append(sentence)
-                current_tokens += sentence_tokens
-            
-            # 处理最后一个批次
-            if current_batch:
-                batch_id += 1
-                file_processing_detail["batch_count"] = batch_id
-                
-                # 构建当前批次的文本
-                batch_text = "".join(current_batch)
-                
-                # 处理当前批次
-                segments, history_summary = process_batch(batch_text, batch_id, history_summary)
-                
-                if segments:
-                    # 更新ID以保持连续性
-                    start_id = len(all_segments) + 1
-                    for j, segment in enumerate(segments):
-                        segment["id"] = str(start_id + j)
-                        segment["batch"] = batch_id
-                        all_segments.append(segment)
-                    
-                    file_processing_detail["segments_count"] = len(all_segments)
-                else:
-                    print(f"批次 {batch_id} 处理失败")
-                    file_processing_detail["failed_segments"].append({
-                        "batch_id": batch_id,
-                        "error": "分割结果解析失败"
-                    })
-            
-            # 保存所有结果
-            if all_segments:
-                # 保存为JSONL格式
-                jsonl_output_path = output_path / f"{file_stem}_speaker_split.jsonl"
-                with open(jsonl_output_path, 'w', encoding='utf-8') as f:
-                    for segment in all_segments:
-                        f.write(json.dumps(segment, ensure_ascii=False) + '\n')
-                print(f"JSONL结果已保存到: {jsonl_output_path}")
-                
-                results["processed_files"] += 1
-                file_processing_detail["status"] = "success"
-                
-                print(f"成功处理 {txt_path}，分割出 {len(all_segments)} 个段落，共 {batch_id} 个批次")
-                
-                # 检查是否有失败的段落
-                if file_processing_detail["failed_segments"]:
-                    file_processing_detail["status"] = "partial_success"
-                    print(f"部分批次处理失败: {len(file_processing_detail['failed_segments'])} 个批次")
-            else:
-                print(f"文件 {txt_path} 处理失败，未获取到有效分割结果")
-                results["failed_files"] += 1
-                results["failed_file_list"].append({"file": txt_path, "error": "未获取到有效分割结果"})
-                file_processing_detail["status"] = "failed"
-                file_processing_detail["error"] = "未获取到有效分割结果"
-            
-            results["processing_details"].append(file_processing_detail)
-            
-        except Exception as e:
-            print(f"处理文件 {txt_path} 时出错: {e}")
-            results["failed_files"] += 1
-            results["failed_file_list"].append({"file": txt_path, "error": str(e)})
-            file_processing_detail["status"] = "failed"
-            file_processing_detail["error"] = str(e)
-            results["processing_details"].append(file_processing_detail)
+    results = summarize_split_results(run, file_details, wall_time=time.perf_counter() - run_start_time)
     
     # 保存处理结果统计
     summary_path = output_path / "processing_summary.json"
     with open(summary_path, 'w', encoding='utf-8') as f:
         json.dump(results, f, ensure_ascii=False, indent=2)
     
-    print(f"\n批量处理完成!")
-    print(f"总文件数: {results['total_files']}")
-    print(f"成功处理: {results['processed_files']}")
-    print(f"处理失败: {results['failed_files']}")
+    print_split_report(results)
     print(f"处理结果统计已保存到: {summary_path}")
     
     return results
@@ -372,6 +1646,31 @@ def split_speakers(
 
 # 使用示例
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="批量说话人分割")
+    parser.add_argument("--input", default='/data3/liangyaozhen/vvmz/raw_text', help="ASR文本所在目录")
+    parser.add_argument("--output", default="/data3/liangyaozhen/vvmz/text_v0/splited_text_0", help="输出目录")
+    parser.add_argument("--rules", default='/data3/liangyaozhen/vvmz/text_v0/speaker_split_rules/speaker_split_rules_20250615_234627/final_rules_summary.txt',
+                        help="分割规则文件")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时处理的文件数")
+    parser.add_argument("--context-length", type=int, default=None, help="模型上下文长度，设置后按实际prompt开销分批")
+    parser.add_argument("--output-ratio", type=float, default=1.3, help="输出与输入token数之比的估计值")
+    parser.add_argument("--prefix-cache", action="store_true", help="使用前缀缓存布局组织分割prompt")
+    parser.add_argument("--pipeline-workers", type=int, default=0, help="预处理进程数，0表示在处理线程中预处理")
+    parser.add_argument("--candidates", type=int, default=1, help="每个批次的候选分割数，大于1时投票合并")
+    parser.add_argument("--candidate-mode", choices=["parallel", "n"], default="parallel",
+                        help="候选的请求方式：并发多个请求，或在一次请求中设置n")
+    parser.add_argument("--adaptive-batching", action="store_true", help="根据延迟、输出截断和解析结果在线调整批次大小")
+    parser.add_argument("--min-batch-tokens", type=int, default=None, help="自适应分批的预算下限")
+    parser.add_argument("--max-batch-tokens", type=int, default=None, help="自适应分批的预算上限")
+    parser.add_argument("--target-batch-latency", type=float, default=None, help="自适应分批的单批目标耗时（秒）")
+    parser.add_argument("--normalize", action="store_true", help="送入LLM前清洗表情标记、口吃重复和重复标点")
+    parser.add_argument("--keep-word-repeats", action="store_true", help="清洗时保留重复的多字词，只折叠单字重复")
+    parser.add_argument("--check-coverage", action="store_true", help="把分割结果对齐到原文，记录片段偏移并补发未覆盖的区间")
+    parser.add_argument("--force", action="store_true", help="忽略处理清单，重新处理所有文件")
+    parser.add_argument("--only-failed", action="store_true", help="只重新处理上次失败或部分成功的文件")
+    args = parser.parse_args()
+    
     # 分割规则示例
     # split_rules = """
     # 1. 识别未明子本人的语言风格和习惯用语，如特定的口头禅、表达方式
@@ -382,20 +1681,33 @@ if __name__ == "__main__":
     # 6. 识别连贯性中断，如话题突然转换或语调变化
     # 7. 注意表达风格的差异，连麦用户通常语言更简短、疑问较多
     # """
-    with open('/data3/liangyaozhen/vvmz/text_v0/speaker_split_rules/speaker_split_rules_20250615_234627/final_rules_summary.txt','r') as f:
+    with open(args.rules,'r') as f:
         split_rules = '\n'.join(f.readlines())
 
     # txt_files = [
     #     '/data3/liangyaozhen/vvmz/raw_text/创伤性分离txt/BV11i7FzzEmK_【未明子】随便聊聊 2025.05.31录播_2025-05-31-04-14-42.txt'
     # ]
-    txt_files = get_all_txt_files('/data3/liangyaozhen/vvmz/raw_text')
-
-    # 输出目录
-    output_directory = "/data3/liangyaozhen/vvmz/text_v0/splited_text_0"
+    txt_files = get_all_txt_files(args.input)
     
     # 执行分割
     results = split_speakers(
         txt_files,
-        output_directory,
+        args.output,
         split_rules=split_rules,
+        max_concurrent_files=args.concurrency,
+        context_length=args.context_length,
+        output_ratio=args.output_ratio,
+        prefix_cache=args.prefix_cache,
+        check_coverage=args.check_coverage,
+        num_candidates=args.candidates,
+        adaptive_batching=args.adaptive_batching,
+        min_batch_tokens=args.min_batch_tokens,
+        max_batch_tokens=args.max_batch_tokens,
+        target_batch_latency=args.target_batch_latency,
+        normalize_text=args.normalize,
+        normalize_options={"collapse_words": not args.keep_word_repeats},
+        candidate_mode=args.candidate_mode,
+        pipeline_workers=args.pipeline_workers,
+        force=args.force,
+        only_failed=args.only_failed,
     )
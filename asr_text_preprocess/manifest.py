@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Any, Optional, Tuple
+
+# 处理成功（包括部分成功）的状态，默认情况下这些文件在输入不变时会被跳过
+DONE_STATUSES = ("success", "partial_success")
+
+class CorpusManifest:
+    """
+    语料处理清单，记录每个输入文件的处理指纹和处理状态
+
+    指纹包括输入内容哈希、分割规则哈希、prompt模板版本、模型以及其他影响输出的分割设置的哈希。重新运行时，
+    指纹不变且已处理完成的文件会被跳过，只处理新增或发生变化的文件。
+    清单保存在SQLite中，可以在多个线程间共享。
+    """
+
+    FINGERPRINT_FIELDS = ("content_hash", "rules_hash", "prompt_version", "model", "options_hash")
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, content_hash TEXT, rules_hash TEXT, prompt_version TEXT, model TEXT, "
+            "status TEXT, output_path TEXT, segments_count INTEGER, error TEXT, updated_at TEXT, options_hash TEXT)"
+        )
+        # 旧清单没有options_hash列，补上后其中的文件因指纹变化重新处理一次
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(files)")}
+        if "options_hash" not in columns:
+            self._conn.execute("ALTER TABLE files ADD COLUMN options_hash TEXT")
+        self._conn.commit()
+
+    def get(self, path: str) -> Optional[Dict[str, Any]]:
+        """读取文件的清单记录，不存在时返回None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM files WHERE path = ?", (path,)).fetchone()
+        return dict(row) if row else None
+
+    def should_process(self, path: str, fingerprint: Dict[str, str], force: bool = False,
+                       only_failed: bool = False) -> Tuple[bool, str]:
+        """
+        判断文件是否需要处理
+
+        Args:
+            path: 输入文件路径
+            fingerprint: 当前的处理指纹
+            force: 忽略清单，处理所有文件
+            only_failed: 只处理清单中记录为失败或部分成功的文件
+        Returns:
+            (是否处理, 原因)
+        """
+        if force:
+            return True, "强制处理"
+        record = self.get(path)
+        if only_failed:
+            if record is not None and record["status"] != "success":
+                return True, f"上次处理状态为{record['status']}"
+            return False, "只处理失败的文件"
+        if record is None:
+            return True, "新文件"
+        changed = [field for field in self.FINGERPRINT_FIELDS if record[field] != fingerprint[field]]
+        if changed:
+            return True, "指纹变化: " + ",".join(changed)
+        if record["status"] not in DONE_STATUSES:
+            return True, f"上次处理状态为{record['status']}"
+        if record["output_path"] and not os.path.exists(record["output_path"]):
+            return True, "输出文件不存在"
+        return False, "输入未变化"
+
+    def update(self, path: str, fingerprint: Dict[str, str], status: str, output_path: str = "",
+               segments_count: int = 0, error: str = ""):
+        """写入或更新文件的处理记录"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (path, content_hash, rules_hash, prompt_version, model, options_hash, "
+                "status, output_path, segments_count, error, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, fingerprint["content_hash"], fingerprint["rules_hash"], fingerprint["prompt_version"],
+                 fingerprint["model"], fingerprint["options_hash"], status, output_path, segments_count, error,
+                 datetime.now().isoformat())
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
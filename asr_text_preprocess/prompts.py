@@ -90,6 +90,42 @@ SPEAKER_SPLIT_USER = '''我需要你帮我分析以下来自未明子直播的AS
 '''
 
 
+# 前缀缓存布局：整次运行不变的说明、规则、格式和示例放在前面，每批变化的历史摘要和ASR文本放在最后，
+# 使所有批次的请求共享同一段前缀，命中推理服务的前缀缓存
+SPEAKER_SPLIT_USER_STATIC = '''我需要你帮我分析来自未明子直播的ASR转录文本，并按说话人进行分割。待分割的文本在本消息最后的【ASR转录文本】中给出。
+这批文本数据来自直播视频的音频转录，主要包含一位主讲人讨论时事、分享知识以及与观众连麦互动的内容。文本具有明显的口语化特征，包含大量重复、口头禅和情绪化表达。内容主题广泛，涵盖社会评论、哲学政治理论、生活建议、教育问题和阶级批判等。
+文本结构呈现两种主要模式：一是主讲人的长篇独白，思路跳跃且内容丰富但组织松散；二是与连麦观众的互动对话，表现为问答交替但边界模糊。主讲人表现出广泛的知识背景，语言风格直接、情绪外露，常用举例说明复杂概念，偶尔使用粗俗语言表达强烈情绪。对话部分特征是交流节奏不稳定，有打断、催促和情绪化反应。
+转录文本存在ASR特有的问题，如词语重复、语义不连贯，以及标点使用不规范。文本中还混杂有表情符号等非语言元素。说话人切换通常没有明确标记，需要依靠内容、语气和交流模式的变化来识别不同的说话人。
+
+【如何分割说话人，分割说话人的原则】
+{split_rules}
+
+【输出格式】
+请按以下格式输出分割结果：
+```
+<SEGMENT>
+<ID>编号</ID>
+<ANALYSIS>为什么在此处进行分割的分析，包括语言风格变化、话题转换、代词变化等关键线索</ANALYSIS>
+<SPEAKER>未明子/连麦用户/旁白/背景音频</SPEAKER>
+<CONTENT>完整保留的原始文本，不要摘要或精简</CONTENT>
+</SEGMENT>
+```
+例如：
+{speaker_split_examples}
+...
+
+请仔细分析ASR转录文本中的对话模式、语气变化和内容衔接，根据上述要求以及下面提供的ASR处理历史，准确区分ASR转录文本中不同说话人及其说话内容。保持原始说话内容的完整，不要进行摘要或改写。
+'''
+
+SPEAKER_SPLIT_USER_DYNAMIC = '''
+【ASR处理历史】
+{asr_history}
+
+【ASR转录文本】
+{asr_raw_text}
+'''
+
+
 SPEAKER_SPLIT_EXAMPLES = '''<SEGMENT>
 <ID>1</ID>
 <ANALYSIS>这是开场连麦用户的自我介绍</ANALYSIS>
@@ -103,6 +139,15 @@ SPEAKER_SPLIT_EXAMPLES = '''<SEGMENT>
 <CONTENT>你高三没结束呢，你还有一个月不到的时间呢。</CONTENT>
 </SEGMENT>'''
 
+SPEAKER_SPLIT_SUMMARY_INSTRUCTION = '''
+【处理历史摘要】
+在所有<SEGMENT>之后，再输出一个<SUMMARY>，用不超过100字概括本段文本的主要说话人和讨论的话题，供处理下一段文本时参考：
+<SUMMARY>摘要内容</SUMMARY>
+'''
+
+SPEAKER_SPLIT_FORMAT_REMINDER = '''
+注意：请直接输出<SEGMENT>格式的分割结果，不要输出表格、代码块或其他说明文字。'''
+
 SPEAKER_SPLIT_FORMAT='''【输出格式】
 请按以下格式输出分割结果：
 ```
@@ -0,0 +1,198 @@
+import re
+from typing import List, Dict, Tuple
+
+# 只识别分割结果中用到的标签，其他的"<"和"&"都按普通文本处理
+SEGMENT_FIELDS = {"ID": "id", "ANALYSIS": "analysis", "SPEAKER": "speaker", "CONTENT": "content"}
+_TAG_PATTERN = re.compile(r'<\s*(/?)\s*(SEGMENT|ID|ANALYSIS|SPEAKER|CONTENT|SUMMARY)\s*>', re.IGNORECASE)
+_ENTITY_PATTERN = re.compile(r'&(lt|gt|amp|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);')
+_NAMED_ENTITIES = {"lt": "<", "gt": ">", "amp": "&", "quot": '"', "apos": "'"}
+
+def _decode_entity(match) -> str:
+    name = match.group(1)
+    if name in _NAMED_ENTITIES:
+        return _NAMED_ENTITIES[name]
+    try:
+        return chr(int(name[2:], 16) if name[1] in "xX" else int(name[1:]))
+    except (ValueError, OverflowError):
+        return match.group(0)
+
+def _field_text(text: str) -> str:
+    """字段文本：还原XML实体并去掉首尾空白，无法识别的"&"保持原样"""
+    if "&" in text:
+        text = _ENTITY_PATTERN.sub(_decode_entity, text)
+    return text.strip()
+
+def parse_segments_xml(text: str) -> List[Dict[str, str]]:
+    """
+    解析XML格式的说话人分割结果
+
+    只扫描一遍文本，按SEGMENT/ID/ANALYSIS/SPEAKER/CONTENT标签切分，不构建完整的XML树。
+    内容中的"<"和"&"按原样保留；缺少结束标签时，字段在下一个标签处结束，
+    片段在下一个<SEGMENT>、<SUMMARY>或文本末尾处结束。同一片段中重复的字段只取第一个。
+    """
+    segments = []
+    segment = None
+    field = None
+    field_start = 0
+
+    def close_field(end):
+        nonlocal field
+        if field is not None:
+            segment.setdefault(field, _field_text(text[field_start:end]))
+            field = None
+
+    def close_segment(end):
+        nonlocal segment
+        if segment is not None:
+            close_field(end)
+            if segment:
+                segments.append({key: segment.get(key, "") for key in SEGMENT_FIELDS.values()})
+            segment = None
+
+    for match in _TAG_PATTERN.finditer(text or ""):
+        closing, name = match.group(1), match.group(2).upper()
+        if name == "SEGMENT":
+            close_segment(match.start())
+            if not closing:
+                segment = {}
+        elif name == "SUMMARY":
+            close_segment(match.start())
+        elif closing:
+            # 结束标签与当前字段不一致时也视为当前字段结束
+            close_field(match.start())
+        else:
+            if segment is None:
+                # 缺少<SEGMENT>时从字段开始一个新片段
+                segment = {}
+            else:
+                close_field(match.start())
+                if name == "ID" and "id" in segment:
+                    # 上一个片段缺少</SEGMENT>和下一个<SEGMENT>，再次出现的<ID>意味着新片段开始
+                    close_segment(match.start())
+                    segment = {}
+            field = SEGMENT_FIELDS[name]
+            field_start = match.end()
+    close_segment(len(text or ""))
+    return segments
+
+# 全角或中文括号包裹的标签，如＜SEGMENT＞、〈/CONTENT〉、《ID》
+_FULLWIDTH_TAG_PATTERN = re.compile(
+    r'[＜〈《‹]\s*([/／]?)\s*(SEGMENT|ID|ANALYSIS|SPEAKER|CONTENT|SUMMARY)\s*[＞〉》›]', re.IGNORECASE
+)
+# 被转义成实体的标签，如&lt;SEGMENT&gt;
+_ESCAPED_TAG_PATTERN = re.compile(r'&lt;\s*(/?)\s*(SEGMENT|ID|ANALYSIS|SPEAKER|CONTENT|SUMMARY)\s*&gt;', re.IGNORECASE)
+# markdown表格表头中各列对应的字段
+_TABLE_HEADERS = {
+    "id": ("ID", "编号", "序号"),
+    "analysis": ("ANALYSIS", "分析", "分割依据", "理由", "依据"),
+    "speaker": ("SPEAKER", "说话人", "说话者", "角色"),
+    "content": ("CONTENT", "内容", "说话内容", "文本", "原文"),
+}
+
+def _table_cells(row: str) -> List[str]:
+    return [cell.strip().strip("*").strip() for cell in row.strip().strip("|").split("|")]
+
+def _table_columns(cells: List[str]) -> Dict[str, int]:
+    """从表头识别各字段所在的列，缺少说话人或内容列时返回空字典"""
+    header = {}
+    for index, cell in enumerate(cells):
+        name = cell.upper()
+        for field, aliases in _TABLE_HEADERS.items():
+            if field not in header and any(alias.upper() in name for alias in aliases):
+                header[field] = index
+                break
+    return header if "speaker" in header and "content" in header else {}
+
+def _table_rows(text: str) -> List[str]:
+    return [line.strip() for line in text.splitlines() if line.strip().startswith("|")]
+
+def _table_to_segments(text: str) -> str:
+    """把markdown表格形式的分割结果转换为<SEGMENT>格式，表头中至少要有说话人和内容两列"""
+    columns = None
+    output = []
+    for row in _table_rows(text):
+        cells = _table_cells(row)
+        if all(re.fullmatch(r':?-{2,}:?', cell) for cell in cells if cell):
+            continue
+        if columns is None:
+            columns = _table_columns(cells) or None
+            continue
+        values = {field: cells[index] if index < len(cells) else "" for field, index in columns.items()}
+        if not values["content"]:
+            continue
+        output.append(
+            f"<SEGMENT>\n<ID>{values.get('id', len(output) + 1)}</ID>\n<ANALYSIS>{values.get('analysis', '')}</ANALYSIS>\n"
+            f"<SPEAKER>{values['speaker']}</SPEAKER>\n<CONTENT>{values['content']}</CONTENT>\n</SEGMENT>"
+        )
+    return "\n".join(output)
+
+def repair_segments_text(text: str) -> Tuple[str, List[str]]:
+    """
+    对解析不出片段的输出做确定性的本地修复
+
+    依次尝试：全角括号替换为半角、还原被转义的标签、把markdown表格转换为<SEGMENT>格式。
+    代码块包裹和缺少结束标签由parse_segments_xml本身容忍，不需要修复。
+
+    Returns:
+        (修复后的文本, 实际生效的修复列表)
+    """
+    fixes = []
+    repaired, count = _FULLWIDTH_TAG_PATTERN.subn(lambda m: f"<{'/' if m.group(1) else ''}{m.group(2).upper()}>", text)
+    if count:
+        fixes.append("fullwidth_brackets")
+    if not _TAG_PATTERN.search(repaired):
+        repaired, count = _ESCAPED_TAG_PATTERN.subn(lambda m: f"<{m.group(1)}{m.group(2).upper()}>", repaired)
+        if count:
+            # 整段输出被转义过一次，内容中的实体也要相应还原一层
+            repaired = repaired.replace("&amp;", "&")
+            fixes.append("escaped_tags")
+    if not _TAG_PATTERN.search(repaired):
+        table = _table_to_segments(repaired)
+        if table:
+            repaired = table
+            fixes.append("markdown_table")
+    return repaired, fixes
+
+def has_segment_markup(text: str) -> bool:
+    """
+    判断输出中是否出现了可以解析或在本地修复的分割标记
+
+    包括任意大小写的标签、全角括号或被转义的标签，以及带说话人和内容列的markdown表格表头，
+    与parse_segments_with_repair能处理的格式一致。用于在流式接收时判断输出格式是否明显不符。
+    """
+    if _TAG_PATTERN.search(text) or _FULLWIDTH_TAG_PATTERN.search(text) or _ESCAPED_TAG_PATTERN.search(text):
+        return True
+    return any(_table_columns(_table_cells(row)) for row in _table_rows(text))
+
+def parse_segments_with_repair(text: str) -> Tuple[List[Dict[str, str]], List[str]]:
+    """解析分割结果，解析不出片段时先做本地修复再解析，返回(片段列表, 生效的修复列表)"""
+    segments = parse_segments_xml(text)
+    if segments or not text:
+        return segments, []
+    repaired, fixes = repair_segments_text(text)
+    if not fixes:
+        return [], []
+    return parse_segments_xml(repaired), fixes
+
+def extract_summary_xml(text: str) -> str:
+    """提取分割结果中的<SUMMARY>摘要，没有时返回空字符串"""
+    match = re.search(r'<SUMMARY>(.*?)(?:</SUMMARY>|$)', text or "", re.DOTALL)
+    return match.group(1).strip() if match else ""
+
+def parse_segments_bs4(text: str) -> List[Dict[str, str]]:
+    """原先基于BeautifulSoup的解析方式，仅用于性能和容错对比"""
+    from bs4 import BeautifulSoup
+
+    try:
+        soup = BeautifulSoup(f"<ROOT>{text}</ROOT>", "xml")
+        segments = []
+        for segment in soup.find_all("SEGMENT"):
+            segments.append({
+                "id": segment.find("ID").text.strip() if segment.find("ID") else "",
+                "analysis": segment.find("ANALYSIS").text.strip() if segment.find("ANALYSIS") else "",
+                "speaker": segment.find("SPEAKER").text.strip() if segment.find("SPEAKER") else "",
+                "content": segment.find("CONTENT").text.strip() if segment.find("CONTENT") else ""
+            })
+        return segments
+    except Exception:
+        return []
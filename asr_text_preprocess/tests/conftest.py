@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# 各模块按脚本方式互相导入（如from utils import ...），测试时把模块所在目录加入搜索路径
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,41 @@
+from adaptive_batching import AdaptiveBatchSizer
+
+OK = {"finish_reason": "stop", "parse": "ok"}
+
+def make_sizer(**kwargs):
+    return AdaptiveBatchSizer(**dict(dict(initial_tokens=1000, min_tokens=200, max_tokens=1800, increase_step=300), **kwargs))
+
+def test_additive_increase_up_to_max():
+    sizer = make_sizer()
+    budgets = [sizer.observe(1000, 1.0, OK)["budget"] for _ in range(4)]
+    assert budgets == [1300, 1600, 1800, 1800]
+    # 已到上限时不计入增加次数
+    assert sizer.stats()["increases"] == 3
+
+def test_multiplicative_decrease_down_to_min():
+    sizer = make_sizer(decrease_factor=0.5)
+    budgets = [sizer.observe(1000, 1.0, {"finish_reason": "length", "parse": "ok"})["budget"] for _ in range(4)]
+    assert budgets == [500, 250, 200, 200]
+    assert sizer.stats()["decreases"] == 4
+
+def test_decrease_reasons_and_hold():
+    sizer = make_sizer(target_latency=10.0)
+    assert sizer.observe(1000, 1.0, {"parse": "failed"})["action"] == "decrease"
+    assert sizer.observe(1000, 1.0, {"parse": "llm_repair"})["action"] == "decrease"
+    assert sizer.observe(1000, 30.0, OK)["action"] == "decrease"
+    assert sizer.stats()["decreases"] == 3
+    # 只靠本地修复时预算不变
+    result = sizer.observe(1000, 1.0, {"parse": "local_repair"})
+    assert result["action"] == "hold"
+    assert result["budget"] == sizer.budget == 342
+
+def test_initial_budget_clamped_and_throughput_grouped():
+    sizer = make_sizer(initial_tokens=5000)
+    assert sizer.budget == 1800
+    sizer.observe(100, 1.0, OK)
+    sizer.observe(300, 1.0, {"parse": "failed"})
+    sizer.observe(400, 1.0, OK)
+    by_size = sizer.stats()["by_size"]
+    assert [(group["tokens_range"], group["batches"]) for group in by_size] == [("0-255", 1), ("256-511", 2)]
+    assert by_size[1]["tokens_per_second"] == 350.0
+    assert by_size[1]["failure_rate"] == 0.5
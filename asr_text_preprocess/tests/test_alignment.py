@@ -0,0 +1,22 @@
+from alignment import align_segments, find_gaps
+
+def test_short_segment_not_matched_far_downstream():
+    source = "今天我们聊逻辑学。嗯。然后我们说存在。" + "后面还有很长的一段讨论。" * 30 + "对。"
+    spans, _ = align_segments(source, ["今天我们聊逻辑学。", "对。", "然后我们说存在。"])
+    assert spans[0] == (0, 9)
+    assert spans[1] is None
+    # 短句没有把位置带到文末，后面的片段仍然能对齐
+    assert spans[2] == (source.index("然后"), source.index("然后") + len("然后我们说存在。"))
+
+def test_long_segment_found_after_large_skip():
+    skipped = "模型漏掉了这一整段内容。" * 40
+    tail = "这是模型输出的下一个很长的片段内容。"
+    source = "开头一句话。" + skipped + tail
+    spans, matched = align_segments(source, ["开头一句话。", tail], base_offset=100)
+    assert spans[1] == (100 + len(source) - len(tail), 100 + len(source))
+    assert find_gaps(source, matched, base_offset=100) == [(106, 106 + len(skipped))]
+
+def test_fuzzy_match_tolerates_small_edits():
+    source = "我想问一下存在和无的关系。"
+    spans, _ = align_segments(source, ["我想问一下存在与无的关系。"])
+    assert spans == [(0, len(source))]
@@ -0,0 +1,36 @@
+import pytest
+
+from asr_normalize import normalize_asr_text
+
+@pytest.mark.parametrize("text", ["谢谢", "讨论讨论", "一点一点", "我们讨论讨论这个问题"])
+def test_reduplication_kept(text):
+    clean, _, removed = normalize_asr_text(text)
+    assert clean == text
+    assert removed["stutter"] == 0
+
+@pytest.mark.parametrize("text, expected", [
+    ("谢谢谢谢", "谢谢"),
+    ("哈哈哈哈哈", "哈哈"),
+    ("我我我我觉得", "我我觉得"),
+    ("然后然后然后呢", "然后然后呢"),
+    ("我觉得我觉得不对", "我觉得不对"),
+])
+def test_stutter_collapsed(text, expected):
+    clean, _, _ = normalize_asr_text(text)
+    assert clean == expected
+
+def test_ellipsis_kept_and_punctuation_deduplicated():
+    clean, _, removed = normalize_asr_text("好，，，那么。。。")
+    assert clean == "好，那么。。。"
+    assert removed["punctuation"] == 2
+
+def test_offset_map_spans_cover_raw_text():
+    raw = "我我我我觉得😊不对。然后然后然后呢"
+    clean, offset_map, _ = normalize_asr_text(raw)
+    middle = clean.index("不对")
+    first = offset_map.span_to_raw(0, middle)
+    second = offset_map.span_to_raw(middle, len(clean))
+    # 相邻区间首尾相接，被删除的字符归入前一个区间
+    assert first == (0, raw.index("不对"))
+    assert second == (raw.index("不对"), len(raw))
+    assert raw[first[0]:first[1]] == "我我我我觉得😊"
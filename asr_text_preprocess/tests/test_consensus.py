@@ -0,0 +1,41 @@
+from consensus import vote_boundaries, merge_candidate_segments
+
+SOURCE = "甲说第一句话。乙说第二句话。甲说第三句话。"
+
+def segments(*parts):
+    """parts为(说话人, start, end)，按原文区间生成片段"""
+    return [{"id": str(i), "analysis": "", "speaker": speaker, "content": SOURCE[start:end]}
+            for i, (speaker, start, end) in enumerate(parts, start=1)]
+
+def test_vote_boundaries_keeps_majority_within_tolerance():
+    assert vote_boundaries([[10, 30], [12, 50], [11]], tolerance=8) == [10]
+    # 同一组中出现次数最多的偏移
+    assert vote_boundaries([[12], [12], [10]], tolerance=8) == [12]
+    # 超出容差的边界不合并，都达不到多数
+    assert vote_boundaries([[10], [20]], tolerance=8) == []
+
+def test_merge_votes_boundaries_and_speakers():
+    full = segments(("甲", 0, 7), ("乙", 7, 14), ("甲", 14, 21))
+    missing_boundary = segments(("甲", 0, 14), ("甲", 14, 21))
+    merged = merge_candidate_segments(SOURCE, [full, full, missing_boundary], tolerance=3)
+    assert [(segment["speaker"], segment["content"]) for segment in merged] == [
+        ("甲", "甲说第一句话。"), ("乙", "乙说第二句话。"), ("甲", "甲说第三句话。")
+    ]
+    assert [segment["confidence"] for segment in merged] == [0.667, 0.667, 1.0]
+    assert not any(segment["low_confidence"] for segment in merged)
+
+def test_unaligned_candidate_not_counted_in_confidence():
+    full = segments(("甲", 0, 7), ("乙", 7, 14), ("甲", 14, 21))
+    unrelated = [{"id": "1", "analysis": "", "speaker": "甲", "content": "完全不在原文中的内容"}]
+    merged = merge_candidate_segments(SOURCE, [full, full, unrelated], tolerance=3)
+    assert [segment["confidence"] for segment in merged] == [1.0, 1.0, 1.0]
+
+def test_speaker_tie_marked_low_confidence():
+    first = segments(("甲", 0, 7), ("乙", 7, 21))
+    second = segments(("甲", 0, 7), ("丙", 7, 21))
+    merged = merge_candidate_segments(SOURCE, [first, second], tolerance=3)
+    assert merged[0]["speaker"] == "甲" and not merged[0]["low_confidence"]
+    # 1比1时取靠前的候选，并标记为低置信度
+    assert merged[1]["speaker"] == "乙"
+    assert merged[1]["confidence"] == 0.5
+    assert merged[1]["low_confidence"]
@@ -0,0 +1,340 @@
+import json
+import re
+
+import pytest
+from openai.types.chat import ChatCompletion
+
+import get_speaker_splits
+from token_counter import estimate_tokens
+from utils import record_llm_call
+
+ASR_TEXT = "今天我们聊一聊黑格尔的逻辑学。那么你先说说你的问题吧。我想问一下存在和无的关系。"
+PROMPT_TOKENS = 100
+COMPLETION_TOKENS = 20
+
+def make_response(content):
+    return ChatCompletion.model_validate({
+        "id": "test", "object": "chat.completion", "created": 0, "model": "test-model",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": PROMPT_TOKENS, "completion_tokens": COMPLETION_TOKENS,
+                  "total_tokens": PROMPT_TOKENS + COMPLETION_TOKENS}
+    })
+
+class FakeLLM:
+    """
+    代替call_llm，不发送请求：分割请求把批次文本按句子分成片段，其余请求返回固定的摘要，并像call_llm一样登记调用记录
+
+    calls记录收到的请求参数；transform不为None时用它改写分割请求的输出，用于模拟格式不规范的输出
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.transform = None
+
+    def __call__(self, messages, purpose="general", **kwargs):
+        self.calls.append(dict(kwargs, purpose=purpose, messages=messages))
+        if purpose in ("split", "gap_split"):
+            batch_text = re.search(r"【ASR转录文本】\n(.*?)\s*(?:\n\n【|$)", messages[-1]["content"], re.S).group(1)
+            sentences = re.findall(r"[^。]+。*", batch_text)
+            content = "".join(
+                f"<SEGMENT>\n<ID>{i}</ID>\n<ANALYSIS>a</ANALYSIS>\n<SPEAKER>{'未明子' if i % 2 else '连麦用户'}</SPEAKER>\n"
+                f"<CONTENT>{sentence}</CONTENT>\n</SEGMENT>\n"
+                for i, sentence in enumerate(sentences, start=1)
+            )
+            if self.transform is not None:
+                content = self.transform(content)
+        else:
+            content = "测试摘要"
+        record = {"purpose": purpose, "outcome": "success", "latency": 0.01,
+                  "prompt_tokens": PROMPT_TOKENS, "completion_tokens": COMPLETION_TOKENS}
+        if kwargs.get("stream"):
+            # 按20个字符一段交给回调，回调返回True时像call_llm一样终止输出并返回None
+            for end in range(20, len(content) + 20, 20):
+                if kwargs["on_delta"](content[end - 20:end], content[:end]):
+                    record["outcome"] = "aborted"
+                    record_llm_call(record)
+                    return None
+        record_llm_call(record)
+        return make_response(content)
+
+    def purposes(self):
+        return [call["purpose"] for call in self.calls]
+
+class FakeAutoTokenizer:
+    """本地没有模型文件，像AutoTokenizer一样加载失败，token数按字符估算"""
+
+    @staticmethod
+    def from_pretrained(model_path):
+        raise OSError(f"{model_path} is not a local model directory")
+
+@pytest.fixture(autouse=True)
+def no_tokenizer(monkeypatch):
+    monkeypatch.setattr(get_speaker_splits, "AutoTokenizer", FakeAutoTokenizer)
+
+@pytest.fixture
+def llm(monkeypatch):
+    fake = FakeLLM()
+    monkeypatch.setattr(get_speaker_splits, "call_llm", fake)
+    return fake
+
+@pytest.fixture
+def asr_file(tmp_path, monkeypatch, llm):
+    # 在临时目录中运行，使用默认配置，不读写真实的缓存
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "input.txt"
+    path.write_text(ASR_TEXT, encoding="utf-8")
+    return path
+
+def read_segments(output_dir):
+    with open(output_dir / "input_speaker_split.jsonl", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def test_parallel_candidate_calls_counted_in_file_usage(asr_file, tmp_path):
+    results = get_speaker_splits.split_speakers(
+        [str(asr_file)], str(tmp_path / "out"), model_path=str(tmp_path / "no-model"), use_cache=False,
+        num_candidates=3, candidate_mode="parallel", force=True
+    )
+    usage = results["processing_details"][0]["llm_usage"]
+    # 3个候选分割请求加1个摘要请求
+    assert usage["by_purpose"]["split"]["calls"] == 3
+    assert usage["calls"] == 4
+    assert usage["prompt_tokens"] == 4 * PROMPT_TOKENS
+    assert usage["completion_tokens"] == 4 * COMPLETION_TOKENS
+    assert results["llm_usage"]["calls"] == 4
+    assert results["llm_usage"]["total_tokens"] == 4 * (PROMPT_TOKENS + COMPLETION_TOKENS)
+
+@pytest.mark.parametrize("check_coverage", [True, False])
+def test_normalized_segments_keep_raw_content(asr_file, tmp_path, check_coverage):
+    raw_text = "我我我我觉得😊这个问题。。。谢谢谢谢谢。我们讨论讨论然后然后然后吧。"
+    asr_file.write_text(raw_text, encoding="utf-8")
+    output_dir = tmp_path / "out"
+    get_speaker_splits.split_speakers(
+        [str(asr_file)], str(output_dir), model_path=str(tmp_path / "no-model"), use_cache=False,
+        check_coverage=check_coverage, normalize_text=True, force=True
+    )
+    segments = read_segments(output_dir)
+    assert [segment["content"] for segment in segments] == ["我我我我觉得😊这个问题。。。", "谢谢谢谢谢。", "我们讨论讨论然后然后然后吧。"]
+    assert all(raw_text[segment["start"]:segment["end"]] == segment["content"] for segment in segments)
+
+def test_split_max_tokens_fits_context(asr_file, tmp_path, llm):
+    context_length = 4096
+    asr_file.write_text(ASR_TEXT * 40, encoding="utf-8")
+    get_speaker_splits.split_speakers(
+        [str(asr_file)], str(tmp_path / "out"), model_path=str(tmp_path / "no-model"), use_cache=False,
+        context_length=context_length, force=True
+    )
+    split_calls = [call for call in llm.calls if call["purpose"] == "split"]
+    assert split_calls
+    for call in split_calls:
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in call["messages"])
+        assert call["max_tokens"] is not None
+        assert prompt_tokens + call["max_tokens"] <= context_length
+
+def test_stream_keeps_fullwidth_tag_output(asr_file, tmp_path, llm):
+    def fullwidth(content):
+        # 分析写得很长，第一个片段结束前已经超过了流式检查的字符数
+        content = content.replace("<ANALYSIS>a</ANALYSIS>", f"<ANALYSIS>{'分析说话人的语气变化' * 80}</ANALYSIS>")
+        return content.replace("<", "＜").replace(">", "＞")
+
+    llm.transform = fullwidth
+    output_dir = tmp_path / "out"
+    results = get_speaker_splits.split_speakers(
+        [str(asr_file)], str(output_dir), model_path=str(tmp_path / "no-model"), use_cache=False,
+        stream=True, max_batch_retries=0, force=True
+    )
+    detail = results["processing_details"][0]
+    assert detail["llm_usage"]["aborted"] == 0
+    assert detail["format_repairs"]["fixes"] == {"fullwidth_brackets": 1}
+    assert "".join(segment["content"] for segment in read_segments(output_dir)) == ASR_TEXT
+
+@pytest.mark.parametrize("dropped, expected_requests", [
+    # 零星的语气词不补发
+    ("就是说那个那个然后呢。", 0),
+    ("我再补充一点，逻辑学的开端是纯存在，它和纯无是同一个东西，区别只在于意谓。", 1),
+])
+def test_gap_requests_only_for_large_gaps(asr_file, tmp_path, llm, dropped, expected_requests):
+    def drop_sentence(content):
+        # 只在包含多个片段的批次输出中漏掉这一句，补发的请求正常返回
+        if content.count("<SEGMENT>") < 2:
+            return content
+        return re.sub(rf"<SEGMENT>(?:(?!</SEGMENT>).)*{dropped}</CONTENT>\n</SEGMENT>\n", "", content, flags=re.S)
+
+    asr_file.write_text(ASR_TEXT + dropped, encoding="utf-8")
+    llm.transform = drop_sentence
+    results = get_speaker_splits.split_speakers(
+        [str(asr_file)], str(tmp_path / "out"), model_path=str(tmp_path / "no-model"), use_cache=False,
+        check_coverage=True, force=True
+    )
+    detail = results["processing_details"][0]
+    assert detail["coverage"]["gap_requests"] == expected_requests
+    assert results["coverage"]["gap_requests"] == expected_requests
+    assert detail["llm_usage"]["by_purpose"].get("gap_split", {}).get("calls", 0) == expected_requests
+    # 过短的空隙不计入未覆盖，补发后较长的空隙也被覆盖
+    assert detail["coverage"]["ratio"] == 1.0
+
+def test_coverage_check_off_by_default(asr_file, tmp_path, llm):
+    llm.transform = lambda content: content.split("</SEGMENT>")[0] + "</SEGMENT>\n"
+    output_dir = tmp_path / "out"
+    results = get_speaker_splits.split_speakers(
+        [str(asr_file)], str(output_dir), model_path=str(tmp_path / "no-model"), use_cache=False, force=True
+    )
+    assert "coverage" not in results["processing_details"][0]
+    assert results["coverage"]["ratio"] is None
+    assert llm.purposes() == ["split", "summary"]
+    assert "start" not in read_segments(output_dir)[0]
+
+class Interrupted(BaseException):
+    """模拟处理过程中被中断"""
+
+@pytest.mark.parametrize("changed, resumed", [
+    ({}, True),
+    ({"inline_summary": True}, False),
+    ({"prefix_cache": True}, False),
+    ({"normalize_text": True}, False),
+])
+def test_checkpoint_only_resumes_with_same_prompt(asr_file, tmp_path, monkeypatch, llm, changed, resumed):
+    asr_file.write_text(ASR_TEXT * 3, encoding="utf-8")
+    output_dir = tmp_path / "out"
+    options = dict(model_path=str(tmp_path / "no-model"), use_cache=False, max_tokens_per_batch=130, force=True)
+
+    def interrupt_second_batch(messages, purpose="general", **kwargs):
+        if purpose == "split" and llm.purposes().count("split") == 1:
+            raise Interrupted()
+        return llm(messages, purpose, **kwargs)
+
+    monkeypatch.setattr(get_speaker_splits, "call_llm", interrupt_second_batch)
+    with pytest.raises(Interrupted):
+        get_speaker_splits.split_speakers([str(asr_file)], str(output_dir), **options)
+    assert (output_dir / "input_speaker_split.jsonl.ckpt").exists()
+
+    monkeypatch.setattr(get_speaker_splits, "call_llm", llm)
+    results = get_speaker_splits.split_speakers([str(asr_file)], str(output_dir), **dict(options, **changed))
+    detail = results["processing_details"][0]
+    assert ("resumed_from_batch" in detail) == resumed
+    assert detail["status"] == "success"
+
+def test_checkpoint_not_resumed_after_input_changes(asr_file, tmp_path, monkeypatch, llm):
+    asr_file.write_text(ASR_TEXT * 3, encoding="utf-8")
+    output_dir = tmp_path / "out"
+    options = dict(model_path=str(tmp_path / "no-model"), use_cache=False, max_tokens_per_batch=130, force=True)
+
+    def interrupt_second_batch(messages, purpose="general", **kwargs):
+        if purpose == "split" and llm.purposes().count("split") == 1:
+            raise Interrupted()
+        return llm(messages, purpose, **kwargs)
+
+    monkeypatch.setattr(get_speaker_splits, "call_llm", interrupt_second_batch)
+    with pytest.raises(Interrupted):
+        get_speaker_splits.split_speakers([str(asr_file)], str(output_dir), **options)
+    checkpoint = json.loads((output_dir / "input_speaker_split.jsonl.ckpt").read_text(encoding="utf-8"))
+    assert checkpoint["source"] == str(asr_file)
+
+    # 批次边界不变，只改动内容
+    changed_text = ASR_TEXT.replace("黑格尔", "康德的") * 3
+    asr_file.write_text(changed_text, encoding="utf-8")
+    monkeypatch.setattr(get_speaker_splits, "call_llm", llm)
+    results = get_speaker_splits.split_speakers([str(asr_file)], str(output_dir), **options)
+    assert "resumed_from_batch" not in results["processing_details"][0]
+    assert "".join(segment["content"] for segment in read_segments(output_dir)) == changed_text
+
+def test_same_stem_in_different_directories_keeps_both_outputs(asr_file, tmp_path):
+    other_text = "第二个目录下的同名文件。内容完全不同。"
+    txt_paths = []
+    for directory, text in (("a", ASR_TEXT), ("b", other_text)):
+        (tmp_path / "in" / directory).mkdir(parents=True)
+        path = tmp_path / "in" / directory / "talk.txt"
+        path.write_text(text, encoding="utf-8")
+        txt_paths.append(str(path))
+    output_dir = tmp_path / "out"
+    results = get_speaker_splits.split_speakers(
+        txt_paths, str(output_dir), model_path=str(tmp_path / "no-model"), use_cache=False,
+        max_concurrent_files=2, force=True
+    )
+    assert results["processed_files"] == 2
+    for stem, text in (("a__talk", ASR_TEXT), ("b__talk", other_text)):
+        with open(output_dir / f"{stem}_speaker_split.jsonl", encoding="utf-8") as f:
+            assert "".join(json.loads(line)["content"] for line in f) == text
+
+def test_assign_output_stems():
+    assert get_speaker_splits.assign_output_stems(["/data/a/x.txt", "/data/b/y.txt"]) == {
+        "/data/a/x.txt": "x", "/data/b/y.txt": "y"
+    }
+    assert get_speaker_splits.assign_output_stems(["/data/a/x.txt", "/data/b/c/x.txt", "/data/b/y.txt"]) == {
+        "/data/a/x.txt": "a__x", "/data/b/c/x.txt": "b__c__x", "/data/b/y.txt": "y"
+    }
+    with pytest.raises(ValueError):
+        get_speaker_splits.assign_output_stems(["/data/a/x.txt", "/data/a/x.txt"])
+
+def test_streamed_prepare_matches_full_read(tmp_path, monkeypatch):
+    # 块很小，句子和多字节字符都会跨块
+    real_iter_text_chunks = get_speaker_splits.iter_text_chunks
+    monkeypatch.setattr(get_speaker_splits, "iter_text_chunks",
+                        lambda path, strip=False: real_iter_text_chunks(path, chunk_bytes=7, strip=strip))
+    path = tmp_path / "input.txt"
+    path.write_text("\n  " + ASR_TEXT * 3 + "  \n", encoding="utf-8")
+    counter = get_speaker_splits.TokenCounter()
+    full = get_speaker_splits.prepare_file_batches(str(path), counter, 50)
+    streamed = get_speaker_splits.prepare_file_batches(str(path), counter, 50, keep_text=False)
+    assert streamed["asr_text"] is None
+    for key in ("input_hash", "sentences", "sentence_spans", "token_counts", "batch_plan"):
+        assert streamed[key] == full[key]
+
+def test_streamed_prepare_reports_empty_file(tmp_path):
+    path = tmp_path / "empty.txt"
+    path.write_text(" \n", encoding="utf-8")
+    prepared = get_speaker_splits.prepare_file_batches(str(path), get_speaker_splits.TokenCounter(), 50, keep_text=False)
+    assert prepared == {"error": "文件为空"}
+
+def test_estimated_prompt_overhead_counts_template_markup():
+    counter = get_speaker_splits.TokenCounter()
+    split_rules = get_speaker_splits.SplitOptions().split_rules
+    messages = get_speaker_splits.build_speaker_split_messages("", split_rules, "")
+    plain = sum(estimate_tokens(message["content"]) for message in messages)
+    assert get_speaker_splits.measure_prompt_overhead(counter, split_rules) > plain * 1.25
+
+@pytest.mark.parametrize("max_batch_retries, lost_sentences", [(2, []), (1, [3, 4])])
+def test_failed_batch_is_bisected_and_stitched_back_in_order(asr_file, tmp_path, llm, max_batch_retries, lost_sentences):
+    # 三批各3句，中间一批包含多个片段时输出无法解析，二分到单句后才能恢复
+    text = ASR_TEXT + ASR_TEXT.replace("黑格尔", "康德的") + ASR_TEXT
+    asr_file.write_text(text, encoding="utf-8")
+    llm.transform = lambda content: "无法解析" if "康德" in content and content.count("<SEGMENT>") > 1 else content
+    output_dir = tmp_path / "out"
+    results = get_speaker_splits.split_speakers(
+        [str(asr_file)], str(output_dir), model_path=str(tmp_path / "no-model"), use_cache=False,
+        max_tokens_per_batch=150, max_batch_retries=max_batch_retries, retry_backoff=0, force=True
+    )
+    detail = results["processing_details"][0]
+    sentences = re.findall(r"[^。]+。", text)
+    assert [segment["content"] for segment in read_segments(output_dir)] == [
+        sentence for i, sentence in enumerate(sentences) if i not in lost_sentences
+    ]
+    assert detail["retried_batches"] == 1
+    assert [(failed["start"], failed["end"]) for failed in detail["failed_segments"]] == (
+        [(3, 5)] if lost_sentences else []
+    )
+
+def test_bisect_batch_splits_by_tokens():
+    assert get_speaker_splits.bisect_batch([10, 10, 10, 10], 0, 4) == 2
+    assert get_speaker_splits.bisect_batch([100, 1, 1], 0, 3) == 1
+    # 两半都至少包含一句
+    assert get_speaker_splits.bisect_batch([1, 1, 100], 0, 3) == 2
+    assert get_speaker_splits.bisect_batch([5, 5, 5, 5], 1, 3) == 2
+
+@pytest.mark.parametrize("changed, reprocessed", [
+    ({}, False),
+    ({"max_tokens_per_batch": 300}, True),
+    ({"check_coverage": True}, True),
+    ({"num_candidates": 3}, True),
+    ({"num_candidates": 3, "candidate_mode": "n"}, True),
+    ({"normalize_text": True}, True),
+    # 只影响速度的设置不触发重新处理
+    ({"max_concurrent_files": 4}, False),
+])
+def test_rerun_reprocesses_when_output_settings_change(asr_file, tmp_path, changed, reprocessed):
+    options = dict(model_path=str(tmp_path / "no-model"), use_cache=False)
+    get_speaker_splits.split_speakers([str(asr_file)], str(tmp_path / "out"), **options)
+    if "candidate_mode" in changed:
+        # 与同为多候选、只改变候选方式的设置比较
+        get_speaker_splits.split_speakers([str(asr_file)], str(tmp_path / "out"), **dict(options, num_candidates=3))
+    results = get_speaker_splits.split_speakers([str(asr_file)], str(tmp_path / "out"), **dict(options, **changed))
+    assert results["skipped_files"] == (0 if reprocessed else 1)
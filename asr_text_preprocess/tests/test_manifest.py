@@ -0,0 +1,31 @@
+import sqlite3
+
+from manifest import CorpusManifest
+
+FINGERPRINT = {"content_hash": "c", "rules_hash": "r", "prompt_version": "p", "model": "m", "options_hash": "o"}
+
+def test_changed_options_hash_reprocesses(tmp_path):
+    (tmp_path / "out.jsonl").write_text("", encoding="utf-8")
+    manifest = CorpusManifest(str(tmp_path / "manifest.sqlite"))
+    manifest.update("a.txt", FINGERPRINT, "success", str(tmp_path / "out.jsonl"))
+    assert manifest.should_process("a.txt", FINGERPRINT) == (False, "输入未变化")
+    assert manifest.should_process("a.txt", dict(FINGERPRINT, options_hash="x")) == (True, "指纹变化: options_hash")
+    manifest.close()
+
+def test_old_manifest_gains_options_hash_column(tmp_path):
+    path = str(tmp_path / "manifest.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE files (path TEXT PRIMARY KEY, content_hash TEXT, rules_hash TEXT, prompt_version TEXT, model TEXT, "
+        "status TEXT, output_path TEXT, segments_count INTEGER, error TEXT, updated_at TEXT)"
+    )
+    conn.execute("INSERT INTO files (path, content_hash, rules_hash, prompt_version, model, status) "
+                 "VALUES ('a.txt', 'c', 'r', 'p', 'm', 'success')")
+    conn.commit()
+    conn.close()
+    manifest = CorpusManifest(path)
+    # 旧记录没有记录分割设置，重新处理一次
+    assert manifest.should_process("a.txt", FINGERPRINT) == (True, "指纹变化: options_hash")
+    manifest.update("a.txt", FINGERPRINT, "failed")
+    assert manifest.get("a.txt")["options_hash"] == "o"
+    manifest.close()
@@ -0,0 +1,44 @@
+import pytest
+
+from benchmarks import export_malformed_responses, load_segment_fixture
+from segment_parser import has_segment_markup, parse_segments_with_repair
+from utils import LLMResponseCache
+
+@pytest.mark.parametrize("text", [
+    "<SEGMENT>\n<ID>1</ID>",
+    "<segment>\n<id>1</id>",
+    "＜SEGMENT＞\n＜ID＞1＜／ID＞",
+    "&lt;SEGMENT&gt;",
+    "| 编号 | 说话人 | 内容 |\n|---|---|---|",
+])
+def test_markup_detected(text):
+    assert has_segment_markup(text)
+
+@pytest.mark.parametrize("text", ["好的，下面我来分析这段文本的说话人。", "| 列1 | 列2 |\n|---|---|"])
+def test_plain_text_has_no_markup(text):
+    assert not has_segment_markup(text)
+
+def test_fullwidth_tags_repaired():
+    segments, fixes = parse_segments_with_repair("＜SEGMENT＞＜ID＞1＜/ID＞＜SPEAKER＞未明子＜/SPEAKER＞＜CONTENT＞你好＜/CONTENT＞＜/SEGMENT＞")
+    assert fixes == ["fullwidth_brackets"]
+    assert segments[0]["speaker"] == "未明子"
+    assert segments[0]["content"] == "你好"
+
+def test_fixture_cases_are_labelled():
+    corpus = load_segment_fixture()
+    assert corpus
+    assert all(case["expected"] and all(speaker and content for speaker, content in case["expected"]) for case in corpus)
+
+def test_export_malformed_responses_for_labelling(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "cache"))
+    for key, content in (
+        ("clean", "<SEGMENT><ID>1</ID><SPEAKER>未明子</SPEAKER><CONTENT>你好</CONTENT></SEGMENT>"),
+        ("malformed", "<SEGMENT><ID>1</ID><CONTENT>没有说话人</CONTENT></SEGMENT>"),
+        ("summary", "测试摘要"),
+    ):
+        cache.set(key, {"choices": [{"message": {"content": content}}]})
+    output_path = tmp_path / "fixture.jsonl"
+    assert export_malformed_responses(str(tmp_path / "cache"), str(output_path)) == 1
+    assert "没有说话人" in output_path.read_text(encoding="utf-8")
+    # 导出的样本标注前不参与评测
+    assert load_segment_fixture(output_path) == []
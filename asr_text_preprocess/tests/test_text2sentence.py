@@ -0,0 +1,35 @@
+import pytest
+
+from text2sentence import (
+    iter_sentences, iter_sentences_from_chunks, split_text_with_spans, split_text_into_sentences,
+    split_text_into_sentences_legacy, _normalize_ellipsis
+)
+
+TEXTS = [
+    "",
+    "没有句末标点的一段话",
+    "今天我们聊一聊黑格尔的逻辑学。那么你先说说你的问题吧！我想问一下存在和无的关系？",
+    "  开头有空白。 中间也有空白。  结尾没有标点的部分  ",
+    "他说“你好。”然后就走了。She said (hello!) and left... OK?",
+    "省略号很长。。。。。。然后呢......还有吗.....没了。",
+    "嗯。。😊🎼然后我今天回家了。。。OK.好好的",
+    "。。开头就是标点！？",
+]
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_sentences_match_legacy_splitter(text):
+    sentences, spans = split_text_with_spans(text)
+    legacy_sentences, legacy_indices = split_text_into_sentences_legacy(text)
+    assert sentences == legacy_sentences
+    # 区间指向原文，去掉首尾空白、压缩省略号后就是句子内容
+    assert [_normalize_ellipsis(text[start:end].strip()) for start, end in spans] == sentences
+    if "...." not in text and "。。。。" not in text:
+        # 没有改写省略号时，旧实现的索引同样指向原文
+        assert split_text_into_sentences(text)[1] == legacy_indices
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_chunked_sentences_match_whole_text(text):
+    expected = list(iter_sentences(text))
+    for size in range(1, len(text) + 1):
+        chunks = [text[i:i + size] for i in range(0, len(text), size)]
+        assert list(iter_sentences_from_chunks(chunks)) == expected, size
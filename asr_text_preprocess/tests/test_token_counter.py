@@ -0,0 +1,35 @@
+import token_counter
+from token_counter import TokenCounter, estimate_tokens, estimate_tokens_batch
+
+SENTENCES = [
+    "",
+    "今天我们聊一聊黑格尔的逻辑学。",
+    "OK好的",
+    "abc",
+    "def ghi，jkl。",
+    "😊🎼emoji之后是English words。",
+    "Hello world! This is a test",
+    "。。。",
+    "mixed中文and英文mixed",
+]
+
+def test_batch_estimate_matches_single_estimate():
+    assert estimate_tokens_batch(SENTENCES) == [estimate_tokens(sentence) for sentence in SENTENCES]
+
+def test_batch_estimate_words_do_not_span_sentences():
+    # 前一句以字母结尾、后一句以字母开头时，仍然算作两个单词
+    assert estimate_tokens_batch(["word", "word"]) == [1, 1]
+    assert estimate_tokens_batch([]) == []
+
+def test_batch_estimate_without_numpy(monkeypatch):
+    monkeypatch.setattr(token_counter, "np", None)
+    assert estimate_tokens_batch(SENTENCES) == [estimate_tokens(sentence) for sentence in SENTENCES]
+
+def test_sentence_counts_cached(tmp_path):
+    counter = TokenCounter(cache_dir=str(tmp_path))
+    first = counter.count_sentences(SENTENCES)
+    second = TokenCounter(cache_dir=str(tmp_path))
+    assert second.count_sentences(SENTENCES) == first
+    assert (counter.stats()["cache_misses"], second.stats()["cache_hits"]) == (1, 1)
+    counter.close()
+    second.close()
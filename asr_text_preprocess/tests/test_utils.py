@@ -0,0 +1,328 @@
+import threading
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import BadRequestError, InternalServerError, RateLimitError
+from openai.types.chat import ChatCompletion
+
+import utils
+from token_counter import estimate_tokens
+from utils import Endpoint, EndpointPool, RateLimiter
+
+class FakeClock:
+    """替换utils中的time模块：时间只在sleep时前进，sleep不真正等待"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    perf_counter = monotonic
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(utils, "time", fake)
+    return fake
+
+def make_response(content="ok", prompt_tokens=100, completion_tokens=20):
+    return ChatCompletion.model_validate({
+        "id": "test", "object": "chat.completion", "created": 0, "model": "test-model",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens}
+    })
+
+class FakeCompletions:
+    """代替client.chat.completions：按顺序返回outcomes中的响应，异常则直接抛出"""
+
+    def __init__(self):
+        self.outcomes = []
+        self.requests = []
+
+    def create(self, **request):
+        self.requests.append(request)
+        outcome = self.outcomes.pop(0) if self.outcomes else make_response()
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+def api_error(error_class, status_code, headers=None):
+    response = httpx.Response(status_code, headers=headers, request=httpx.Request("POST", "http://fake/v1/chat/completions"))
+    return error_class(f"status {status_code}", response=response, body=None)
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    # 限流器、服务池和缓存都是进程内共享的，每个测试使用各自的实例
+    monkeypatch.setattr(utils, "_rate_limiters", {})
+    monkeypatch.setattr(utils, "_endpoint_pools", {})
+    monkeypatch.setattr(utils, "_caches", {})
+    completions = FakeCompletions()
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    monkeypatch.setattr(utils, "get_client", lambda config=None: client)
+    return completions
+
+def make_pool(*names):
+    return EndpointPool([Endpoint(name, "sk-test") for name in names], failure_threshold=2, eject_seconds=30)
+
+def test_prompt_estimate_uses_batch_estimator():
+    messages = [{"role": "system", "content": "你是助手。Follow the rules."}, {"role": "user", "content": None}]
+    expected = estimate_tokens("你是助手。Follow the rules.") + 2 * utils.MESSAGE_OVERHEAD_TOKENS
+    assert utils.estimate_prompt_tokens(messages) == expected
+
+def test_cache_evicts_least_recently_used(tmp_path, clock):
+    cache = utils.LLMResponseCache(str(tmp_path), max_bytes=250)
+    value = {"content": "x" * 100}
+    cache.set("a", value)
+    clock.sleep(1)
+    cache.set("b", value)
+    clock.sleep(1)
+    # 读取a后，b成为最久未使用的条目
+    assert cache.get("a") == value
+    clock.sleep(1)
+    cache.set("c", value)
+    assert cache.get("b") is None
+    assert cache.get("a") == value and cache.get("c") == value
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["entries"] == 2
+
+def test_call_llm_serves_repeated_request_from_cache(tmp_path, fake_client):
+    config = {"BASE_URL": "primary", "CACHE_DIR": str(tmp_path)}
+    messages = [{"role": "user", "content": "你好"}]
+    first = utils.call_llm(messages, config=config)
+    second = utils.call_llm(messages, config=config)
+    assert second.choices[0].message.content == first.choices[0].message.content
+    assert len(fake_client.requests) == 1
+    # 参数不同的请求不命中缓存
+    utils.call_llm(messages, config=config, max_tokens=10)
+    assert len(fake_client.requests) == 2
+
+def test_rate_limiter_blocks_when_rpm_exhausted(clock):
+    limiter = RateLimiter(rpm=2)
+    assert limiter.acquire(0) == 0.0
+    assert limiter.acquire(0) == 0.0
+    # 每分钟2个请求，补充1个请求需要30秒
+    assert limiter.acquire(0) == pytest.approx(30.0)
+    assert clock.sleeps == [pytest.approx(30.0)]
+
+def test_rate_limiter_blocks_when_tpm_exhausted(clock):
+    limiter = RateLimiter(tpm=600)
+    assert limiter.acquire(600) == 0.0
+    assert not limiter.try_acquire(300)
+    assert limiter.acquire(300) == pytest.approx(30.0)
+
+def test_rate_limiter_oversized_request_waits_for_full_bucket(clock):
+    limiter = RateLimiter(tpm=600)
+    limiter.acquire(100)
+    # 超过容量的请求只需等桶装满，不会永远阻塞
+    assert limiter.acquire(1000) == pytest.approx(10.0)
+    assert limiter.token_bucket.tokens == pytest.approx(0.0)
+
+def test_rate_limiter_refund_restores_budget(clock):
+    limiter = RateLimiter(tpm=600)
+    limiter.acquire(600)
+    limiter.adjust(-300)
+    assert limiter.try_acquire(300)
+    # 退还不会超过容量
+    limiter.adjust(-10000)
+    assert limiter.token_bucket.tokens == 600
+
+def test_call_llm_retries_rate_limited_request(clock, fake_client):
+    fake_client.outcomes = [api_error(RateLimitError, 429, {"retry-after": "2"}), make_response()]
+    config = {"BASE_URL": "primary", "CACHE_ENABLED": False, "RATE_LIMIT_TPM": 6000, "MAX_RETRIES": 2}
+    with utils.telemetry_scope() as records:
+        response = utils.call_llm([{"role": "user", "content": "你好"}], config=config)
+    assert response.choices[0].message.content == "ok"
+    assert clock.sleeps == [2.0]
+    assert records[0]["retries"] == 1
+    # 失败的请求退还了预扣的预算，成功的请求按实际用量120个token计
+    assert utils.get_rate_limiter(config).token_bucket.tokens == pytest.approx(6000 - 120)
+
+def test_call_llm_gives_up_after_max_retries(clock, fake_client):
+    fake_client.outcomes = [api_error(RateLimitError, 429) for _ in range(3)]
+    config = {"BASE_URL": "primary", "CACHE_ENABLED": False, "RATE_LIMIT_TPM": 6000, "MAX_RETRIES": 2}
+    with utils.telemetry_scope() as records:
+        assert utils.call_llm([{"role": "user", "content": "你好"}], config=config) is None
+    assert len(fake_client.requests) == 3
+    assert records[0]["outcome"] == "error"
+    assert utils.get_rate_limiter(config).token_bucket.tokens == pytest.approx(6000)
+
+def test_call_llm_does_not_retry_bad_request(clock, fake_client):
+    fake_client.outcomes = [api_error(BadRequestError, 400)]
+    config = {"BASE_URL": "primary", "CACHE_ENABLED": False, "MAX_RETRIES": 2}
+    assert utils.call_llm([{"role": "user", "content": "你好"}], config=config) is None
+    assert len(fake_client.requests) == 1
+    assert clock.sleeps == []
+
+def test_endpoint_ejected_after_consecutive_failures_and_recovers(clock):
+    pool = make_pool("a", "b")
+    a, b = pool.endpoints
+    for _ in range(2):
+        pool.release(pool.acquire(exclude=[b]), False)
+    assert a.ejections == 1
+    # 摘除期间只选择b
+    assert pool.acquire() is b
+    pool.release(b, True)
+    clock.sleep(30)
+    assert pool.acquire(exclude=[b]) is a
+
+def test_endpoint_success_resets_failure_count(clock):
+    pool = make_pool("a")
+    a = pool.endpoints[0]
+    for success in (False, True, False):
+        pool.release(pool.acquire(), success)
+    assert a.ejections == 0
+    assert a.consecutive_failures == 1
+
+def test_all_endpoints_ejected_uses_earliest_recovery(clock):
+    pool = make_pool("a", "b")
+    a, b = pool.endpoints
+    for endpoint in (b, a):
+        for _ in range(2):
+            endpoint.in_flight += 1
+            pool.release(endpoint, False)
+        clock.sleep(1)
+    assert pool.acquire() is b
+
+def test_endpoint_pool_respects_weight_and_concurrency(clock):
+    pool = EndpointPool([Endpoint("a", "sk-test", weight=2, max_concurrency=2), Endpoint("b", "sk-test", max_concurrency=1)])
+    a, b = pool.endpoints
+    acquired = [pool.acquire() for _ in range(3)]
+    assert sorted(endpoint.base_url for endpoint in acquired) == ["a", "a", "b"]
+    # 所有服务都达到并发上限
+    assert pool.try_acquire() is None
+    pool.release(b, True)
+    assert pool.try_acquire() is b
+
+def test_call_llm_retries_on_another_endpoint(clock, fake_client):
+    fake_client.outcomes = [api_error(InternalServerError, 503), make_response()]
+    config = {"ENDPOINTS": [{"BASE_URL": "a"}, {"BASE_URL": "b"}], "CACHE_ENABLED": False, "RETRY_BASE_DELAY": 0}
+    with utils.telemetry_scope() as records:
+        assert utils.call_llm([{"role": "user", "content": "你好"}], config=config) is not None
+    failed = next(stats for stats in utils.get_endpoint_stats() if stats["failures"])
+    assert records[0]["endpoint"] != failed["base_url"]
+
+class FakeSender:
+    """代替send_to_endpoint：每个服务的请求先等待各自的Event再返回响应或抛出异常，并像真实请求一样释放服务名额"""
+
+    def __init__(self, monkeypatch, outcomes):
+        self.outcomes = outcomes
+        self.gates = {name: threading.Event() for name in outcomes}
+        self.started = {name: threading.Event() for name in outcomes}
+        self.finished = {name: threading.Event() for name in outcomes}
+        monkeypatch.setattr(utils, "send_to_endpoint", self.send)
+
+    def send(self, pool, endpoint, config, request, on_delta=None, record=None):
+        name = endpoint.base_url
+        self.started[name].set()
+        self.gates[name].wait(5)
+        outcome = self.outcomes[name]
+        try:
+            pool.release(endpoint, not isinstance(outcome, Exception))
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        finally:
+            self.finished[name].set()
+
+@pytest.fixture
+def hedging(monkeypatch):
+    utils.reset_telemetry()
+    yield
+    utils.reset_telemetry()
+
+def test_no_hedge_when_primary_returns_in_time(clock, hedging, monkeypatch):
+    sender = FakeSender(monkeypatch, {"primary": make_response("primary")})
+    sender.gates["primary"].set()
+    pool = make_pool("primary", "backup")
+    limiter = RateLimiter(tpm=6000)
+    record = {}
+    response, winner = utils.send_hedged(pool, limiter, pool.acquire(), {}, {}, 5, 1000, record)
+    assert winner.base_url == "primary"
+    assert "hedged" not in record
+    assert utils.get_hedge_stats()["fired"] == 0
+    assert limiter.token_bucket.tokens == 6000
+
+def test_hedge_wins_when_primary_is_slow(clock, hedging, monkeypatch):
+    sender = FakeSender(monkeypatch, {"primary": make_response("primary"), "backup": make_response("backup")})
+    sender.gates["backup"].set()
+    pool = make_pool("primary", "backup")
+    primary = pool.acquire()
+    record = {}
+    response, winner = utils.send_hedged(pool, RateLimiter(tpm=6000), primary, {}, {}, 0.01, 1000, record)
+    assert response.choices[0].message.content == "backup"
+    assert record["hedged"] and record["hedge_won"]
+    stats = utils.get_hedge_stats()
+    assert (stats["fired"], stats["hedge_wins"]) == (1, 1)
+    # 落败的主请求结束后结果被丢弃，服务名额照常释放
+    sender.gates["primary"].set()
+    assert sender.finished["primary"].wait(5)
+    assert primary.in_flight == 0
+
+def test_losing_hedge_refunds_its_estimate(clock, hedging, monkeypatch):
+    sender = FakeSender(monkeypatch, {"primary": make_response("primary"), "backup": make_response("backup")})
+    pool = make_pool("primary", "backup")
+    limiter = RateLimiter(tpm=6000)
+    limiter.acquire(1000)
+    record = {}
+
+    def release_primary_after_hedge():
+        sender.started["backup"].wait(5)
+        sender.gates["primary"].set()
+    threading.Thread(target=release_primary_after_hedge).start()
+    response, winner = utils.send_hedged(pool, limiter, pool.acquire(), {}, {}, 0.01, 1000, record)
+    assert winner.base_url == "primary"
+    assert record["hedged"] and "hedge_won" not in record
+    # 只剩主请求预扣的1000
+    assert limiter.token_bucket.tokens == 5000
+    sender.gates["backup"].set()
+
+def test_no_hedge_without_rate_limit_budget(clock, hedging, monkeypatch):
+    sender = FakeSender(monkeypatch, {"primary": make_response("primary"), "backup": make_response("backup")})
+    pool = make_pool("primary", "backup")
+    limiter = RateLimiter(tpm=1000)
+    limiter.acquire(1000)
+    threading.Timer(0.05, sender.gates["primary"].set).start()
+    record = {}
+    response, winner = utils.send_hedged(pool, limiter, pool.acquire(), {}, {}, 0.01, 1000, record)
+    assert winner.base_url == "primary"
+    assert "hedged" not in record
+    assert not sender.started["backup"].is_set()
+
+def test_hedge_refunds_both_attempts_when_both_fail(clock, hedging, monkeypatch):
+    sender = FakeSender(monkeypatch, {"primary": RuntimeError("primary failed"), "backup": RuntimeError("backup failed")})
+    pool = make_pool("primary", "backup")
+    limiter = RateLimiter(tpm=6000)
+    limiter.acquire(1000)
+
+    def fail_primary_after_hedge():
+        sender.started["backup"].wait(5)
+        sender.gates["backup"].set()
+        sender.finished["backup"].wait(5)
+        sender.gates["primary"].set()
+    threading.Thread(target=fail_primary_after_hedge).start()
+    with pytest.raises(RuntimeError):
+        utils.send_hedged(pool, limiter, pool.acquire(), {}, {}, 0.01, 1000, {})
+    # 对冲请求预扣的部分已退还，剩下主请求的1000由call_llm退还
+    assert limiter.token_bucket.tokens == 5000
+
+def test_reset_telemetry_clears_hedge_stats():
+    with utils._hedge_lock:
+        utils._hedge_stats["fired"] += 1
+        utils._hedge_latencies["actual"].append(1.0)
+    utils.reset_telemetry()
+    stats = utils.get_hedge_stats()
+    assert stats["fired"] == 0
+    assert stats["p99_with_hedging"] == 0.0
+    assert utils._hedge_latencies["actual"].maxlen == utils.HEDGE_STATS_WINDOW
@@ -1,4 +1,104 @@
 import re
+from typing import Iterable, Iterator, List, Tuple
+
+# 句末标点（可以连续出现），后面可以跟一个右引号、右括号或">"
+_SENTENCE_END_PATTERN = re.compile(r'[。！？\.\!\?]+[\"\'"\'"\)\)\>\>]?')
+# 连续3个以上的点或中文句号压缩为3个
+_DOTS_PATTERN = re.compile(r'\.{3,}')
+_CHINESE_DOTS_PATTERN = re.compile(r'。{3,}')
+
+def _normalize_ellipsis(sentence: str) -> str:
+    """把句子中过长的省略号压缩为3个点，与原先先改写全文再分句的结果一致"""
+    sentence = _DOTS_PATTERN.sub('...', sentence)
+    return _CHINESE_DOTS_PATTERN.sub('。。。', sentence)
+
+def iter_sentences(text: str) -> Iterator[Tuple[str, int, int]]:
+    """
+    逐个产出文本中的句子，适合流式处理很长的转录文本
+
+    只扫描一遍原文，不改写全文。省略号整体属于句末标点，压缩只作用在所在句子内，
+    因此句子内容和划分位置与原先的实现（split_text_into_sentences_legacy）完全一致。
+
+    参数:
+        text (str): 输入文本
+
+    产出:
+        (sentence, start, end): 句子内容（去掉首尾空白、压缩省略号），以及句子在原文中的[start, end)字符区间
+    """
+    if not text:
+        return
+    # 整段文本没有过长的省略号时跳过逐句压缩
+    normalize = '....' in text or '。。。。' in text
+    start_pos = 0
+    for match in _SENTENCE_END_PATTERN.finditer(text):
+        end_pos = match.end()
+        raw = text[start_pos:end_pos]
+        sentence = raw.strip()
+        if sentence:
+            # 句末是标点，只有开头可能有空白
+            start = end_pos - len(sentence)
+            yield (_normalize_ellipsis(sentence) if normalize else sentence), start, end_pos
+        start_pos = end_pos
+
+    if start_pos == 0:
+        # 没有句末标点时整段文本作为一个句子
+        yield text, 0, len(text)
+    elif start_pos < len(text):
+        last_part = text[start_pos:].strip()
+        if last_part:
+            start = text.index(last_part, start_pos)
+            yield (_normalize_ellipsis(last_part) if normalize else last_part), start, start + len(last_part)
+
+def iter_sentences_from_chunks(chunks: Iterable[str]) -> Iterator[Tuple[str, int, int]]:
+    """
+    从按块到达的文本中逐个产出句子，结果与iter_sentences("".join(chunks))完全一致
+
+    只保留尚未结束的最后一个句子，已产出的部分不再扫描，适合边读取边分句的超长文件。
+    """
+    buffer = ""
+    base = 0  # buffer在整段文本中的起始偏移
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffer += chunk
+        start_pos = 0
+        for match in _SENTENCE_END_PATTERN.finditer(buffer):
+            end_pos = match.end()
+            # 标点可能在下一块中继续
+            if end_pos == len(buffer):
+                break
+            sentence = buffer[start_pos:end_pos].strip()
+            if sentence:
+                if '....' in sentence or '。。。。' in sentence:
+                    sentence_text = _normalize_ellipsis(sentence)
+                else:
+                    sentence_text = sentence
+                yield sentence_text, base + end_pos - len(sentence), base + end_pos
+            start_pos = end_pos
+        buffer = buffer[start_pos:]
+        base += start_pos
+
+    if base == 0:
+        # 整段文本都还在buffer中
+        yield from iter_sentences(buffer)
+        return
+    for sentence, start, end in iter_sentences(buffer):
+        stripped = sentence.strip()
+        if stripped == sentence:
+            yield sentence, base + start, base + end
+        elif stripped:
+            # 前面已经有句子时，剩余的无标点部分按最后一部分处理，要去掉首尾空白
+            start += sentence.index(stripped)
+            yield stripped, base + start, base + start + len(stripped)
+
+def split_text_with_spans(text: str) -> Tuple[List[str], List[Tuple[int, int]]]:
+    """将文本划分为句子，返回(句子列表, 每个句子在原文中的[start, end)区间列表)"""
+    sentences = []
+    spans = []
+    for sentence, start, end in iter_sentences(text):
+        sentences.append(sentence)
+        spans.append((start, end))
+    return sentences, spans
 
 def split_text_into_sentences(text):
     """
@@ -10,16 +110,17 @@ def split_text_into_sentences(text):
     返回:
         tuple: (sentences_list, indices_list)
             - sentences_list: 划分好的句子列表
-            - indices_list: 每个句子结束位置在原文中的索引列表
+            - indices_list: 每个句子最后一个字符在原文中的索引列表
     """
-    # 中文句末标点: 。！？…
-    # 英文句末标点: .!?
-    # 考虑省略号: ... 或 。。。
-    # 考虑引号后的句末标点
-    
-    # 匹配句子结束的模式
-    sentence_end_pattern = r'(?<=[。！？\.\!\?])[^。！？\.\!\?]*(?=[。！？\.\!\?])|(?<=[\.\!\?])\s+'
-    
+    sentences, spans = split_text_with_spans(text)
+    indices = [end - 1 for _, end in spans]
+    if spans and _SENTENCE_END_PATTERN.search(text, spans[-1][0]) is None:
+        # 与原先的实现一致：没有句末标点的最后一部分，索引指向文本末尾（包括末尾的空白）
+        indices[-1] = len(text) - 1
+    return sentences, indices
+
+def split_text_into_sentences_legacy(text):
+    """原先先改写省略号再分句的实现，返回的索引指向改写后的文本，仅用于性能和一致性对比"""
     # 特殊处理省略号
     text = re.sub(r'\.{3,}', '...', text)  # 将连续3个以上的点替换为3个点
     text = re.sub(r'。{3,}', '。。。', text)  # 将连续3个以上的中文点替换为3个点
@@ -0,0 +1,164 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+from typing import List, Optional
+
+from utils import content_hash
+
+try:
+    import numpy as np
+except ImportError:  # numpy不可用时退回到逐句正则估算
+    np = None
+
+# tokenizer单次批量编码的句子数，避免超长文件一次性占用过多内存
+ENCODE_BATCH_SIZE = 4096
+
+def estimate_tokens(text: str) -> int:
+    """估算token数量，当tokenizer不可用时使用"""
+    # 中文字符大约是1个token，英文单词大约是1.3个token
+    chinese_chars = len(re.findall(r'[\u4e00-\u9fff]', text))
+    english_words = len(re.findall(r'[a-zA-Z]+', text))
+    return chinese_chars + int(english_words * 1.3)
+
+def estimate_tokens_batch(texts: List[str]) -> List[int]:
+    """
+    批量估算token数量，结果与逐句调用estimate_tokens一致
+
+    把所有句子拼接后转成码点数组，用向量运算统计每句的中文字符数和英文单词数。
+    """
+    if np is None or not texts:
+        return [estimate_tokens(text) for text in texts]
+
+    lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    codepoints = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32)
+
+    chinese = (codepoints >= 0x4e00) & (codepoints <= 0x9fff)
+    letters = ((codepoints >= 0x41) & (codepoints <= 0x5a)) | ((codepoints >= 0x61) & (codepoints <= 0x7a))
+    # 单词起点：当前是字母且前一个字符不是字母，每句的第一个字符都视为新的起点
+    previous_letter = np.zeros_like(letters)
+    previous_letter[1:] = letters[:-1]
+    previous_letter[starts[starts < len(codepoints)]] = False
+    word_starts = letters & ~previous_letter
+
+    def per_text(mask):
+        cumulative = np.concatenate(([0], np.cumsum(mask, dtype=np.int64)))
+        return cumulative[ends] - cumulative[starts]
+
+    english_words = per_text(word_starts)
+    counts = per_text(chinese) + (english_words * 1.3).astype(np.int64)
+    return counts.tolist()
+
+class TokenCounter:
+    """
+    句子token计数器
+
+    tokenizer可用时一次批量编码文件中的所有句子，否则使用向量化的字符估算。
+    计数结果按句子内容的哈希缓存在SQLite中，同一文件重新处理时不必重新分词。
+    同一个实例可以在多个线程间共享。
+    """
+
+    def __init__(self, tokenizer=None, name: str = "estimate", cache_dir: Optional[str] = None):
+        """
+        Args:
+            tokenizer: 用于分词的tokenizer，为None时按字符数估算
+            name: 计数方式的名称（如模型路径），作为缓存键的一部分
+            cache_dir: 计数缓存目录，为None时不缓存
+        """
+        self.tokenizer = tokenizer
+        self.name = name if tokenizer else "estimate"
+        self.hits = 0
+        self.misses = 0
+        self.count_seconds = 0.0
+        self._tokenizer_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._conn = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(cache_dir, "token_counts.sqlite"), timeout=30,
+                                         check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS token_counts (key TEXT PRIMARY KEY, counts TEXT NOT NULL)")
+            self._conn.commit()
+
+    def count(self, text: str) -> int:
+        """计算单段文本的token数量"""
+        if self.tokenizer:
+            with self._tokenizer_lock:
+                return len(self.tokenizer.encode(text))
+        return estimate_tokens(text)
+
+    def _encode_lengths(self, sentences: List[str]) -> List[int]:
+        """批量编码句子，返回每句的token数"""
+        if not getattr(self.tokenizer, "is_fast", False):
+            # 慢速tokenizer不支持真正的批量编码，逐句处理
+            with self._tokenizer_lock:
+                return [len(self.tokenizer.encode(sentence)) for sentence in sentences]
+        counts = []
+        for i in range(0, len(sentences), ENCODE_BATCH_SIZE):
+            with self._tokenizer_lock:
+                encoded = self.tokenizer(sentences[i:i + ENCODE_BATCH_SIZE], return_attention_mask=False)
+            counts.extend(len(ids) for ids in encoded["input_ids"])
+        return counts
+
+    def count_sentences(self, sentences: List[str]) -> List[int]:
+        """
+        计算一组句子各自的token数量
+
+        Args:
+            sentences: 同一文件分割出的句子
+        Returns:
+            与sentences一一对应的token数
+        """
+        start_time = time.perf_counter()
+        key = content_hash(self.name + "\n" + "\x1e".join(sentences))
+        if self._conn is not None:
+            with self._lock:
+                row = self._conn.execute("SELECT counts FROM token_counts WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                counts = json.loads(row[0])
+                with self._lock:
+                    self.hits += 1
+                    self.count_seconds += time.perf_counter() - start_time
+                return counts
+
+        if self.tokenizer:
+            counts = self._encode_lengths(sentences)
+        else:
+            counts = estimate_tokens_batch(sentences)
+
+        if self._conn is not None:
+            with self._lock:
+                self.misses += 1
+                self._conn.execute("INSERT OR REPLACE INTO token_counts (key, counts) VALUES (?, ?)",
+                                   (key, json.dumps(counts)))
+                self._conn.commit()
+        with self._lock:
+            self.count_seconds += time.perf_counter() - start_time
+        return counts
+
+    def merge_stats(self, stats):
+        """并入其他进程中计数器的统计"""
+        with self._lock:
+            self.hits += stats.get("cache_hits", 0)
+            self.misses += stats.get("cache_misses", 0)
+            self.count_seconds += stats.get("count_seconds", 0.0)
+
+    def stats(self):
+        """返回缓存命中和计数耗时统计"""
+        return {
+            "counter": self.name,
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "count_seconds": round(self.count_seconds, 3)
+        }
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+                self._conn = None
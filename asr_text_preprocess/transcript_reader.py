@@ -0,0 +1,92 @@
+import os
+import mmap
+import codecs
+import random
+from typing import Iterator, Optional
+
+from text2sentence import iter_sentences
+from token_counter import estimate_tokens
+
+# 每次从文件中解码的字节数
+READ_CHUNK_BYTES = 1024 * 1024
+# 采样窗口按每个token约3字节（一个汉字的UTF-8长度）估算读取量，再留一倍余量
+BYTES_PER_TOKEN = 3
+
+def iter_text_chunks(path: str, chunk_bytes: int = READ_CHUNK_BYTES, strip: bool = False) -> Iterator[str]:
+    """
+    按块读取UTF-8文本文件，逐块产出解码后的文本
+
+    文件通过mmap映射，每次只解码chunk_bytes字节；跨块的多字节字符由增量解码器拼接，不会被截断。
+    strip为True时去掉整个文本首尾的空白，所有块拼接起来与f.read().strip()完全一致。
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    leading = strip
+    pending = ""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for offset in range(0, size, chunk_bytes):
+            chunk = decoder.decode(mapped[offset:offset + chunk_bytes], final=offset + chunk_bytes >= size)
+            if not strip:
+                if chunk:
+                    yield chunk
+                continue
+            if leading:
+                chunk = chunk.lstrip()
+                if not chunk:
+                    continue
+                leading = False
+            # 块末尾的空白先保留，后面还有内容时再产出，到文件末尾时丢弃
+            body = chunk.rstrip()
+            if body:
+                yield pending + body
+                pending = chunk[len(body):]
+            else:
+                pending += chunk
+
+def sample_text_window(path: str, max_tokens: int, seed: Optional[str] = None) -> str:
+    """
+    从文件中取一段不超过max_tokens的连续文本，用于总结分割规则
+
+    文件估算的token数不超过上限时返回完整文本；否则只映射并解码一个窗口，从随机位置后的第一个完整句子开始，
+    按句子累加到token上限，返回这段原文。起始位置由seed（默认为文件路径）决定，同一文件每次取到相同的窗口，
+    重新运行时可以命中LLM响应缓存。
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return ""
+    window_bytes = max_tokens * BYTES_PER_TOKEN * 2
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if size <= window_bytes:
+            offset = 0
+            data = mapped[:]
+        else:
+            offset = random.Random(seed if seed is not None else str(path)).randrange(size - window_bytes)
+            # 跳过多字节字符的后续字节，从一个完整字符开始解码
+            while offset < size and mapped[offset] & 0xC0 == 0x80:
+                offset += 1
+            data = mapped[offset:offset + window_bytes]
+    # 未结束的增量解码会丢弃末尾不完整的字符
+    text = codecs.getincrementaldecoder("utf-8")().decode(data, final=offset + len(data) >= size)
+    if offset == 0 and estimate_tokens(text) <= max_tokens and offset + len(data) >= size:
+        return text
+
+    window_start = None
+    window_end = 0
+    total_tokens = 0
+    for index, (sentence, start, end) in enumerate(iter_sentences(text)):
+        # 从中间开始时第一个句子通常不完整
+        if offset > 0 and index == 0:
+            continue
+        sentence_tokens = estimate_tokens(sentence)
+        if window_start is not None and total_tokens + sentence_tokens > max_tokens:
+            break
+        if window_start is None:
+            window_start = start
+        window_end = end
+        total_tokens += sentence_tokens
+    if window_start is None:
+        # 窗口内没有完整的句子时按字符截断，汉字大约一个字一个token
+        return text.strip()[:max_tokens]
+    return text[window_start:window_end]
@@ -1,79 +1,981 @@
 import os
 import random
-import re
 import json
+import time
+import hashlib
+import sqlite3
+import threading
+import contextvars
 import yaml
+from collections import deque
+from concurrent.futures import Future, wait, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError
 from pathlib import Path
 from datetime import datetime
-from openai import OpenAI
+import httpx
+from openai import OpenAI, DefaultHttpxClient, APIConnectionError, APIStatusError
+from openai.types.chat import ChatCompletion
+from contextlib import contextmanager
 from typing import List
 
+# 已解析的配置，按配置文件路径缓存，文件修改时间变化时重新加载
+_config_cache = {}
+_config_lock = threading.Lock()
+
 def load_config(config_path="./llm_api_config.yaml"):
-    """从YAML文件加载配置"""
+    """
+    从YAML文件加载配置
+    
+    解析结果按文件修改时间缓存，只有配置文件被修改后才会重新读取。
+    返回的字典在调用之间共享，调用方不应修改它。
+    """
     try:
-        with open(config_path, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
+        mtime = os.path.getmtime(config_path)
+    except OSError:
+        mtime = None
+    
+    with _config_lock:
+        cached = _config_cache.get(config_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        
+        try:
+            with open(config_path, 'r', encoding='utf-8') as f:
+                config = yaml.safe_load(f)
+        except FileNotFoundError:
+            print(f"警告: 配置文件 {config_path} 不存在，将使用默认配置")
+            config = {
+                "BASE_URL": "",
+                "DEFAULT_MODEL": "deepseek-r1",
+                "REQUEST_TIMEOUT": 1000,
+                "TEMPERATURE": 0.0,
+                "MAX_TOKENS": 8192,
+                "API_KEY": "sk-demo-key",  # 默认值，实际使用时应替换
+                "CACHE_ENABLED": True,
+                "CACHE_DIR": "./.llm_cache",
+                "CACHE_MAX_MB": 1024,
+                "MAX_CONNECTIONS": 100,
+                "MAX_KEEPALIVE_CONNECTIONS": 20,
+                "KEEPALIVE_EXPIRY": 60,
+                "RATE_LIMIT_RPM": 0,  # 每分钟请求数上限，0表示不限制
+                "RATE_LIMIT_TPM": 0,  # 每分钟token数上限，0表示不限制
+                "MAX_RETRIES": 5,
+                "RETRY_BASE_DELAY": 1.0,
+                "RETRY_MAX_DELAY": 60.0,
+                # 多个OpenAI兼容服务时配置ENDPOINTS列表，每项可包含BASE_URL/API_KEY/WEIGHT/MAX_CONCURRENCY/MODEL
+                "ENDPOINTS": [],
+                "ENDPOINT_FAILURE_THRESHOLD": 3,  # 连续失败多少次后暂时摘除该服务
+                "ENDPOINT_EJECT_SECONDS": 30,
+                # 对冲请求：调用超过近期延迟的HEDGE_PERCENTILE分位数仍未返回时，再发一份相同的请求
+                "HEDGE_ENABLED": False,
+                "HEDGE_PERCENTILE": 95,
+                "HEDGE_MIN_SAMPLES": 20,
+                "HEDGE_MIN_DELAY": 5.0,
+                "HEDGE_WINDOW": 200
+            }
+        except Exception as e:
+            print(f"加载配置文件时出错: {e}")
+            return {}
+        
+        _config_cache[config_path] = (mtime, config)
         return config
-    except FileNotFoundError:
-        print(f"警告: 配置文件 {config_path} 不存在，将使用默认配置")
+
+# 客户端注册表：每个(base_url, api_key)只保留一个带连接池的客户端，复用keep-alive连接
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(config=None):
+    """获取或初始化OpenAI客户端，相同的服务地址和密钥共享同一个客户端"""
+    # 如果没有提供配置，从YAML加载
+    if config is None:
+        config = load_config()
+    
+    base_url = config.get("BASE_URL", "")
+    api_key = config.get("API_KEY", "sk-demo-key")
+    key = (base_url, api_key)
+    
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            limits = httpx.Limits(
+                max_connections=config.get("MAX_CONNECTIONS", 100),
+                max_keepalive_connections=config.get("MAX_KEEPALIVE_CONNECTIONS", 20),
+                keepalive_expiry=config.get("KEEPALIVE_EXPIRY", 60)
+            )
+            client = OpenAI(
+                base_url=base_url,
+                api_key=api_key,
+                timeout=config.get("REQUEST_TIMEOUT", 1000),
+                max_retries=0,  # 重试由call_llm统一控制，配合限流器退避
+                http_client=DefaultHttpxClient(limits=limits)
+            )
+            _clients[key] = client
+    
+    return client
+
+def close_clients():
+    """关闭所有已创建的客户端，释放连接池"""
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+class LLMResponseCache:
+    """
+    持久化的LLM响应缓存，以请求内容的哈希为键，存储在SQLite中
+    
+    缓存总大小超过上限时，按最近访问时间淘汰最久未使用的条目（LRU）。
+    同一个缓存实例可以在多个线程间共享。
+    """
+    
+    def __init__(self, cache_dir="./.llm_cache", max_bytes=1024 * 1024 * 1024):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "responses.sqlite")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+        self._conn.commit()
+    
+    @staticmethod
+    def make_key(model, messages, temperature, max_tokens, n=1, seed=None):
+        """根据模型、消息、温度、最大token数以及候选数和随机种子计算缓存键"""
+        request = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+        # 只在使用时加入，保持单候选请求原有的缓存键不变
+        if n != 1:
+            request["n"] = n
+        if seed is not None:
+            request["seed"] = seed
+        payload = json.dumps(request, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def get(self, key):
+        """读取缓存，命中时返回响应的字典形式，否则返回None"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return json.loads(row[0])
+    
+    def set(self, key, value):
+        """写入缓存，并在超出容量时淘汰最久未使用的条目"""
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, data, size, time.time())
+            )
+            self.writes += 1
+            self._evict()
+            self._conn.commit()
+    
+    def _evict(self):
+        """淘汰最久未使用的条目，直到总大小不超过上限（调用方需持有锁）"""
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+    
+    def stats(self):
+        """返回缓存命中统计"""
+        with self._lock:
+            entries, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
         return {
-            "BASE_URL": "",
-            "DEFAULT_MODEL": "deepseek-r1",
-            "REQUEST_TIMEOUT": 1000,
-            "TEMPERATURE": 0.0,
-            "API_KEY": "sk-demo-key"  # 默认值，实际使用时应替换
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size_bytes": total
         }
+
+# 按缓存目录共享的缓存实例
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(config):
+    """根据配置获取响应缓存实例，未启用缓存时返回None"""
+    if not config.get("CACHE_ENABLED", True):
+        return None
+    cache_dir = config.get("CACHE_DIR", "./.llm_cache")
+    with _caches_lock:
+        if cache_dir not in _caches:
+            max_bytes = int(config.get("CACHE_MAX_MB", 1024) * 1024 * 1024)
+            _caches[cache_dir] = LLMResponseCache(cache_dir, max_bytes)
+        return _caches[cache_dir]
+
+def get_cache_stats():
+    """汇总当前进程中所有响应缓存的命中统计"""
+    with _caches_lock:
+        caches = list(_caches.values())
+    stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+    for cache in caches:
+        cache_stats = cache.stats()
+        for key in stats:
+            stats[key] += cache_stats[key]
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+    return stats
+
+class TokenBucket:
+    """令牌桶，容量为每分钟的预算，按秒匀速补充"""
+    
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+    
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, amount):
+        """返回桶中攒够amount个令牌还需要等待的秒数"""
+        amount = min(amount, self.capacity)  # 超过容量的请求只需等桶装满
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+class RateLimiter:
+    """
+    客户端限流器，同时限制每分钟请求数(RPM)和每分钟token数(TPM)
+    
+    发送前按估算的prompt token数预扣TPM预算，收到响应后再按实际用量修正。
+    预算为0表示不限制对应维度。
+    """
+    
+    def __init__(self, rpm=0, tpm=0):
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+        self._lock = threading.Lock()
+    
+    def acquire(self, tokens):
+        """阻塞直到预算允许发送一个约tokens大小的请求，返回等待的秒数"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                wait = 0.0
+                for bucket, amount in ((self.request_bucket, 1), (self.token_bucket, tokens)):
+                    if bucket is not None:
+                        bucket.refill()
+                        wait = max(wait, bucket.wait_time(amount))
+                if wait == 0.0:
+                    if self.request_bucket is not None:
+                        self.request_bucket.tokens -= 1
+                    if self.token_bucket is not None:
+                        self.token_bucket.tokens -= min(tokens, self.token_bucket.capacity)
+                    return waited
+            time.sleep(wait)
+            waited += wait
+    
+    def try_acquire(self, tokens):
+        """预算足够时立即占用并返回True，否则不等待直接返回False"""
+        with self._lock:
+            for bucket, amount in ((self.request_bucket, 1), (self.token_bucket, tokens)):
+                if bucket is not None:
+                    bucket.refill()
+                    if bucket.wait_time(amount) > 0:
+                        return False
+            if self.request_bucket is not None:
+                self.request_bucket.tokens -= 1
+            if self.token_bucket is not None:
+                self.token_bucket.tokens -= min(tokens, self.token_bucket.capacity)
+            return True
+    
+    def adjust(self, delta):
+        """按实际token用量修正预扣的TPM预算，delta为负时退还"""
+        if self.token_bucket is None or not delta:
+            return
+        with self._lock:
+            self.token_bucket.refill()
+            self.token_bucket.tokens = min(self.token_bucket.capacity, self.token_bucket.tokens - delta)
+
+# 进程内共享的限流器，所有线程的调用共用同一份预算
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(config):
+    """根据配置中的RATE_LIMIT_RPM/RATE_LIMIT_TPM获取共享的限流器"""
+    key = (config.get("RATE_LIMIT_RPM", 0) or 0, config.get("RATE_LIMIT_TPM", 0) or 0)
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter(*key)
+        return _rate_limiters[key]
+
+# 每条消息的角色标记等额外token
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def estimate_prompt_tokens(messages):
+    """估算消息列表的token数，与分批时使用同一个估算函数，限流器和分批对请求大小的估计一致"""
+    # token_counter导入了utils，在这里导入避免循环导入
+    from token_counter import estimate_tokens
+    return sum(estimate_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+def is_retryable_error(error):
+    """判断调用失败是否值得重试：限流、超时、连接错误和服务端错误"""
+    if isinstance(error, APIConnectionError):  # 包括APITimeoutError
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+def retry_delay(error, attempt, base_delay=1.0, max_delay=60.0):
+    """计算第attempt次重试前的等待时间：优先服从Retry-After，否则使用带抖动的指数退避"""
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        try:
+            if retry_after is not None:
+                return min(float(retry_after), max_delay)
+        except ValueError:
+            pass
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+class Endpoint:
+    """一个OpenAI兼容服务的地址、权重、并发上限以及运行统计"""
+    
+    def __init__(self, base_url, api_key, weight=1.0, max_concurrency=0, model=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.weight = float(weight) if weight else 1.0
+        self.max_concurrency = max_concurrency or 0  # 0表示不限制
+        self.model = model
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.tokens = 0
+        self.latency_total = 0.0
+        self.first_start = None
+        self.last_finish = None
+    
+    def client_config(self, config):
+        """生成该服务使用的客户端配置"""
+        return dict(config, BASE_URL=self.base_url, API_KEY=self.api_key)
+    
+    def has_capacity(self):
+        return not self.max_concurrency or self.in_flight < self.max_concurrency
+    
+    def stats(self):
+        elapsed = (self.last_finish - self.first_start) if self.first_start and self.last_finish else 0.0
+        return {
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "max_concurrency": self.max_concurrency,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "in_flight": self.in_flight,
+            "tokens": self.tokens,
+            "avg_latency": round(self.latency_total / self.requests, 3) if self.requests else 0.0,
+            "requests_per_minute": round(self.requests * 60 / elapsed, 2) if elapsed else 0.0,
+            "tokens_per_second": round(self.tokens / elapsed, 2) if elapsed else 0.0
+        }
+
+class EndpointPool:
+    """
+    多个OpenAI兼容服务之间的负载均衡
+    
+    每次请求选择当前负载（进行中请求数/权重）最小的健康服务；达到并发上限的服务不参与选择，
+    所有服务都满载时阻塞等待。连续失败达到阈值的服务会被暂时摘除，冷却后自动恢复。
+    """
+    
+    def __init__(self, endpoints, failure_threshold=3, eject_seconds=30):
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.eject_seconds = eject_seconds
+        self._cond = threading.Condition()
+    
+    @classmethod
+    def from_config(cls, config):
+        endpoint_configs = config.get("ENDPOINTS") or [{}]
+        endpoints = [
+            Endpoint(
+                base_url=item.get("BASE_URL", config.get("BASE_URL", "")),
+                api_key=item.get("API_KEY", config.get("API_KEY", "sk-demo-key")),
+                weight=item.get("WEIGHT", 1.0),
+                max_concurrency=item.get("MAX_CONCURRENCY", 0),
+                model=item.get("MODEL")
+            )
+            for item in endpoint_configs
+        ]
+        return cls(endpoints, config.get("ENDPOINT_FAILURE_THRESHOLD", 3), config.get("ENDPOINT_EJECT_SECONDS", 30))
+    
+    def _select(self, exclude):
+        now = time.monotonic()
+        healthy = [e for e in self.endpoints if e.ejected_until <= now]
+        if not healthy:
+            # 所有服务都被摘除时，提前启用最早恢复的那个，避免请求全部卡住
+            healthy = [min(self.endpoints, key=lambda e: e.ejected_until)]
+        candidates = [e for e in healthy if e.has_capacity()]
+        # 重试时尽量换一个服务
+        preferred = [e for e in candidates if e not in exclude] or candidates
+        if not preferred:
+            return None
+        return min(preferred, key=lambda e: ((e.in_flight + 1) / e.weight, e.requests))
+    
+    def acquire(self, exclude=()):
+        """选择一个服务并占用它的一个并发名额"""
+        with self._cond:
+            while True:
+                endpoint = self._select(exclude)
+                if endpoint is not None:
+                    endpoint.in_flight += 1
+                    if endpoint.first_start is None:
+                        endpoint.first_start = time.monotonic()
+                    return endpoint
+                self._cond.wait()
+    
+    def try_acquire(self, exclude=()):
+        """不等待地占用一个服务，没有空闲名额时返回None"""
+        with self._cond:
+            endpoint = self._select(exclude)
+            if endpoint is not None:
+                endpoint.in_flight += 1
+                if endpoint.first_start is None:
+                    endpoint.first_start = time.monotonic()
+            return endpoint
+    
+    def release(self, endpoint, success, latency=0.0, tokens=0):
+        """释放并发名额并更新统计，连续失败达到阈值时摘除该服务"""
+        with self._cond:
+            endpoint.in_flight -= 1
+            endpoint.requests += 1
+            endpoint.latency_total += latency
+            endpoint.last_finish = time.monotonic()
+            if success:
+                endpoint.tokens += tokens
+                endpoint.consecutive_failures = 0
+            else:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.failure_threshold:
+                    endpoint.ejected_until = time.monotonic() + self.eject_seconds
+                    endpoint.ejections += 1
+                    endpoint.consecutive_failures = 0
+                    print(f"服务 {endpoint.base_url} 连续失败，暂时摘除 {self.eject_seconds} 秒")
+            self._cond.notify_all()
+    
+    def stats(self):
+        with self._cond:
+            return [endpoint.stats() for endpoint in self.endpoints]
+
+# 按服务列表共享的负载均衡池
+_endpoint_pools = {}
+_endpoint_pools_lock = threading.Lock()
+
+def get_endpoint_pool(config):
+    """根据配置获取共享的服务池，未配置ENDPOINTS时只包含BASE_URL一个服务"""
+    key = json.dumps(
+        [config.get("ENDPOINTS") or [], config.get("BASE_URL", ""), config.get("API_KEY", "")],
+        sort_keys=True
+    )
+    with _endpoint_pools_lock:
+        if key not in _endpoint_pools:
+            _endpoint_pools[key] = EndpointPool.from_config(config)
+        return _endpoint_pools[key]
+
+def get_endpoint_stats():
+    """返回当前进程中所有服务的吞吐统计"""
+    with _endpoint_pools_lock:
+        pools = list(_endpoint_pools.values())
+    return [stats for pool in pools for stats in pool.stats()]
+
+class StreamAborted(Exception):
+    """流式输出被on_delta回调主动终止"""
+
+def _consume_stream(stream, on_delta, record, start_time):
+    """
+    读取流式响应并拼装成完整的ChatCompletion
+    
+    每收到一段新文本就调用on_delta(delta, text_so_far)，回调返回True时关闭连接并抛出StreamAborted，
+    不再为后续的输出付费。
+    """
+    parts = []
+    finish_reason = None
+    usage = None
+    response_id, created, model = "", int(time.time()), ""
+    try:
+        for chunk in stream:
+            response_id, created, model = chunk.id or response_id, chunk.created or created, chunk.model or model
+            if chunk.usage is not None:
+                usage = chunk.usage.model_dump(mode="json")
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            finish_reason = choice.finish_reason or finish_reason
+            delta = choice.delta.content if choice.delta is not None else None
+            if not delta:
+                continue
+            if not parts:
+                record["first_token_latency"] = time.perf_counter() - start_time
+            parts.append(delta)
+            if on_delta is not None and on_delta(delta, "".join(parts)):
+                raise StreamAborted(f"已接收 {sum(len(part) for part in parts)} 个字符后终止")
+    finally:
+        stream.close()
+    return ChatCompletion.model_validate({
+        "id": response_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "".join(parts)},
+            "finish_reason": finish_reason or "stop"
+        }],
+        "usage": usage
+    })
+
+def send_to_endpoint(pool, endpoint, config, request, on_delta=None, record=None):
+    """向指定服务发送一次请求，结束后释放服务名额并更新服务统计。流式请求会被拼装成完整响应"""
+    attempt_start = time.perf_counter()
+    try:
+        response = get_client(endpoint.client_config(config)).chat.completions.create(
+            **dict(request, model=endpoint.model or request["model"])
+        )
+        if request.get("stream"):
+            response = _consume_stream(response, on_delta, record if record is not None else {}, attempt_start)
+    except StreamAborted:
+        # 主动终止不代表服务不健康
+        pool.release(endpoint, True, time.perf_counter() - attempt_start)
+        raise
     except Exception as e:
-        print(f"加载配置文件时出错: {e}")
-        return {}
+        # 只有限流、超时、服务端错误才算作服务不健康，请求本身有误时不影响服务的健康状态
+        pool.release(endpoint, not is_retryable_error(e), time.perf_counter() - attempt_start)
+        raise
+    usage_tokens = response.usage.total_tokens if response.usage is not None else 0
+    pool.release(endpoint, True, time.perf_counter() - attempt_start, usage_tokens or 0)
+    return response
 
-# 全局客户端实例
-_client = None
+def _run_in_thread(fn, *args):
+    """在独立的后台线程中执行fn，返回Future。对冲请求不用线程池，避免线程池占满时对冲请求排队"""
+    future = Future()
+    
+    def runner():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    
+    threading.Thread(target=runner, daemon=True).start()
+    return future
 
-def get_client(config=None):
-    """获取或初始化OpenAI客户端"""
-    global _client
-    
-    # 如果提供了新配置或客户端不存在，则初始化
-    if _client is None or config is not None:
-        # 如果没有提供配置，从YAML加载
-        if config is None:
-            config = load_config()
-            
-        _client = OpenAI(
-            base_url=config.get("BASE_URL", ""),
-            api_key=config.get("API_KEY", "sk-demo-key"),
-            timeout=config.get("REQUEST_TIMEOUT", 1000)
+# 对冲请求的延迟窗口与统计，按调用用途分别记录近期延迟
+_latency_windows = {}
+_hedge_lock = threading.Lock()
+_hedge_stats = {"eligible_calls": 0, "fired": 0, "hedge_wins": 0}
+# 计算p99对比时只保留最近的延迟样本，长时间运行的进程中不会无限增长
+HEDGE_STATS_WINDOW = 10000
+_hedge_latencies = {"actual": deque(maxlen=HEDGE_STATS_WINDOW), "primary": deque(maxlen=HEDGE_STATS_WINDOW)}
+
+def get_hedge_delay(config, purpose):
+    """返回该用途调用的对冲等待时间，未启用对冲或样本不足时返回None"""
+    if not config.get("HEDGE_ENABLED", False):
+        return None
+    with _hedge_lock:
+        window = list(_latency_windows.get(purpose, ()))
+    if len(window) < config.get("HEDGE_MIN_SAMPLES", 20):
+        return None
+    return max(_percentile(window, config.get("HEDGE_PERCENTILE", 95)), config.get("HEDGE_MIN_DELAY", 5.0))
+
+def record_attempt_latency(config, purpose, latency):
+    """记录一次成功请求的延迟，用于计算对冲等待时间"""
+    with _hedge_lock:
+        window = _latency_windows.get(purpose)
+        if window is None:
+            window = _latency_windows[purpose] = deque(maxlen=config.get("HEDGE_WINDOW", 200))
+        window.append(latency)
+
+def send_hedged(pool, limiter, endpoint, config, request, hedge_delay, estimated_tokens, record):
+    """
+    发送对冲请求：主请求在hedge_delay秒内未返回时，向另一个（或同一个）服务再发一份相同请求，
+    先成功返回的结果获胜。
+    
+    同步客户端无法中断已发出的HTTP请求，落败的请求若尚未开始会被取消，否则其结果被丢弃，
+    服务名额在它结束时释放。
+    
+    返回:
+        tuple: (响应, 获胜的服务)
+    """
+    attempt_start = time.perf_counter()
+    with _hedge_lock:
+        _hedge_stats["eligible_calls"] += 1
+    primary = _run_in_thread(send_to_endpoint, pool, endpoint, config, request)
+    
+    def finish(response, winner, primary_latency=None):
+        actual = time.perf_counter() - attempt_start
+        with _hedge_lock:
+            _hedge_latencies["actual"].append(actual)
+            if primary_latency is not None:
+                _hedge_latencies["primary"].append(primary_latency)
+        return response, winner
+    
+    try:
+        response = primary.result(timeout=hedge_delay)
+        return finish(response, endpoint, time.perf_counter() - attempt_start)
+    except FuturesTimeoutError:
+        pass
+    
+    # 对冲请求同样受限流和服务并发上限约束，没有余量时继续等待主请求
+    hedge_endpoint = pool.try_acquire(exclude=[endpoint]) if limiter.try_acquire(estimated_tokens) else None
+    if hedge_endpoint is None:
+        response = primary.result()
+        return finish(response, endpoint, time.perf_counter() - attempt_start)
+    
+    record["hedged"] = True
+    with _hedge_lock:
+        _hedge_stats["fired"] += 1
+    
+    # 主请求结束时记录它的实际耗时，作为不对冲时的延迟
+    def on_primary_done(future):
+        if future.exception() is None:
+            with _hedge_lock:
+                _hedge_latencies["primary"].append(time.perf_counter() - attempt_start)
+    primary.add_done_callback(on_primary_done)
+    
+    hedge = _run_in_thread(send_to_endpoint, pool, hedge_endpoint, config, request)
+    futures = {primary: endpoint, hedge: hedge_endpoint}
+    pending = set(futures)
+    first_error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for loser in pending:
+                    loser.cancel()
+                if future is hedge:
+                    record["hedge_won"] = True
+                    with _hedge_lock:
+                        _hedge_stats["hedge_wins"] += 1
+                else:
+                    # 对冲请求落败，退还它预扣的token预算
+                    limiter.adjust(-estimated_tokens)
+                return finish(future.result(), futures[future])
+            first_error = first_error or future.exception()
+    # 两个请求都失败：主请求预扣的预算由call_llm退还，这里退还对冲请求预扣的部分
+    limiter.adjust(-estimated_tokens)
+    raise first_error
+
+def get_hedge_stats():
+    """
+    返回对冲请求的统计：触发次数、对冲获胜次数，以及启用对冲前后的p99延迟对比
+    
+    "不对冲的p99"使用主请求自身的实际完成时间估算（对冲获胜时主请求仍会在后台结束）。
+    """
+    with _hedge_lock:
+        stats = dict(_hedge_stats)
+        actual = list(_hedge_latencies["actual"])
+        primary = list(_hedge_latencies["primary"])
+    stats["fire_rate"] = round(stats["fired"] / stats["eligible_calls"], 4) if stats["eligible_calls"] else 0.0
+    stats["p99_with_hedging"] = round(_percentile(actual, 99), 3)
+    stats["p99_without_hedging"] = round(_percentile(primary, 99), 3)
+    stats["p99_improvement"] = round(stats["p99_without_hedging"] - stats["p99_with_hedging"], 3)
+    return stats
+
+# LLM调用遥测：每次调用生成一条记录，写入进程级列表以及当前上下文中所有活动的统计范围
+_telemetry_records = []
+_telemetry_lock = threading.Lock()
+_telemetry_scopes = contextvars.ContextVar("llm_telemetry_scopes", default=())
+
+@contextmanager
+def telemetry_scope():
+    """
+    收集当前上下文中发生的LLM调用记录
+    
+    用法:
+        with telemetry_scope() as records:
+            call_llm(...)
+        summary = summarize_telemetry(records)
+    """
+    records = []
+    token = _telemetry_scopes.set(_telemetry_scopes.get() + (records,))
+    try:
+        yield records
+    finally:
+        _telemetry_scopes.reset(token)
+
+def record_llm_call(record):
+    """登记一条LLM调用记录"""
+    with _telemetry_lock:
+        _telemetry_records.append(record)
+    for records in _telemetry_scopes.get():
+        records.append(record)
+
+def get_telemetry_records():
+    """返回当前进程中所有LLM调用记录的副本"""
+    with _telemetry_lock:
+        return list(_telemetry_records)
+
+def reset_telemetry():
+    """清空进程级的LLM调用记录和对冲请求的统计（计算对冲等待时间的延迟窗口保留）"""
+    with _telemetry_lock:
+        _telemetry_records.clear()
+    with _hedge_lock:
+        for key in _hedge_stats:
+            _hedge_stats[key] = 0
+        for latencies in _hedge_latencies.values():
+            latencies.clear()
+
+def _percentile(values, q):
+    """计算百分位数（线性插值），values为空时返回0"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    lower = int(pos)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+def summarize_telemetry(records, wall_time=None):
+    """
+    汇总LLM调用记录
+    
+    参数:
+        records (list): record_llm_call登记的调用记录
+        wall_time (float): 这些调用覆盖的墙钟时间（秒），提供时额外计算整体吞吐
+        
+    返回:
+        dict: 调用次数、token用量、延迟分位数及按用途的细分
+    """
+    def empty_bucket():
+        return {"calls": 0, "cache_hits": 0, "errors": 0, "aborted": 0, "retries": 0, "hedged": 0, "rate_limit_wait": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "latency_total": 0.0}
+    
+    summary = empty_bucket()
+    by_purpose = {}
+    latencies = []
+    first_token_latencies = []
+    for record in records:
+        bucket = by_purpose.setdefault(record.get("purpose", "general"), empty_bucket())
+        for target in (summary, bucket):
+            target["calls"] += 1
+            target["cache_hits"] += record["outcome"] == "cache_hit"
+            target["errors"] += record["outcome"] == "error"
+            target["aborted"] += record["outcome"] == "aborted"
+            target["retries"] += record.get("retries", 0)
+            target["hedged"] += bool(record.get("hedged"))
+            target["rate_limit_wait"] += record.get("rate_limit_wait", 0.0)
+            target["prompt_tokens"] += record.get("prompt_tokens", 0)
+            target["completion_tokens"] += record.get("completion_tokens", 0)
+            target["cached_tokens"] += record.get("cached_tokens", 0)
+            target["latency_total"] += record.get("latency", 0.0)
+        if record["outcome"] != "cache_hit":
+            latencies.append(record.get("latency", 0.0))
+        if "first_token_latency" in record:
+            first_token_latencies.append(record["first_token_latency"])
+    
+    for target in [summary] + list(by_purpose.values()):
+        target["total_tokens"] = target["prompt_tokens"] + target["completion_tokens"]
+        target["latency_total"] = round(target["latency_total"], 3)
+        target["rate_limit_wait"] = round(target["rate_limit_wait"], 3)
+        # 输入token中命中服务端前缀缓存的比例
+        target["prefix_cache_hit_rate"] = (
+            round(target["cached_tokens"] / target["prompt_tokens"], 4) if target["prompt_tokens"] else 0.0
         )
     
-    return _client
+    summary["latency_p50"] = round(_percentile(latencies, 50), 3)
+    summary["latency_p95"] = round(_percentile(latencies, 95), 3)
+    summary["latency_p99"] = round(_percentile(latencies, 99), 3)
+    if first_token_latencies:
+        # 流式调用的首token延迟
+        summary["first_token_p50"] = round(_percentile(first_token_latencies, 50), 3)
+        summary["first_token_p95"] = round(_percentile(first_token_latencies, 95), 3)
+    # 单次调用的生成速度：补全token数 / 调用耗时之和
+    summary["completion_tokens_per_second"] = (
+        round(summary["completion_tokens"] / summary["latency_total"], 2) if summary["latency_total"] else 0.0
+    )
+    if wall_time:
+        # 整体吞吐：所有token / 墙钟时间，并发时会高于单次调用的速度
+        summary["wall_time"] = round(wall_time, 3)
+        summary["tokens_per_second"] = round(summary["total_tokens"] / wall_time, 2)
+    summary["by_purpose"] = by_purpose
+    return summary
+
+def print_telemetry_report(summary):
+    """在控制台输出LLM调用统计报告"""
+    print(f"LLM调用: {summary['calls']} 次（缓存命中 {summary['cache_hits']}，失败 {summary['errors']}，"
+          f"提前终止 {summary['aborted']}，重试 {summary['retries']}，"
+          f"对冲 {summary['hedged']}，限流等待 {summary['rate_limit_wait']}s）")
+    print(f"Token用量: 输入 {summary['prompt_tokens']}，输出 {summary['completion_tokens']}，合计 {summary['total_tokens']}")
+    if summary["cached_tokens"]:
+        print(f"前缀缓存: 命中 {summary['cached_tokens']} 个输入token，命中率 {summary['prefix_cache_hit_rate']:.1%}")
+    print(f"延迟: p50 {summary['latency_p50']}s，p95 {summary['latency_p95']}s，p99 {summary['latency_p99']}s")
+    if "first_token_p50" in summary:
+        print(f"首token延迟: p50 {summary['first_token_p50']}s，p95 {summary['first_token_p95']}s")
+    if "tokens_per_second" in summary:
+        print(f"吞吐: {summary['tokens_per_second']} tokens/s（墙钟 {summary['wall_time']}s），"
+              f"单次生成速度 {summary['completion_tokens_per_second']} tokens/s")
+    for purpose, bucket in summary["by_purpose"].items():
+        print(f"  [{purpose}] {bucket['calls']} 次，输入 {bucket['prompt_tokens']}（前缀缓存命中 {bucket['prefix_cache_hit_rate']:.1%}），"
+              f"输出 {bucket['completion_tokens']}，耗时 {bucket['latency_total']}s")
 
-def call_llm(messages, model=None, temperature=None, config=None):
-    """调用LLM API的简单封装"""
+def call_llm(messages, model=None, temperature=None, config=None, max_tokens=None, use_cache=True, refresh_cache=False,
+             purpose="general", stream=False, on_delta=None, n=1, seed=None):
+    """
+    调用LLM API的简单封装
+    
+    相同的模型、消息、温度和最大token数会命中本地响应缓存，不再重复请求。
+    use_cache=False时完全绕过缓存；refresh_cache=True时忽略已有缓存并用新响应覆盖。
+    每次调用都会登记一条遥测记录，purpose用于标记调用用途（如split/summary/format_correction）。
+    发送前经过共享限流器；遇到限流、超时等可重试错误时按指数退避重试，最多MAX_RETRIES次。
+    配置了多个服务(ENDPOINTS)时，每次请求发往当前负载最小的健康服务，重试时优先换一个服务。
+    启用HEDGE_ENABLED后，调用超过近期延迟分位数仍未返回时会发出对冲请求，取先返回的结果。
+    stream=True时以流式接收输出，每收到新文本调用on_delta(delta, text_so_far)；回调返回True会立即终止输出，
+    此时返回None，遥测记录的outcome为aborted。流式响应同样拼装成完整的ChatCompletion返回，且不参与对冲。
+    n>1时在一次请求中生成多个候选（choices），不能与流式同时使用；seed用于区分并发发出的同一请求，
+    两者都是缓存键的一部分。
+    """
     # 更新或获取配置
     if config is None:
         config = load_config()
     
-    # 获取客户端
-    client = get_client(config)
-    
     # 设置参数
     model = model or config.get("DEFAULT_MODEL", "deepseek-r1")
     temperature = temperature if temperature is not None else config.get("TEMPERATURE", 0.0)
+    max_tokens = max_tokens or config.get("MAX_TOKENS", 8192)
     
-    # 调用API
-    try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            timeout=config.get("REQUEST_TIMEOUT", 1000),
-            max_tokens=8192,
-        )
-        return response
-    except Exception as e:
-        print(f"LLM API调用失败: {e}")
-        return None
+    record = {
+        "timestamp": datetime.now().isoformat(),
+        "purpose": purpose,
+        "model": model,
+        "outcome": "success",
+        "latency": 0.0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "cached_tokens": 0,
+        "retries": 0,
+        "rate_limit_wait": 0.0,
+        "hedged": False
+    }
+    start_time = time.perf_counter()
+    
+    # 查询响应缓存
+    cache = get_cache(config) if use_cache else None
+    cache_key = None
+    if cache is not None:
+        cache_key = LLMResponseCache.make_key(model, messages, temperature, max_tokens, n, seed)
+        if not refresh_cache and not config.get("CACHE_REFRESH", False):
+            cached = cache.get(cache_key)
+            if cached is not None:
+                record["outcome"] = "cache_hit"
+                record["latency"] = time.perf_counter() - start_time
+                record_llm_call(record)
+                response = ChatCompletion.model_validate(cached)
+                # 流式调用命中缓存时，把完整内容一次性交给回调，保证调用方的处理流程一致
+                if stream and on_delta is not None:
+                    content = response.choices[0].message.content
+                    on_delta(content, content)
+                return response
+    
+    # 调用API，经过限流器并对可重试的错误进行退避重试
+    limiter = get_rate_limiter(config)
+    pool = get_endpoint_pool(config)
+    estimated_tokens = estimate_prompt_tokens(messages)
+    max_retries = config.get("MAX_RETRIES", 5)
+    request = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "timeout": config.get("REQUEST_TIMEOUT", 1000),
+        "max_tokens": max_tokens,
+    }
+    if n != 1:
+        request["n"] = n
+    if seed is not None:
+        request["seed"] = seed
+    if stream:
+        request["stream"] = True
+        request["stream_options"] = {"include_usage": True}
+    hedge_delay = None if stream else get_hedge_delay(config, purpose)
+    attempt = 0
+    failed_endpoints = []
+    while True:
+        record["rate_limit_wait"] += limiter.acquire(estimated_tokens)
+        endpoint = pool.acquire(exclude=failed_endpoints)
+        record["endpoint"] = endpoint.base_url
+        attempt_start = time.perf_counter()
+        try:
+            if hedge_delay is None:
+                response = send_to_endpoint(pool, endpoint, config, request, on_delta, record)
+            else:
+                response, winner = send_hedged(pool, limiter, endpoint, config, request, hedge_delay, estimated_tokens, record)
+                record["endpoint"] = winner.base_url
+            record_attempt_latency(config, purpose, time.perf_counter() - attempt_start)
+            break
+        except StreamAborted as e:
+            print(f"流式输出被提前终止: {e}")
+            record["outcome"] = "aborted"
+            record["latency"] = time.perf_counter() - start_time
+            record_llm_call(record)
+            return None
+        except Exception as e:
+            retryable = is_retryable_error(e)
+            if retryable:
+                failed_endpoints.append(endpoint)
+            # 失败的请求不消耗token预算
+            limiter.adjust(-estimated_tokens)
+            if attempt < max_retries and retryable:
+                delay = retry_delay(e, attempt, config.get("RETRY_BASE_DELAY", 1.0), config.get("RETRY_MAX_DELAY", 60.0))
+                print(f"LLM API调用失败({endpoint.base_url}): {e}，{delay:.1f} 秒后进行第 {attempt + 1} 次重试")
+                time.sleep(delay)
+                attempt += 1
+                record["retries"] = attempt
+                continue
+            print(f"LLM API调用失败({endpoint.base_url}): {e}")
+            record["outcome"] = "error"
+            record["error"] = str(e)
+            record["latency"] = time.perf_counter() - start_time
+            record_llm_call(record)
+            return None
+    
+    record["latency"] = time.perf_counter() - start_time
+    if response.usage is not None:
+        record["prompt_tokens"] = response.usage.prompt_tokens or 0
+        record["completion_tokens"] = response.usage.completion_tokens or 0
+        # 支持前缀缓存的服务会在prompt_tokens_details中返回命中缓存的输入token数
+        prompt_details = getattr(response.usage, "prompt_tokens_details", None)
+        record["cached_tokens"] = (getattr(prompt_details, "cached_tokens", 0) or 0) if prompt_details else 0
+        # 用实际用量修正预扣的TPM预算
+        limiter.adjust(record["prompt_tokens"] + record["completion_tokens"] - estimated_tokens)
+    if response.choices:
+        record["finish_reason"] = response.choices[0].finish_reason
+    record_llm_call(record)
+    
+    # 只缓存有内容的响应，避免把异常结果固化下来
+    if cache is not None and response.choices and response.choices[0].message.content:
+        try:
+            cache.set(cache_key, response.model_dump(mode="json"))
+        except Exception as e:
+            print(f"写入LLM响应缓存失败: {e}")
+    return response
 
 # 其余代码保持不变...
 
@@ -127,6 +1029,30 @@ def savejson(data, filepath, encoding='utf-8', indent=2, ensure_dir=True):
         print(f"保存JSON文件失败: {filepath}, 错误: {str(e)}")
         return False
 
+def savejson_atomic(data, filepath, encoding='utf-8'):
+    """
+    原子地保存JSON文件：先写入临时文件并fsync，再重命名覆盖目标文件，
+    保证进程崩溃或断电时目标文件要么是旧内容要么是完整的新内容
+    """
+    tmp_path = f"{filepath}.tmp"
+    with open(tmp_path, 'w', encoding=encoding) as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filepath)
+
+def content_hash(text: str) -> str:
+    """计算文本内容的sha256哈希"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def file_hash(filepath: str) -> str:
+    """计算文件内容的sha256哈希"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
 def get_all_txt_files(directory: str) -> List[str]:
     """
     递归获取指定目录及其子目录下的所有txt文件
@@ -171,3 +1097,4 @@ if __name__ == "__main__":
 
     if resp:
         print(resp.choices[0].message.content)
+    print_telemetry_report(summarize_telemetry(get_telemetry_records()))